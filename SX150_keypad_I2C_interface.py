@@ -25,62 +25,1125 @@
 # Keypad decode engine and 3x4 numeric keypad for user input
 # 1 Red and 1 Green LED for user feedback
 
-import smbus
 import time
 import signal
 import threading
+import heapq
+import itertools
+import collections
+import contextlib
+import hashlib
+import hmac
+import os
 import sys
-import RPi.GPIO as GPIO
-from db_manager import PASSCODE_DB
-from remote_interface import remote_unlock_event
-from remote_interface import RemoteCommandThread
-
-RemoteCommandServer = RemoteCommandThread()
+import errno
+# Python 2, and Python 3 for keypad_async's asyncio users
+try:
+    import Queue
+    import thread
+except ImportError:
+    import queue as Queue
+    import _thread as thread
+
+import keypad_metrics
+from keypad_metrics import metrics
+from keypad_log import log
+
+# the time this module was loaded, startup times are reported from here
+module_load_time = time.time()
+
+# smbus, RPi.GPIO, db_manager and remote_interface are imported when first used so importing this module
+# is fast and works without them, ie. with the sx1509_sim backends; smbus and RPi.GPIO are only
+# available on the device
+def default_bus(channel):
+    import smbus
+    return smbus.SMBus(channel)
+
+def default_gpio():
+    import RPi.GPIO as GPIO
+    return GPIO
+
+def default_db():
+    from db_manager import PASSCODE_DB
+    return PASSCODE_DB()
+
+RemoteCommandServer = None
+RemoteCommandServerLock = threading.Lock()
+
+# the remote command server is shared by every user interface, create and start it once
+def start_remote_command_server():
+    global RemoteCommandServer
+    with RemoteCommandServerLock:
+        if RemoteCommandServer is None:
+            from remote_interface import RemoteCommandThread
+            RemoteCommandServer = RemoteCommandThread()
+            RemoteCommandServer.start()
 
 
 
 if __name__ == '__main__':
-    GPIO.setmode(GPIO.BOARD)
+    default_gpio().setmode(default_gpio().BOARD)
+
+# registers that are not 0x00 after power up / reset, as per the SX1509 datasheet; shared with sx1509_sim.
+# The LED driver registers of I/O 0-3 and 8-11 are RegTOn, RegIOn, RegOff (3 each) and those of I/O 4-7 and
+# 12-15 add RegTRise, RegTFall (5 each), from RegTOn0 at 0x29: only RegIOn is not 0x00
+SX1509_REG_DEFAULTS = {0x0E: 0xFF, 0x0F: 0xFF,                                  # RegDirB/A: all inputs
+                       0x10: 0xFF, 0x11: 0xFF,                                  # RegDataB/A
+                       0x12: 0xFF, 0x13: 0xFF,                                  # RegInterruptMaskB/A
+                       0x27: 0xFF, 0x28: 0xFF,                                  # RegKeyData1/2: no key
+                       0x2A: 0xFF, 0x2D: 0xFF, 0x30: 0xFF, 0x33: 0xFF,          # RegIOn0-3
+                       0x36: 0xFF, 0x3B: 0xFF, 0x40: 0xFF, 0x45: 0xFF,          # RegIOn4-7
+                       0x4A: 0xFF, 0x4D: 0xFF, 0x50: 0xFF, 0x53: 0xFF,          # RegIOn8-11
+                       0x56: 0xFF, 0x5B: 0xFF, 0x60: 0xFF, 0x65: 0xFF,          # RegIOn12-15
+                      }
+
+# ========= define a class to shadow the SX1509 registers =========
+# write-through cache of the SX1509 register file so that bit level updates of a register
+# (ie. the LED on/off bits in RegDataB) cost a single I2C write instead of a read + write
+class SX1509_RegisterCache:
+
+    reg_reset = 0x7D
+    # keypad input data registers change with every key press so they are never cached
+    volatile_regs = (0x27, 0x28)
+    # SX1509 register space 0x00 - 0x7F
+    reg_count = 0x80
+    # register values after power up / reset
+    reg_defaults = SX1509_REG_DEFAULTS
+    # the last register with a known reset value, RegHighInputA
+    reg_last = 0x6A
+    # longest smbus block transfer
+    block_size = 32
+
+    def __init__(self, bus, address):
+        self.bus = bus
+        self.address = address
+        self.lock = threading.RLock()
+        self.shadow = [0] * self.reg_count
+        self.valid = [False] * self.reg_count
+        self.cache_hits = 0
+        self.cache_misses = 0
+
+    # read a register, only goes out on the bus if the cached value is not valid
+    def read(self, reg):
+        with self.lock:
+            if self.valid[reg]:
+                self.cache_hits = self.cache_hits + 1
+                return self.shadow[reg]
+            self.cache_misses = self.cache_misses + 1
+            msg_data = self.bus.read_byte_data(self.address, reg)
+            if reg not in self.volatile_regs:
+                self.shadow[reg] = msg_data
+                self.valid[reg] = True
+            return msg_data
+
+    # write a register through to the chip and keep a copy of the value written
+    def write(self, reg, msg_data):
+        with self.lock:
+            self.bus.write_byte_data(self.address, reg, msg_data)
+            if reg not in self.volatile_regs:
+                self.shadow[reg] = msg_data
+                self.valid[reg] = True
+
+    # write several registers, skipping the ones that already hold the value; with posted=True the
+    # writes are queued on the bus as one group and the call returns without waiting for the bus
+    def write_group(self, writes, posted=False):
+        with self.lock:
+            changed = []
+            for reg, msg_data in writes:
+                if self.valid[reg] and self.shadow[reg] == msg_data:
+                    self.cache_hits = self.cache_hits + 1
+                    continue
+                self.shadow[reg] = msg_data
+                self.valid[reg] = True
+                changed.append((reg, msg_data))
+            if not changed:
+                return
+            if posted and hasattr(self.bus, 'post_writes'):
+                self.bus.post_writes(self.address, changed)
+            else:
+                for reg, msg_data in changed:
+                    self.bus.write_byte_data(self.address, reg, msg_data)
+
+    # clear the bits not in and_mask, set the bits in or_mask and preserve the rest; nothing is
+    # written when the register already holds the result
+    def update_bits(self, reg, and_mask=0xFF, or_mask=0x00, posted=False):
+        with self.lock:
+            msg_data = (self.read(reg) & and_mask) | or_mask
+            self.write_group([(reg, msg_data)], posted=posted)
+            return msg_data
+
+    # drop the cached value of one or all registers so the next read goes to the chip
+    def invalidate(self, reg=None):
+        with self.lock:
+            if reg is None:
+                self.valid = [False] * self.reg_count
+            else:
+                self.valid[reg] = False
+
+    # software reset of the SX1509: as per the datasheet write 0x12 then 0x34 to RegReset
+    # all registers return to their default values so the cache holds the defaults without reading them
+    def reset(self):
+        with self.lock:
+            self.bus.write_byte_data(self.address, self.reg_reset, 0x12)
+            self.bus.write_byte_data(self.address, self.reg_reset, 0x34)
+            self.set_defaults()
+
+    # the chip was reset, ie. by a brown out, and holds its reset values
+    def set_defaults(self):
+        with self.lock:
+            self.invalidate()
+            for reg in range(self.reg_last + 1):
+                if reg not in self.volatile_regs:
+                    self.shadow[reg] = self.reg_defaults.get(reg, 0x00)
+                    self.valid[reg] = True
+
+    # read count registers from reg into the cache with as few block reads as possible, ie. to find
+    # out what a chip that was not reset holds
+    def load(self, reg, count):
+        with self.lock:
+            for block_reg in range(reg, reg + count, self.block_size):
+                block_count = min(self.block_size, reg + count - block_reg)
+                data = self.bus.read_i2c_block_data(self.address, block_reg, block_count)
+                self.cache_misses = self.cache_misses + 1
+                for offset, msg_data in enumerate(data):
+                    if block_reg + offset not in self.volatile_regs:
+                        self.shadow[block_reg + offset] = msg_data
+                        self.valid[block_reg + offset] = True
+
+    # block read of consecutive registers in a single I2C transaction, never cached; doesn't take
+    # the cache lock so a key data read never waits behind a slower register update
+    def read_block(self, reg, count):
+        self.cache_misses = self.cache_misses + 1
+        return self.bus.read_i2c_block_data(self.address, reg, count)
+
+    # one read that doesn't wait for the bus, None when the bus is held or the read failed
+    def read_block_nowait(self, reg, count):
+        data = self.bus.read_i2c_block_data_nowait(self.address, reg, count)
+        if data is not None:
+            self.cache_misses = self.cache_misses + 1
+        return data
+
+    def cache_stats(self):
+        with self.lock:
+            return {'hits': self.cache_hits, 'misses': self.cache_misses,
+                    'valid': self.valid.count(True)}
+
+# ========= END define a class to shadow the SX1509 registers =========
+
+
+# I2C addresses an SX1509 can be strapped to
+SX1509_ADDRESSES = (0x3E, 0x3F, 0x70, 0x71)
+
+# ========= define a class to serialize access to a bus shared by several SX1509s =========
+# smbus selects the slave address and runs the transaction in separate calls, so transactions from
+# different threads are serialized; waiting transactions go in priority order, key data reads first
+PRIORITY_KEY_DATA = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LED = 2
+
+# bus errors by what a retry can do about them
+BUS_ERROR_TRANSIENT = 'transient'   # arbitration lost, timeout, busy: the next attempt normally works
+BUS_ERROR_NO_ACK = 'no_ack'         # no device acked the address, ie. the SX1509 is browning out or resetting
+BUS_ERROR_FATAL = 'fatal'           # the bus itself is gone or misused, retrying won't help
+BUS_ERROR_CLASSES = (BUS_ERROR_TRANSIENT, BUS_ERROR_NO_ACK, BUS_ERROR_FATAL)
+
+def classify_bus_error(e):
+    if e.errno in (errno.EREMOTEIO, errno.ENXIO):
+        return BUS_ERROR_NO_ACK
+    if e.errno in (errno.EIO, errno.EAGAIN, errno.ETIMEDOUT, errno.EBUSY, errno.EINTR):
+        return BUS_ERROR_TRANSIENT
+    return BUS_ERROR_FATAL
+
+class SharedBus:
+
+    # SX1509 registers that don't use PRIORITY_NORMAL
+    register_priority = {0x27: PRIORITY_KEY_DATA, 0x28: PRIORITY_KEY_DATA,  # RegKeyData1/2
+                         0x10: PRIORITY_LED,                                # RegDataB, LED on/off
+                        }
+    for reg in range(0x5F, 0x69):                                           # LED 14/15 driver
+        register_priority[reg] = PRIORITY_LED
+    del reg
+
+    # retries: attempts after the first for transient and no ack errors, the delay before a retry starts
+    # at retry_delay and doubles up to retry_delay_max so a failing transaction holds the bus for a few ms
+    def __init__(self, bus, retries=3, retry_delay=0.001, retry_delay_max=0.008):
+        self.bus = bus
+        self.retries = retries
+        self.retry_delay = retry_delay
+        self.retry_delay_max = retry_delay_max
+        self.condition = threading.Condition(threading.Lock())
+        # thread holding the bus and its nesting depth
+        self.owner = None
+        self.depth = 0
+        self.waiting = [0, 0, 0]
+        # queued writes (address, reg) -> value, written by the posted write thread
+        self.posted = collections.OrderedDict()
+        self.posted_writer = None
+        # statistics per priority
+        self.transactions = [0, 0, 0]
+        self.wait_count = [0, 0, 0]
+        self.wait_time = [0.0, 0.0, 0.0]
+        self.wait_time_max = [0.0, 0.0, 0.0]
+        self.posted_writes = 0
+        self.coalesced_writes = 0
+        self.posted_depth_max = 0
+        # errors per class, including the ones that were retried successfully
+        self.errors = dict((error_class, 0) for error_class in BUS_ERROR_CLASSES)
+        self.retried = 0
+        self.error_time = None
+        self.posted_write_errors = 0
+
+    # take the bus for one or more transactions; nested acquires by the same thread don't wait
+    def acquire(self, priority=PRIORITY_NORMAL):
+        me = thread.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.depth = self.depth + 1
+                return
+            start_time = None
+            self.waiting[priority] = self.waiting[priority] + 1
+            while self.owner is not None or sum(self.waiting[:priority]) > 0:
+                if start_time is None:
+                    start_time = time.time()
+                self.condition.wait()
+            self.waiting[priority] = self.waiting[priority] - 1
+            self.owner = me
+            self.depth = 1
+            if start_time is not None:
+                wait_time = time.time() - start_time
+                self.wait_count[priority] = self.wait_count[priority] + 1
+                self.wait_time[priority] = self.wait_time[priority] + wait_time
+                if wait_time > self.wait_time_max[priority]:
+                    self.wait_time_max[priority] = wait_time
+
+    # take the bus only if nobody holds it or waits for it at a higher priority, never waits
+    def try_acquire(self, priority=PRIORITY_NORMAL):
+        me = thread.get_ident()
+        with self.condition:
+            if self.owner == me:
+                self.depth = self.depth + 1
+                return True
+            if self.owner is not None or sum(self.waiting[:priority + 1]) > 0:
+                return False
+            self.owner = me
+            self.depth = 1
+            return True
+
+    def release(self):
+        with self.condition:
+            self.depth = self.depth - 1
+            if self.depth == 0:
+                self.owner = None
+                self.condition.notify_all()
+
+    # with bus.transaction(): ... makes a multi register operation atomic
+    @contextlib.contextmanager
+    def transaction(self, priority=PRIORITY_NORMAL):
+        self.acquire(priority)
+        try:
+            yield self
+        finally:
+            self.release()
+
+    def priority(self, reg):
+        return self.register_priority.get(reg, PRIORITY_NORMAL)
+
+    # a synchronous access replaces (write) or first flushes (read) a queued write of the same register
+    def take_posted(self, address, reg):
+        with self.condition:
+            return self.posted.pop((address, reg), None)
+
+    # run one transaction on the underlying bus, the caller holds the bus; transient and no ack
+    # errors are retried with a bounded exponential backoff before the IOError is raised
+    def bus_call(self, priority, function, *args):
+        self.transactions[priority] = self.transactions[priority] + 1
+        timed = metrics.enabled
+        if timed:
+            start_time = time.time()
+        retry_delay = self.retry_delay
+        attempt = 0
+        while True:
+            try:
+                result = function(*args)
+                break
+            except IOError as e:
+                error_class = classify_bus_error(e)
+                self.errors[error_class] = self.errors[error_class] + 1
+                self.error_time = time.time()
+                metrics.count(keypad_metrics.COUNT_BUS_ERRORS)
+                if error_class == BUS_ERROR_FATAL or attempt >= self.retries:
+                    raise
+            attempt = attempt + 1
+            self.retried = self.retried + 1
+            metrics.count(keypad_metrics.COUNT_BUS_RETRIES)
+            time.sleep(retry_delay)
+            retry_delay = min(retry_delay * 2, self.retry_delay_max)
+        if timed:
+            metrics.observe(keypad_metrics.STAGE_I2C_TRANSACTION, time.time() - start_time)
+        return result
+
+    def read_byte_data(self, address, reg):
+        priority = self.priority(reg)
+        with self.transaction(priority):
+            posted = self.take_posted(address, reg)
+            if posted is not None:
+                self.bus_call(priority, self.bus.write_byte_data, address, reg, posted)
+            return self.bus_call(priority, self.bus.read_byte_data, address, reg)
+
+    def write_byte_data(self, address, reg, msg_data):
+        priority = self.priority(reg)
+        with self.transaction(priority):
+            self.take_posted(address, reg)
+            self.bus_call(priority, self.bus.write_byte_data, address, reg, msg_data)
+
+    def read_i2c_block_data(self, address, reg, length=32):
+        priority = self.priority(reg)
+        with self.transaction(priority):
+            return self.bus_call(priority, self.bus.read_i2c_block_data, address, reg, length)
+
+    # for the GPIO callback: one attempt, no waiting for the bus and no retry sleeps; None when the bus
+    # is held or the read failed, the caller then reads with read_i2c_block_data from a thread that may wait
+    def read_i2c_block_data_nowait(self, address, reg, length=32):
+        priority = self.priority(reg)
+        if not self.try_acquire(priority):
+            return None
+        try:
+            self.transactions[priority] = self.transactions[priority] + 1
+            return self.bus.read_i2c_block_data(address, reg, length)
+        except IOError as e:
+            error_class = classify_bus_error(e)
+            self.errors[error_class] = self.errors[error_class] + 1
+            self.error_time = time.time()
+            metrics.count(keypad_metrics.COUNT_BUS_ERRORS)
+            return None
+        finally:
+            self.release()
+
+    def write_i2c_block_data(self, address, reg, data):
+        priority = self.priority(reg)
+        with self.transaction(priority):
+            for offset in range(len(data)):
+                self.take_posted(address, reg + offset)
+            self.bus_call(priority, self.bus.write_i2c_block_data, address, reg, data)
+
+    # queue writes of (reg, value) to be written at PRIORITY_LED as one group; a queued write to
+    # a register that is still waiting replaces the earlier value
+    def post_writes(self, address, writes):
+        with self.condition:
+            for reg, msg_data in writes:
+                key = (address, reg)
+                if key in self.posted:
+                    self.coalesced_writes = self.coalesced_writes + 1
+                self.posted[key] = msg_data
+                self.posted_writes = self.posted_writes + 1
+            if len(self.posted) > self.posted_depth_max:
+                self.posted_depth_max = len(self.posted)
+            if self.posted_writer is None:
+                self.posted_writer = threading.Thread(target=self.run_posted_writes)
+                self.posted_writer.daemon = True
+                self.posted_writer.start()
+            self.condition.notify_all()
+
+    def run_posted_writes(self):
+        while True:
+            with self.condition:
+                while not self.posted:
+                    self.condition.wait()
+            with self.transaction(PRIORITY_LED):
+                # taken while holding the bus so a synchronous write can't be overtaken by an older queued value
+                with self.condition:
+                    writes = list(self.posted.items())
+                    self.posted.clear()
+                for (address, reg), msg_data in writes:
+                    # a lost LED write must not stop the writer, the keypad's health monitor puts it back
+                    try:
+                        self.bus_call(PRIORITY_LED, self.bus.write_byte_data, address, reg, msg_data)
+                    except IOError as e:
+                        self.posted_write_errors = self.posted_write_errors + 1
+                        log.warning('bus', 'posted write failed', address=hex(address), reg=hex(reg), error=e)
+
+    def stats(self):
+        with self.condition:
+            return {'transactions': list(self.transactions),
+                    'waiting': list(self.waiting),
+                    'wait_count': list(self.wait_count),
+                    'wait_time_avg': [self.wait_time[priority] / self.wait_count[priority] if self.wait_count[priority] else 0.0
+                                      for priority in range(3)],
+                    'wait_time_max': list(self.wait_time_max),
+                    'posted_depth': len(self.posted),
+                    'posted_depth_max': self.posted_depth_max,
+                    'posted_writes': self.posted_writes,
+                    'coalesced_writes': self.coalesced_writes,
+                    'errors': dict(self.errors),
+                    'retried': self.retried,
+                    'posted_write_errors': self.posted_write_errors}
+
+# ========= END define a class to serialize access to a bus shared by several SX1509s =========
+
+
+# ========= define a class to derive the SX1509 keypad configuration from a key map =========
+# the key map is a list of rows, each a sequence of key names of the same length, ie. KEYPAD_3X4
+# rows are driven on I/O 0-7 and columns are read on I/O 8-15; the LEDs use I/O 14 and 15 so a
+# keypad with 7 or 8 columns needs leds=False
+KEYPAD_3X4 = (('1', '2', '3'),
+              ('4', '5', '6'),
+              ('7', '8', '9'),
+              ('*', '0', '#'),
+             )
+KEYPAD_4X4 = (('1', '2', '3', 'A'),
+              ('4', '5', '6', 'B'),
+              ('7', '8', '9', 'C'),
+              ('*', '0', '#', 'D'),
+             )
+
+class SX1509_KeypadLayout:
+
+    def __init__(self, key_map, leds=True):
+        self.key_map = [list(row_keys) for row_keys in key_map]
+        self.keypad_row = len(self.key_map)
+        if self.keypad_row:
+            self.keypad_col = len(self.key_map[0])
+        else:
+            self.keypad_col = 0
+        # RegKeyConfig2 rows = 0 turns scanning off so the engine scans 2 to 8 rows
+        if self.keypad_row < 2 or self.keypad_row > 8:
+            raise ValueError("keypad must have 2 to 8 rows: " + str(self.keypad_row))
+        if self.keypad_col < 1 or self.keypad_col > 8:
+            raise ValueError("keypad must have 1 to 8 columns: " + str(self.keypad_col))
+        for row_keys in self.key_map:
+            if len(row_keys) != self.keypad_col:
+                raise ValueError("every keypad row must have " + str(self.keypad_col) + " keys")
+        if leds and self.keypad_col > 6:
+            raise ValueError("columns 7 and 8 use the LED pins I/O 14 and 15, a " + str(self.keypad_col) +
+                             " column keypad needs leds=False")
+        self.leds = leds
+
+        self.row_mask = (1 << self.keypad_row) - 1
+        self.col_mask = (1 << self.keypad_col) - 1
+        if leds:
+            self.led_mask = 0xC0
+        else:
+            self.led_mask = 0x00
+        # number of rows bits(5:3) = rows - 1, number of columns bits(2:0) = columns - 1, ie. 4x3 = 0x1A
+        self.key_config_2 = ((self.keypad_row - 1) << 3) | (self.keypad_col - 1)
+        # all bank A pins are open drain outputs as in the original 3x4 configuration: the engine drives the
+        # rows and the unused pins stay high impedance with RegDataA at its reset value 0xFF
+        self.dir_A = 0x00
+        self.open_drain_A = 0xFF
+        # columns and unused bank B pins are pulled up inputs, the LED pins are outputs
+        self.dir_B = self.led_mask ^ 0xFF
+        self.pullup_B = self.led_mask ^ 0xFF
+        # the columns and unused bank B inputs are debounced as in the original configuration
+        self.debounce_B = self.led_mask ^ 0xFF
+
+# ========= END define a class to derive the SX1509 keypad configuration from a key map =========
+
+
+# ========= define a class to describe the keypad engine scan timing =========
+# RegDebounceConfig bits(2:0): debounce time 0.5ms * 2^n; RegKeyConfig1 bits(2:0): scan time per row 1ms * 2^n,
+# bits(6:4): auto sleep after 128ms * 2^(n-1) without a key press, 0 = off; all for the internal 2MHz clock.
+# The scan time per row must be longer than the debounce time.
+# A press just after its row was scanned is detected one full scan later, after the debounce time:
+# worst case detection latency = rows * scan time + debounce time. A key press wakes a sleeping engine and
+# scanning starts over from the first row so a sleeping keypad stays within the same bound.
+class KeypadScanProfile:
+
+    def __init__(self, name, debounce=0x05, scan_time=0x05, auto_sleep=0x00, clock=0x50):
+        if not 0 <= debounce <= 7 or not 0 <= scan_time <= 7 or not 0 <= auto_sleep <= 7:
+            raise ValueError("debounce, scan time and auto sleep are 3 bit register values")
+        # scan time per row 1ms * 2^n > debounce time 0.5ms * 2^n
+        if scan_time < debounce:
+            raise ValueError("scan time per row must be longer than the debounce time: " + name)
+        self.name = name
+        self.debounce = debounce
+        self.scan_time = scan_time
+        self.auto_sleep = auto_sleep
+        # RegClock, the keypad engine runs from the internal 2MHz oscillator
+        self.clock = clock
+        self.reg_debounce_config = debounce
+        self.reg_key_config_1 = (auto_sleep << 4) | scan_time
+
+    def debounce_time(self):
+        return 0.0005 * (1 << self.debounce)
+
+    def scan_time_per_row(self):
+        return 0.001 * (1 << self.scan_time)
+
+    # seconds without a key press before the engine sleeps, None when auto sleep is off
+    def auto_sleep_time(self):
+        if self.auto_sleep == 0:
+            return None
+        return 0.128 * (1 << (self.auto_sleep - 1))
+
+    def worst_case_latency(self, rows):
+        return rows * self.scan_time_per_row() + self.debounce_time()
+
+# lobby units: 4ms debounce, 8ms per row, never sleeps; worst case 36ms for 4 rows
+SCAN_PROFILE_LOW_LATENCY = KeypadScanProfile('low_latency', debounce=0x03, scan_time=0x03)
+# the original settings: 16ms debounce, 32ms per row, never sleeps; worst case 144ms for 4 rows
+SCAN_PROFILE_BALANCED = KeypadScanProfile('balanced', debounce=0x05, scan_time=0x05)
+# battery backed units: 16ms debounce, 64ms per row, sleeps after 128ms; worst case 272ms for 4 rows
+SCAN_PROFILE_LOW_POWER = KeypadScanProfile('low_power', debounce=0x05, scan_time=0x06, auto_sleep=0x01)
+
+SCAN_PROFILES = collections.OrderedDict((profile.name, profile) for profile in
+                                        (SCAN_PROFILE_LOW_LATENCY, SCAN_PROFILE_BALANCED, SCAN_PROFILE_LOW_POWER))
+
+# a profile name or a KeypadScanProfile
+def get_scan_profile(profile):
+    if isinstance(profile, KeypadScanProfile):
+        return profile
+    if profile not in SCAN_PROFILES:
+        raise ValueError("unknown scan profile " + str(profile) + ", one of " + ', '.join(SCAN_PROFILES))
+    return SCAN_PROFILES[profile]
+
+# ========= END define a class to describe the keypad engine scan timing =========
+
+
+# ========= define a class to hold the keys of the unlock code being entered =========
+# The keys are kept in a preallocated ring so adding a key is O(1); a code is joined once it is complete.
+#   KEY_SEQUENCE_FIXED: a code is complete after length keys
+#   KEY_SEQUENCE_ROLLING: every key completes a code of the last length keys, ie. 99912345 matches 2345
+#   terminators, ie. ('#',): a code of up to length keys is complete when a terminator is pressed, the
+#   oldest keys are dropped past length; clear_keys, ie. ('*',), start the code over
+# While a complete code is pending verification further keys are kept as type ahead, release() hands them
+# to the next attempt or drops them.
+KEY_SEQUENCE_FIXED = 'fixed'
+KEY_SEQUENCE_ROLLING = 'rolling'
+
+class KeySequenceBuffer:
+
+    def __init__(self, length=4, mode=KEY_SEQUENCE_FIXED, terminators=(), clear_keys=()):
+        if length < 1:
+            raise ValueError("key sequence length must be at least 1: " + str(length))
+        if mode not in (KEY_SEQUENCE_FIXED, KEY_SEQUENCE_ROLLING):
+            raise ValueError("unknown key sequence mode " + str(mode))
+        if mode == KEY_SEQUENCE_ROLLING and terminators:
+            raise ValueError("a rolling key sequence can't have terminators")
+        self.length = length
+        self.mode = mode
+        self.terminators = frozenset(terminators)
+        self.clear_keys = frozenset(clear_keys)
+        # the current attempt and up to one more attempt and its terminator typed ahead
+        self.capacity = 2 * length + 1
+        self.keys = [None] * self.capacity
+        # ring index of the first key of the current attempt and its number of keys
+        self.start = 0
+        self.count = 0
+        # the current attempt was handed out as a complete code
+        self.pending = False
+        # keys typed while the code was pending, they follow the current attempt in the ring
+        self.ahead = 0
+        self.dropped = 0
+
+    # returns the complete code or None
+    def add(self, key):
+        if self.pending:
+            if self.ahead == self.capacity - self.count:
+                self.dropped = self.dropped + 1
+                return None
+            self.keys[(self.start + self.count + self.ahead) % self.capacity] = key
+            self.ahead = self.ahead + 1
+            return None
+        return self.push(key, True)
+
+    def push(self, key, complete_at_length):
+        if key in self.clear_keys:
+            self.count = 0
+            return None
+        if key in self.terminators:
+            if self.count == 0:
+                return None
+            return self.complete()
+        if self.count == self.length:
+            # rolling window or a terminated code that is too long: drop the oldest key
+            self.start = (self.start + 1) % self.capacity
+            self.count = self.count - 1
+        self.keys[(self.start + self.count) % self.capacity] = key
+        self.count = self.count + 1
+        if complete_at_length and not self.terminators and self.count == self.length:
+            return self.complete()
+        return None
+
+    def complete(self):
+        self.pending = True
+        return ''.join([self.keys[(self.start + index) % self.capacity] for index in range(self.count)])
+
+    # the pending code was handled: with keep_type_ahead the keys typed meanwhile start the next attempt
+    # and the code they complete, if any, is returned; a rolling window keeps its keys
+    def release(self, keep_type_ahead=False):
+        ahead_keys = [self.keys[(self.start + self.count + index) % self.capacity] for index in range(self.ahead)]
+        pending = self.pending
+        self.pending = False
+        self.ahead = 0
+        if not keep_type_ahead:
+            self.start = 0
+            self.count = 0
+            return None
+        if not ahead_keys and not pending:
+            # nothing was handed out, the attempt goes on
+            return None
+        if self.mode == KEY_SEQUENCE_ROLLING:
+            for key in ahead_keys:
+                self.push(key, False)
+            # only a window with a new key is a new code
+            if ahead_keys and self.count == self.length:
+                return self.complete()
+            return None
+        self.start = (self.start + self.count) % self.capacity
+        self.count = 0
+        code = None
+        for key in ahead_keys:
+            if code is None:
+                code = self.push(key, True)
+            else:
+                self.add(key)
+        return code
+
+    def reset(self):
+        self.release(False)
+
+# ========= END define a class to hold the keys of the unlock code being entered =========
+
+
+# ========= define a class to decode the keypad engine key data =========
+# KeyData1 (column) and KeyData2 (row) are active low, exactly 1 bit of each byte is 0 for a valid key press
+# each raw byte is mapped through a precomputed 256 entry table to the row/col number or to a decode error
+KEY_DECODE_OK = 0
+KEY_DECODE_NONE = -1   # no bit set ie. an errant 0xFF read
+KEY_DECODE_MULTI = -2  # more than one bit set
+KEY_DECODE_RANGE = -3  # bit set outside of the configured keypad matrix
+KEY_DECODE_AMBIGUOUS = -4  # more than one bit set in both bytes, the pressed keys can't be told apart
+
+class SX1509_KeyDecoder:
+
+    def __init__(self, key_map, keypad_row, keypad_col):
+        self.key_map = key_map
+        self.keypad_row = keypad_row
+        self.keypad_col = keypad_col
+        self.row_table = self.build_table(keypad_row)
+        self.col_table = self.build_table(keypad_col)
+        # for multi key presses: the bit numbers of the 0 bits, or None when a bit is outside the matrix
+        self.row_bits = self.build_bits_table(keypad_row)
+        self.col_bits = self.build_bits_table(keypad_col)
+
+    # table entry = bit number of the single 0 bit in the raw byte, or a KEY_DECODE_ error
+    @staticmethod
+    def build_table(width):
+        table = []
+        for raw_byte in range(256):
+            bits = raw_byte ^ 0xFF
+            if bits == 0:
+                table.append(KEY_DECODE_NONE)
+            elif bits & (bits - 1):
+                table.append(KEY_DECODE_MULTI)
+            else:
+                bit_num = bits.bit_length() - 1
+                if bit_num < width:
+                    table.append(bit_num)
+                else:
+                    table.append(KEY_DECODE_RANGE)
+        return table
+
+    @staticmethod
+    def build_bits_table(width):
+        table = []
+        for raw_byte in range(256):
+            bits = raw_byte ^ 0xFF
+            if bits >> width:
+                table.append(None)
+            else:
+                table.append(tuple(bit_num for bit_num in range(width) if bits & (1 << bit_num)))
+        return table
+
+    # returns (status, row, col, key); key is None unless status == KEY_DECODE_OK
+    def decode(self, col_byte, row_byte):
+        col = self.col_table[col_byte]
+        row = self.row_table[row_byte]
+        if col < 0:
+            return col, row, col, None
+        if row < 0:
+            return row, row, col, None
+        return KEY_DECODE_OK, row, col, self.key_map[row][col]
+
+    # returns (status, keys) with keys a tuple of (row, col, key); several keys pressed in one row (or one
+    # column) are returned as KEY_DECODE_MULTI with every pressed key, a single key costs the same two lookups
+    def decode_keys(self, col_byte, row_byte):
+        col = self.col_table[col_byte]
+        row = self.row_table[row_byte]
+        if col >= 0 and row >= 0:
+            return KEY_DECODE_OK, ((row, col, self.key_map[row][col]),)
+        if col in (KEY_DECODE_NONE, KEY_DECODE_RANGE):
+            return col, ()
+        if row in (KEY_DECODE_NONE, KEY_DECODE_RANGE):
+            return row, ()
+        rows = self.row_bits[row_byte]
+        cols = self.col_bits[col_byte]
+        if rows is None or cols is None:
+            return KEY_DECODE_RANGE, ()
+        if len(rows) > 1 and len(cols) > 1:
+            return KEY_DECODE_AMBIGUOUS, ()
+        return KEY_DECODE_MULTI, tuple((row, col, self.key_map[row][col]) for row in rows for col in cols)
+
+# ========= END define a class to decode the keypad engine key data =========
+
+
+# ========= define a class to run deferred calls at a deadline =========
+# a single thread services a heap of deadlines so timed steps (ie. turning an LED off after a flash)
+# never need a sleeping thread or a new Timer thread of their own
+class ScheduledCall:
+
+    def __init__(self, deadline, callback, args, name):
+        self.deadline = deadline
+        self.callback = callback
+        self.args = args
+        self.name = name
+        self.cancelled = False
+
+
+class DeadlineScheduler:
+
+    def __init__(self):
+        self.heap = []
+        self.condition = threading.Condition()
+        self.sequence = itertools.count()
+        self.thread = threading.Thread(target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    # call callback(*args) delay seconds from now, returns a handle that can be cancelled
+    def schedule(self, delay, callback, args=(), name=None):
+        call = ScheduledCall(time.time() + delay, callback, args, name)
+        with self.condition:
+            heapq.heappush(self.heap, (call.deadline, next(self.sequence), call))
+            # wake the scheduler thread in case the new deadline is the earliest one
+            self.condition.notify()
+        return call
+
+    # cancelled calls are left in the heap and discarded when they reach the top
+    def cancel(self, call):
+        if call is not None:
+            call.cancelled = True
+
+    # move a call to a new deadline delay seconds from now, returns the new handle
+    def reschedule(self, call, delay):
+        self.cancel(call)
+        return self.schedule(delay, call.callback, call.args, call.name)
+
+    # list of (seconds until due, name) of the calls that have not run or been cancelled, earliest first
+    def pending(self):
+        now = time.time()
+        with self.condition:
+            calls = [entry[2] for entry in self.heap if not entry[2].cancelled]
+        calls.sort(key=lambda call: call.deadline)
+        return [(call.deadline - now, call.name) for call in calls]
+
+    def run(self):
+        while True:
+            with self.condition:
+                while True:
+                    while self.heap and self.heap[0][2].cancelled:
+                        heapq.heappop(self.heap)
+                    if not self.heap:
+                        self.condition.wait()
+                        continue
+                    delay = self.heap[0][0] - time.time()
+                    if delay <= 0:
+                        call = heapq.heappop(self.heap)[2]
+                        break
+                    self.condition.wait(delay)
+            # run the call outside the lock so it can schedule further calls
+            try:
+                call.callback(*call.args)
+            except Exception as e:
+                log.error('scheduler', 'scheduled call failed', call=call.name, error=e)
+
+# ========= END define a class to run deferred calls at a deadline =========
+
+
+# ========= define a class to defer key press processing off of the GPIO callback thread =========
+# the GPIO callback only captures a timestamp and the raw key data, decoding, building the key sequence
+# and the LED feedback are done by the dispatcher's worker thread
+class KeypadDispatcher:
+
+    # with several workers each keypad is assigned to one worker so its key presses stay in order
+    def __init__(self, queue_size=32, workers=1):
+        self.work_queues = []
+        self.workers = []
+        for worker_num in range(workers):
+            work_queue = Queue.Queue(queue_size)
+            worker = threading.Thread(target=self.run, args=(work_queue,))
+            worker.daemon = True
+            worker.start()
+            self.work_queues.append(work_queue)
+            self.workers.append(worker)
+        self.assigned = 0
+        self.overflow_count = 0
+
+    # returns the worker queue for a keypad, round robin
+    def register(self, keypad):
+        work_queue = self.work_queues[self.assigned % len(self.work_queues)]
+        self.assigned = self.assigned + 1
+        return work_queue
+
+    # called from the GPIO callback thread, never blocks; the key press is dropped if the queue is full
+    def submit(self, keypad, timestamp, key_data):
+        try:
+            keypad.dispatch_queue.put_nowait((keypad, timestamp, key_data))
+            return True
+        except Queue.Full:
+            self.overflow_count = self.overflow_count + 1
+            return False
+
+    # number of key presses waiting to be processed
+    def pending(self):
+        return sum(work_queue.qsize() for work_queue in self.work_queues)
+
+    def run(self, work_queue):
+        while True:
+            keypad, timestamp, key_data = work_queue.get()
+            try:
+                keypad.process_key_data(timestamp, key_data)
+            except Exception as e:
+                log.error('dispatcher', 'key processing failed', keypad=keypad.keypad_id, error=e)
+
+# ========= END define a class to defer key press processing off of the GPIO callback thread =========
+
+
+# ========= define a class to detect and recover from SX1509 bus faults =========
+# every interval seconds one block read of RegClock - RegKeyConfig2 checks those registers against the
+# configuration the keypad wrote, and a keypad that gets a bus error asks for a check straight away.
+# RegClock back at its reset value means the chip was reset (ie. a brown out): the cache is set to the
+# reset values and only the registers that differ from them are written back. Any other difference, or
+# bus errors since the last check, is repaired from a block read of RegInputDisableB - RegKeyConfig2.
+# A check that fails on the bus is retried with a backoff that doubles up to the interval.
+class KeypadHealthMonitor:
+
+    reg_first = 0x1E    # RegClock
+    reg_last = 0x26     # RegKeyConfig2
+    # LED driver registers are written from the cache, ones that may not have reached the chip are rewritten
+    led_regs = range(0x5F, 0x69)
+
+    def __init__(self, keypad, interval=1.0, retry_delay=0.005):
+        self.keypad = keypad
+        self.interval = interval
+        self.retry_delay = retry_delay
+        self.delay = retry_delay
+        self.lock = threading.Lock()
+        self.check_call = None
+        self.stopped = True
+        # start of the current outage, None while the keypad is healthy
+        self.fault_time = None
+        self.ok_time = time.time()
+        self.bus_error_count = self.bus_errors()
+        self.checks = 0
+        self.failed_checks = 0
+        self.chip_resets = 0
+        self.repairs = 0
+        self.recoveries = 0
+        self.stuck_interrupts = 0
+        self.recovery_time_last = None
+        self.recovery_time_max = 0.0
+
+    def bus_errors(self):
+        bus = self.keypad.bus
+        return sum(bus.errors.values()) + bus.posted_write_errors
+
+    def start(self):
+        self.stopped = False
+        self.schedule(self.interval)
+
+    def stop(self):
+        with self.lock:
+            self.stopped = True
+            self.keypad.scheduler.cancel(self.check_call)
+            self.check_call = None
+
+    def schedule(self, delay):
+        with self.lock:
+            if self.stopped:
+                return
+            self.keypad.scheduler.cancel(self.check_call)
+            self.check_call = self.keypad.scheduler.schedule(delay, self.check, name="keypad health check")
+
+    # a bus call of the keypad failed after its retries
+    def report_error(self, e):
+        if self.fault_time is None:
+            self.fault_time = time.time()
+        log.warning('health', 'bus error', keypad=self.keypad.keypad_id, error_class=classify_bus_error(e), error=e)
+        self.schedule(0)
+
+    # scheduler callback
+    def check(self):
+        delay = self.interval
+        try:
+            self.verify()
+            # a key press whose key data was never read holds the interrupt low and no further falling edge
+            # comes, ie. it came in while the bus was failing or its deferred read was lost to a dispatcher overflow
+            if self.keypad.GPIO.input(self.keypad.KP_INT_PIN) == self.keypad.GPIO.LOW:
+                self.stuck_interrupts = self.stuck_interrupts + 1
+                log.warning('health', 'interrupt stuck low, reading the key data', keypad=self.keypad.keypad_id)
+                self.keypad.read_key_press(self.keypad.KP_INT_PIN)
+            self.delay = self.retry_delay
+        except IOError as e:
+            self.failed_checks = self.failed_checks + 1
+            if self.fault_time is None:
+                self.fault_time = time.time()
+            log.warning('health', 'check failed', keypad=self.keypad.keypad_id, error_class=classify_bus_error(e),
+                        error=e, retry_s=self.delay)
+            delay = self.delay
+            self.delay = min(self.delay * 2, self.interval)
+        finally:
+            self.schedule(delay)
+
+    def verify(self):
+        keypad = self.keypad
+        regs = keypad.regs
+        self.checks = self.checks + 1
+        # the register cache lock is taken before the bus, as everywhere else
+        with regs.lock:
+            with keypad.bus.transaction():
+                expected = keypad.expected_config()
+                data = regs.read_block(self.reg_first, self.reg_last - self.reg_first + 1)
+                bus_errors = self.bus_errors()
+                chip_reset = data[0] == 0x00 and expected.get(keypad.reg_clock, 0x00) != 0x00
+                changed = [reg for reg in range(self.reg_first, self.reg_last + 1)
+                           if reg in expected and data[reg - self.reg_first] != expected[reg]]
+                if not changed and bus_errors == self.bus_error_count and self.fault_time is None:
+                    self.ok_time = time.time()
+                    return
+                if self.fault_time is None:
+                    # the chip was last seen configured at the previous check
+                    self.fault_time = self.ok_time
+                if chip_reset:
+                    self.chip_resets = self.chip_resets + 1
+                    metrics.count(keypad_metrics.COUNT_CHIP_RESETS)
+                    regs.set_defaults()
+                else:
+                    self.repairs = self.repairs + 1
+                    regs.load(0x00, 0x27)
+                for reg in self.led_regs:
+                    regs.invalidate(reg)
+                regs.write_group(keypad.config_writes())
+                keypad.LED.configure()
+                self.bus_error_count = bus_errors
+        now = time.time()
+        recovery_time = now - self.fault_time
+        self.fault_time = None
+        self.ok_time = now
+        self.recoveries = self.recoveries + 1
+        self.recovery_time_last = recovery_time
+        if recovery_time > self.recovery_time_max:
+            self.recovery_time_max = recovery_time
+        metrics.count(keypad_metrics.COUNT_RECOVERIES)
+        if metrics.enabled:
+            metrics.observe(keypad_metrics.STAGE_BUS_RECOVERY, recovery_time)
+        log.info('health', 'recovered', keypad=keypad.keypad_id, chip_reset=chip_reset, registers_changed=len(changed),
+                 recovery_ms=recovery_time * 1000.0)
+
+    def stats(self):
+        return {'checks': self.checks, 'failed_checks': self.failed_checks, 'chip_resets': self.chip_resets,
+                'repairs': self.repairs, 'recoveries': self.recoveries, 'stuck_interrupts': self.stuck_interrupts,
+                'recovery_time_last': self.recovery_time_last,
+                'recovery_time_max': self.recovery_time_max, 'healthy': self.fault_time is None}
+
+# ========= END define a class to detect and recover from SX1509 bus faults =========
+
 
 # ========= define a class to interface with the keyboard =========
 class I2C_KeyPad:
 
-    def __init__(self, unlock_code_max=4, inter_keypress_time=6, kpad_interrupt_input_pin=7):
+    def __init__(self, unlock_code_max=4, inter_keypress_time=6, kpad_interrupt_input_pin=7, dispatcher=None, scheduler=None,
+                 bus=None, gpio=None, channel=1, address=0x3E, keypad_id=None, key_map=KEYPAD_3X4, leds=True,
+                 trace=None, warm_start=False, self_test=True, health_check_interval=1.0, scan_profile=SCAN_PROFILE_BALANCED,
+                 key_sequence_mode=KEY_SEQUENCE_FIXED, terminators=(), clear_keys=(), type_ahead=False):
+
+        init_time = time.time()
 
+        # identifies the keypad when several are served by one process
+        self.keypad_id = keypad_id
+        # the last complete unlock code, "" until one is entered
         self.unlock_code = ""
         self.unlock_code_read_event = threading.Event()
         self.unlock_code_update_lock = threading.RLock()
         self.unlock_code_max = unlock_code_max
         self.inter_keypress_time = inter_keypress_time
         self.display_unlock_code_reset=True
-        self.key_interpress_timer = threading.Timer(self.inter_keypress_time,self.unlock_code_reset, [True])
-
-        # key map for keypad row/col decoding
-        self.keypad_row=4
-        self.keypad_col=3
-        self.keypad_matrix_size = 0x1A # defines #row/cols for RegKeyConfig2 as per SX1509 spec. sheet
-        self.keypad_clock_enable = 0x50 # internal 2Mhz clock
+        # inter key press timeout, run by the scheduler; key_count identifies the key that started it
+        self.key_interpress_timer = None
+        self.key_count = 0
+        # called with the completed unlock code, in addition to setting unlock_code_read_event
+        self.unlock_code_listener = None
+
+        # key map for keypad row/col decoding, the register settings are derived from its size
+        self.layout = SX1509_KeypadLayout(key_map, leds)
+        self.keypad_row = self.layout.keypad_row
+        self.keypad_col = self.layout.keypad_col
+        self.keypad_matrix_size = self.layout.key_config_2 # defines #row/cols for RegKeyConfig2 as per SX1509 spec. sheet
+        # debounce, scan time, auto sleep and clock, see set_scan_profile
+        self.scan_profile = get_scan_profile(scan_profile)
+        self.keypad_clock_enable = self.scan_profile.clock # internal 2Mhz clock
         self.keypad_clock_disable = 0x10 # disable clock
-        self.key_map = a = [['1', '2', '3'],
-                            ['4', '5', '6'],
-                            ['7', '8', '9'],
-                            ['*', '0', '#'],
-                           ]
+        self.key_map = self.layout.key_map
+        # precomputed row/col decode tables for the key data registers
+        self.key_decoder = SX1509_KeyDecoder(self.key_map, self.keypad_row, self.keypad_col)
+        self.key_decode_errors = {KEY_DECODE_NONE: 0, KEY_DECODE_RANGE: 0, KEY_DECODE_AMBIGUOUS: 0}
+        # called with the (row, col, key) tuples of keys pressed together, they are not added to the unlock code
+        self.multi_key_listener = None
+        self.multi_key_presses = 0
+        # called with each decoded key and the time of its interrupt
+        self.key_listener = None
+        # keys of the unlock code being entered, unlock_code_max is the code length (the longest code with terminators)
+        for key in tuple(terminators) + tuple(clear_keys):
+            if not any(key in row_keys for row_keys in self.key_map):
+                raise ValueError("terminator or clear key " + str(key) + " is not on the keypad")
+        self.key_sequence = KeySequenceBuffer(unlock_code_max, key_sequence_mode, terminators, clear_keys)
+        # keep scanning while a code is verified, the keys typed meanwhile start the next attempt after a rejection
+        self.type_ahead = type_ahead
+
+        # key presses are processed by the dispatcher's worker thread, not the GPIO callback thread
+        if dispatcher is None:
+            dispatcher = KeypadDispatcher()
+        self.dispatcher = dispatcher
+        self.dispatch_queue = dispatcher.register(self)
+        # longest time spent in the GPIO callback, in seconds
+        self.callback_time_max = 0.0
+        # interrupts whose key data was read by the dispatcher's worker because the bus was held
+        self.deferred_reads = 0
+        # runs the timed steps of the LED patterns
+        if scheduler is None:
+            scheduler = DeadlineScheduler()
+        self.scheduler = scheduler
+
+        # RPi.GPIO unless another gpio backend is given
+        if gpio is None:
+            gpio = default_gpio()
+        self.GPIO = gpio
 
         # SX1509 Interupt connection to the PI; pin 7
         self.KP_INT_PIN = kpad_interrupt_input_pin
-        GPIO.setup(self.KP_INT_PIN, GPIO.IN, pull_up_down=GPIO.PUD_UP)
-        GPIO.add_event_detect(self.KP_INT_PIN, GPIO.FALLING, callback=self.read_key_press)
+        self.GPIO.setup(self.KP_INT_PIN, self.GPIO.IN, pull_up_down=self.GPIO.PUD_UP)
 
-        print "unlock_code_max: " + str(self.unlock_code_max)
-        print "KP_interupt_pin: " + str(self.KP_INT_PIN)
+        log.info('init', 'keypad setup', keypad=self.keypad_id, unlock_code_max=self.unlock_code_max,
+                 interrupt_pin=self.KP_INT_PIN)
 
         # I2C channel 1 is connected to the SX1509 I/O expander with keyboard engine
-        self.channel = 1
-        # Initialize I2C (SMBus)
-        self.bus = smbus.SMBus(self.channel)
-        #  SX1509 address
-        self.address = 0x3E
+        self.channel = channel
+        # Initialize I2C (SMBus) unless another bus backend is given
+        if bus is None:
+            bus = default_bus(self.channel)
+        # trace recorder, ie. keypad_trace.KeypadTraceRecorder: gets every interrupt's raw key data and,
+        # unless the bus is already shared, every transaction
+        self.trace = trace
+        if trace is not None and not isinstance(bus, SharedBus):
+            bus = trace.bus(bus)
+        # all access to the bus is serialized and prioritized
+        if not isinstance(bus, SharedBus):
+            bus = SharedBus(bus)
+        self.bus = bus
+        #  SX1509 address, set by the ADDR1/ADDR0 pins
+        if address not in SX1509_ADDRESSES:
+            raise ValueError("SX1509 address must be one of 0x3E, 0x3F, 0x70, 0x71: " + hex(address))
+        self.address = address
 
         # ===== define addresses of keypad engine registers =====
 
@@ -105,10 +1168,10 @@ class I2C_KeyPad:
         reg_pullup_B = 0x06
 
         # Input debounce setting registers
-        reg_debounce_config = 0x22 # debounce time
+        self.reg_debounce_config = 0x22 # debounce time
         reg_debounce_enable_A = 0x24
         reg_debounce_enable_B = 0x23
-        reg_key_config_1 = 0x25
+        self.reg_key_config_1 = 0x25
         self.reg_key_config_2 = 0x26
 
         self.reg_key_data_1 = 0x27 # keypad input data: pressed key column
@@ -118,171 +1181,338 @@ class I2C_KeyPad:
 
         # ===== initilize the keypad engine =====
 
-        # start by reseting the dSX1509 as per the datasheet write 0x12 then 0x34 to reset
-        msg_data = 0x12
-        self.bus.write_byte_data(self.address, reg_reset,  msg_data)
-        msg_data = 0x34
-        self.bus.write_byte_data(self.address, reg_reset,  msg_data)
-
-        # init the internal clock 2Mhz
-        msg_data = self.keypad_clock_enable
-        self.bus.write_byte_data(self.address, self.reg_clock,  msg_data)
-
-        # The I/O directions of the keypad's pins
-        # 12 button key pad 4 rows, 3 columns
-        # SX1509 uses I/O 0-7 for rows; I/O 8-15 for columns;
-        # rows are outputs, columns are inputs
-        # 3x4 keypad uses outputs 0-2 and inputs 0-3
-        msg_data = 0x00
-        # initialze output pins
-        self.bus.write_byte_data(self.address, reg_dir_A,  msg_data) # set reg bit to 0 = outputs
-        #print hex(self.bus.read_byte_data(self.address, reg_dir_A))+' : reg dir A\n'
-        msg_data = 0xFF
-        self.bus.write_byte_data(self.address, reg_open_drain_A,  msg_data) # set reg bit to 1 = open drain output
-        #print hex(self.bus.read_byte_data(self.address, reg_open_drain_A))+' : open drain A\n'
-        # initilize input pins
-        msg_data = 0x3F #0xFF
-        self.bus.write_byte_data(self.address, reg_dir_B,  msg_data) # set reg bit to 1 = inputs
-        #print hex(self.bus.read_byte_data(self.address, reg_dir_B))+' : reg dir B\n'
-        self.bus.write_byte_data(self.address, reg_pullup_B,  msg_data) # set reg bit to 1 = inputs to pullup
-        #print hex(self.bus.read_byte_data(self.address, reg_pullup_B))+':  pullup B\n'
+        # all register access goes through the register cache
+        self.regs = SX1509_RegisterCache(self.bus, self.address)
+
+        # the configuration is written as one bus transaction group so nothing interleaves with it; the
+        # registers are collected and written with write_group which skips the ones already holding the value
+        config = []
+        with self.bus.transaction():
+            if warm_start:
+                # warm restart: the chip may still be configured by the previous run, read back what it holds
+                # (RegInputDisableB 0x00 - RegKeyConfig2 0x26) in 2 block reads instead of resetting it
+                self.regs.load(0x00, 0x27)
+            else:
+                # start by reseting the dSX1509 as per the datasheet write 0x12 then 0x34 to reset
+                self.regs.reset()
+
+            # init the internal clock 2Mhz
+            msg_data = self.keypad_clock_enable
+            config.append((self.reg_clock, msg_data))
+
+            # The I/O directions of the keypad's pins
+            # SX1509 uses I/O 0-7 for rows; I/O 8-15 for columns;
+            # rows are outputs, columns are inputs
+            # 3x4 keypad uses outputs 0-3 and inputs 0-2
+            msg_data = self.layout.dir_A
+            # initialze output pins
+            config.append((reg_dir_A, msg_data)) # set reg bit to 0 = outputs
+            #print hex(self.bus.read_byte_data(self.address, reg_dir_A))+' : reg dir A\n'
+            msg_data = self.layout.open_drain_A
+            config.append((reg_open_drain_A, msg_data)) # set reg bit to 1 = open drain output
+            #print hex(self.bus.read_byte_data(self.address, reg_open_drain_A))+' : open drain A\n'
+            # initilize input pins
+            msg_data = self.layout.dir_B # 0x3F with the LEDs on I/O 14 and 15
+            config.append((reg_dir_B, msg_data)) # set reg bit to 1 = inputs
+            #print hex(self.bus.read_byte_data(self.address, reg_dir_B))+' : reg dir B\n'
+            msg_data = self.layout.pullup_B
+            config.append((reg_pullup_B, msg_data)) # set reg bit to 1 = inputs to pullup
+            #print hex(self.bus.read_byte_data(self.address, reg_pullup_B))+':  pullup B\n'
+
+            # Enable and configure debouncing on the inputs
+            msg_data = self.scan_profile.reg_debounce_config # debounce time as specd in the SX1509 datasheet : 0x05=16ms, 0x04=8ms
+            config.append((self.reg_debounce_config, msg_data))
+            #print hex(self.bus.read_byte_data(self.address, reg_debounce_config))+': debounce config\n'
+            msg_data = self.layout.debounce_B
+            config.append((reg_debounce_enable_B, msg_data)) # set reg bit to 1 = enable debouncing on the input
+            #print hex(self.bus.read_byte_data(self.address, reg_debounce_enable_B))+': debounce enable\n'
+
+            # scan time per row bits(2:0) > debounce time = 32ms = 0b0110;  Auto sleep time bits(6:4) = 0 (off) = 0x05
+            #                                               16ms = 0b0100;  Auto sleep time bits(6:0) = 0 (off) = 0x04
+            msg_data = self.scan_profile.reg_key_config_1
+            config.append((self.reg_key_config_1, msg_data))
+            #print hex(self.bus.read_byte_data(self.address, reg_key_config_1))+': config 1 \n'
+            # number of rows (outputs)  + key scan enable = 4 rows = bits(5:3) = 0b011
+            # number of columns (inputs) = 3 cols = bits(2:0) = 0b010
+            # = 00011010 = 0x1A for the 3x4 keypad
+            msg_data = self.keypad_matrix_size
+            config.append((self.reg_key_config_2, msg_data))
+            #print hex(self.bus.read_byte_data(self.address, reg_key_config_2))+' : config 2 \n'
+            self.regs.write_group(config)
+            # kept for the health monitor to restore
+            self.config = config
+            self.keypad_scanning = True
+
+            if warm_start:
+                # a key pressed while nothing was running holds the interrupt low so no falling edge would
+                # come, reading the key data releases it
+                self.regs.read_block(self.reg_key_data_1, 2)
+
+        # create LED object, shares the register cache with the keypad
+        # without the LEDs their pins can be keypad columns and the LED calls do nothing
+        if leds:
+            led_pins = (LED_RED, LED_GREEN)
+        else:
+            led_pins = ()
+        self.LED = I2C_LED(self.bus, self.address, self.regs, self.scheduler, led_pins)
+        if self_test:
+            # LED self test: both on for 4 seconds, turned off by the LED driver's scheduler
+            self.LED.play(LED_RED, LEDPattern.steady(4))
+            self.LED.play(LED_GREEN, LEDPattern.steady(4))
+        else:
+            # after a warm restart the LEDs may still show the previous run's state
+            self.LED.red_off()
+            self.LED.green_off()
+
+        # only start taking interrupts once the keypad engine and LEDs are initialized
+        self.GPIO.add_event_detect(self.KP_INT_PIN, self.GPIO.FALLING, callback=self.read_key_press)
 
-        # Enable and configure debouncing on the inputs
-        msg_data = 0x05 # debounce time 16 ms as specd in the SX1509 datasheet : 0x05=16ms, 0x04=8ms
-        self.bus.write_byte_data(self.address, reg_debounce_config, msg_data)
-        #print hex(self.bus.read_byte_data(self.address, reg_debounce_config))+': debounce config\n'
-        msg_data = 0x3F #0xFF
-        self.bus.write_byte_data(self.address, reg_debounce_enable_B, msg_data) # set reg bit to 1 = enable debouncing on the input
-        #print hex(self.bus.read_byte_data(self.address, reg_debounce_enable_B))+': debounce enable\n'
-
-        # scan time per row bits(2:0) > debounce time = 32ms = 0b0110;  Auto sleep time bits(6:4) = 0 (off) = 0x05
-        #                                               16ms = 0b0100;  Auto sleep time bits(6:0) = 0 (off) = 0x04
-        msg_data = 0x05
-        self.bus.write_byte_data(self.address, reg_key_config_1, msg_data)
-        #print hex(self.bus.read_byte_data(self.address, reg_key_config_1))+': config 1 \n'
-        # number of rows (outputs)  + key scan enable = 4 rows = bits(5:3) = 0b011
-        # number of columns (inputs) = 3 cols = bits(2:0) = 0b010
-        # = 00011010 = 0x1A
-        msg_data = self.keypad_matrix_size #0x1A
-        self.bus.write_byte_data(self.address, self.reg_key_config_2, msg_data)
-        #print hex(self.bus.read_byte_data(self.address, reg_key_config_2))+' : config 2 \n'
-
-
-        # create LED object
-        self.LED = I2C_LED(self.bus, self.address)
-        self.LED.red_steady_on()
-        self.LED.green_steady_on()
-        time.sleep(4)
-        self.LED.green_off()
-        self.LED.red_off()
+        # checks the chip's configuration and puts back what a bus fault or chip reset lost
+        self.health = None
+        if health_check_interval is not None:
+            self.health = KeypadHealthMonitor(self, health_check_interval)
+            self.health.start()
+
+        # time from the start of __init__ until key presses are taken, and from the module load
+        self.ready_time = time.time()
+        self.startup_time = self.ready_time - init_time
+        self.first_key_time = None
+        log.info('init', 'keypad ready', keypad=self.keypad_id, warm_start=warm_start, scan_profile=self.scan_profile.name,
+                 worst_case_latency_ms=self.scan_latency() * 1000.0,
+                 startup_ms=self.startup_time * 1000.0, since_load_ms=(self.ready_time - module_load_time) * 1000.0,
+                 bus_transactions=sum(self.bus.stats()['transactions']))
 
         # ===== end of keypad initalization =====
 
 
+    # GPIO interrupt callback: only read the key data and hand it to the dispatcher so the callback
+    # thread is free for the next interrupt; reading the key data also clears the SX1509 interrupt.
+    # The callback never waits for the bus: when another transaction holds it (ie. a queued LED group or a
+    # health check) or the read fails, the dispatcher's worker reads the key data, with retries
     def read_key_press(self, channel):
+        timestamp = time.time()
+        # KeyData1 (col) and KeyData2 (row) are consecutive registers so read both in one transaction
+        key_data = self.regs.read_block_nowait(self.reg_key_data_1, 2)
+        if key_data is None:
+            self.deferred_reads = self.deferred_reads + 1
+        elif self.trace is not None:
+            self.trace.key_data(timestamp, self.address, key_data)
+        self.dispatcher.submit(self, timestamp, key_data)
+        callback_time = time.time() - timestamp
+        if callback_time > self.callback_time_max:
+            self.callback_time_max = callback_time
+        if metrics.enabled:
+            metrics.observe(keypad_metrics.STAGE_READ_KEY_PRESS, callback_time)
+
+    # the key data the GPIO callback could not read without waiting for the bus
+    def read_deferred_key_data(self, timestamp):
+        try:
+            key_data = self.regs.read_block(self.reg_key_data_1, 2)
+        except IOError as e:
+            # the interrupt stays low, the health monitor reads the key data once the bus is back
+            self.bus_error(e)
+            return None
+        if self.trace is not None:
+            self.trace.key_data(timestamp, self.address, key_data)
+        return key_data
+
+    # runs on the dispatcher's worker thread
+    def process_key_data(self, timestamp, key_data):
+        if key_data is None:
+            key_data = self.read_deferred_key_data(timestamp)
+            if key_data is None:
+                return
 
-        self.LED.green_steady_on() #green_blink_on()
-        time.sleep(.25)
-        self.LED.green_off()
-        #print('reading key press: callback executing \n')
-        col_byte = self.bus.read_byte_data(self.address, self.reg_key_data_1) ^ 0xFF
-        #print "read_key_press - col_byte: " + str(col_byte)
-        col = 255
-        # determine which col bit is set by setting only that bit in the byte to 1 and then shifting right
-        # to bit 0; the number of shifts = the column number
-        if col_byte != 0: # in case of an errant 0xFF data read from keypad b/c 1 bit of read byte should always be 0
-            col = 0
-            while col_byte !=1 :
-                col = col+1
-                col_byte = col_byte >> 1
-        # determine which row bit is set by setting only that bit in the byte to 1 and then shifting right
-        # to bit 0; the number of shifts = the row number
-        row_byte = self.bus.read_byte_data(self.address, self.reg_key_data_2) ^ 0xFF
-        #print "read_key_press - row_byte:" + str(row_byte)
-        row = 255
-        if row_byte != 0: # in case of an errant 0xFF data read from keypad b/c 1 bit of read byte should always be 0
-            row = 0
-            while row_byte != 1:
-                row = row+1
-                row_byte = row_byte >> 1
+        if self.first_key_time is None:
+            self.first_key_time = timestamp
+            log.info('process_key_data', 'first key press', keypad=self.keypad_id,
+                     since_ready_s=timestamp - self.ready_time, since_load_s=timestamp - module_load_time)
 
+        # key press feedback
+        self.LED.play(LED_GREEN, LEDPattern.flash_once(.25))
+        #print('reading key press: callback executing \n')
+        status, keys = self.key_decoder.decode_keys(key_data[0], key_data[1])
         #print "read_key_press - row: "+ str(row) + "  col: " + str(col)
-        if row < self.keypad_row  and col < self.keypad_col:
-            pressed_key_val = self.key_map[row][col]
-            print('key:'+ pressed_key_val)
-            self.key_sequence_add(pressed_key_val)
+        if status == KEY_DECODE_OK:
+            metrics.count(keypad_metrics.COUNT_KEYPRESSES)
+            # never log the key itself, the keys make up the unlock code
+            log.debug('process_key_data', 'key pressed', keypad=self.keypad_id, timestamp=timestamp)
+            if self.key_listener is not None:
+                self.key_listener(keys[0][2], timestamp)
+            self.key_sequence_add(keys[0][2])
+        elif status == KEY_DECODE_MULTI:
+            # keys pressed together are a separate event, ie. a function key chord, not part of the code
+            metrics.count(keypad_metrics.COUNT_MULTI_KEY_PRESSES)
+            self.multi_key_presses = self.multi_key_presses + 1
+            log.info('process_key_data', 'keys pressed together', keypad=self.keypad_id, timestamp=timestamp,
+                     key_count=len(keys))
+            if self.multi_key_listener is not None:
+                self.multi_key_listener(keys)
+        else:
+            metrics.count(keypad_metrics.COUNT_INVALID_DECODES)
+            self.key_decode_errors[status] = self.key_decode_errors[status] + 1
+            log.warning('process_key_data', 'invalid key data', keypad=self.keypad_id, timestamp=timestamp,
+                        col_data=hex(key_data[0]), row_data=hex(key_data[1]), status=status)
 
 
     def key_sequence_add(self,new_key):
 
-
+        timed = metrics.enabled
+        if timed:
+            start_time = time.time()
+        try:
+            with self.unlock_code_update_lock:
+
+                # the key sequence buffer keeps the keys of the current attempt, once it completes a code an event
+                # is triggered to notify listeners so the code can be checked
+
+                # cancel the current inter key press timer
+                self.scheduler.cancel(self.key_interpress_timer)
+                self.key_interpress_timer = None
+
+                self.key_count = self.key_count + 1
+                # while the current code is checked the new key is typed ahead for the next attempt, it's dropped
+                # when the code is accepted or type ahead is off
+                if self.key_sequence.pending:
+                    self.key_sequence.add(new_key)
+                    log.info('key_sequence_add', 'typed ahead key', keypad=self.keypad_id,
+                             type_ahead_length=self.key_sequence.ahead)
+                    return
+                unlock_code = self.key_sequence.add(new_key)
+                log.info('key_sequence_add', 'added key', keypad=self.keypad_id, code_length=self.key_sequence.count)
+
+                # the key completed an unlock code so trigger the notify event
+                if unlock_code is not None:
+                    self.unlock_code_complete(unlock_code)
+                else:
+                    # only allow some much time in between key presses, if too much time then reset the current key sequence
+                    # and the user will have to start over
+                    self.display_unlock_code_reset=True
+                    self.key_interpress_timer = self.scheduler.schedule(self.inter_keypress_time, self.key_interpress_timeout,
+                                                                        (self.key_count,), "inter keypress timeout")
+        finally:
+            if timed:
+                metrics.observe(keypad_metrics.STAGE_KEY_SEQUENCE_ADD, time.time() - start_time)
+
+    # called with the unlock code update lock held
+    def unlock_code_complete(self, unlock_code):
+        self.unlock_code = unlock_code
+        self.unlock_code_read_event.set()
+        if self.unlock_code_listener is not None:
+            self.unlock_code_listener(unlock_code)
+
+    # scheduler callback when too much time passed since the last key press
+    def key_interpress_timeout(self, key_count):
         with self.unlock_code_update_lock:
-
-            # this functions keeps only a sequence of the last for keys that were pressed
-            # if the sequence reaches a length of self.key_sequence_max (unlock code length) an event is triggered to notify listeners that
-            # self.key_sequence_max keys have been pressed so the current sequence can be retieved
-
-            # cancel the current inter key press timer
-            self.key_interpress_timer.cancel()
-
-            # if the sequence is already self.key_sequence_max the new key is ignored until the sequence has been reset
-            # to less than self.key_sequence_max by an external call to key_sequence_reset
-            if len(self.unlock_code) == self.unlock_code_max:
-                #print('key_sequence_add - sequence == self.key_sequence_max, ignoring new key'+new_key)
+            # a key was added after the timeout became due
+            if key_count != self.key_count:
                 return
-            else:
-                self.unlock_code = self.unlock_code + new_key
-                print('key_sequence_add - added new key:' + self.unlock_code)
-
-            # key sequence has reached a length of self.key_sequence_max so trigger the notify event
-            if len(self.unlock_code) == self.unlock_code_max:
-                #print('key_sequence_add - new sequence = self.key_sequence_max - setting event')
-                self.unlock_code_read_event.set()
-                #self.LED.green_off()
-            else:
-                # only allow some much time in between key presses, if too much time then reset the current key sequence
-                # and the user will have to start over
-                self.display_unlock_code_reset=True
-                self.key_interpress_timer = threading.Timer(self.inter_keypress_time,self.unlock_code_reset, [True])
-                self.key_interpress_timer.start()
-                pass
-
-    def unlock_code_reset(self, LED_on):
-        print "unlock_code_reset: reset code"
+            self.key_interpress_timer = None
+            metrics.count(keypad_metrics.COUNT_TIMEOUTS)
+            self.unlock_code_reset(True)
+
+    # keep_type_ahead: the keys typed while the last code was checked start the next attempt (with type_ahead on),
+    # a rolling window keeps its keys after a rejected code with or without type_ahead
+    def unlock_code_reset(self, LED_on, keep_type_ahead=False):
+        timed = metrics.enabled
+        if timed:
+            start_time = time.time()
+        log.info('unlock_code_reset', 'reset code', keypad=self.keypad_id)
         with self.unlock_code_update_lock:
             self.unlock_code_read_event.clear()
             self.unlock_code = ""
+            unlock_code = self.key_sequence.release(keep_type_ahead and
+                                                    (self.type_ahead or self.key_sequence.mode == KEY_SEQUENCE_ROLLING))
             self.LED.green_off()
             self.LED.red_off()
             if LED_on == True: #self.display_unlock_code_reset==True:
-                self.LED.red_steady_on()
-                time.sleep(1.5)
-                self.LED.red_off()
+                self.LED.play(LED_RED, LEDPattern.flash_once(1.5))
 
             self.display_unlock_code_reset=True
+            if unlock_code is not None:
+                # the typed ahead keys already make up the next code
+                self.unlock_code_complete(unlock_code)
+            elif self.key_sequence.count:
+                self.scheduler.cancel(self.key_interpress_timer)
+                self.key_interpress_timer = self.scheduler.schedule(self.inter_keypress_time, self.key_interpress_timeout,
+                                                                    (self.key_count,), "inter keypress timeout")
+        if timed:
+            metrics.observe(keypad_metrics.STAGE_UNLOCK_CODE_RESET, time.time() - start_time)
 
 
     # has to be set to detect keypad input : default is false - no detect
     def enable_keypad_scanning(self, EnableFlag):
+        timed = metrics.enabled
+        if timed:
+            start_time = time.time()
         if EnableFlag == True :
-            print "EnableKeyPadDetect = Enabled"
+            log.info('enable_keypad_scanning', 'scanning enabled', keypad=self.keypad_id)
             # setup scanning of the 4x3 keypad matrix
             msg_data = self.keypad_matrix_size  # 0x1A
         elif EnableFlag == False:
-            print "EnableKeyPadDetect = Disabled"
+            log.info('enable_keypad_scanning', 'scanning disabled', keypad=self.keypad_id)
             # turn off scanning of keypad matrix
             msg_data = 0x00
-        self.bus.write_byte_data(self.address, self.reg_key_config_2, msg_data)
+        try:
+            with self.regs.lock:
+                self.keypad_scanning = EnableFlag
+                self.regs.write(self.reg_key_config_2, msg_data)
+        except IOError as e:
+            # the health monitor sets the scanning state once the bus is back
+            self.bus_error(e)
+        if timed:
+            metrics.observe(keypad_metrics.STAGE_ENABLE_KEYPAD_SCANNING, time.time() - start_time)
+
+    # switch the debounce, scan time, auto sleep and clock at runtime, key presses keep being taken; the
+    # profile becomes part of the configuration the health monitor checks and restores
+    def set_scan_profile(self, profile):
+        profile = get_scan_profile(profile)
+        profile_regs = {self.reg_clock: profile.clock,
+                        self.reg_debounce_config: profile.reg_debounce_config,
+                        self.reg_key_config_1: profile.reg_key_config_1}
+        with self.regs.lock:
+            self.scan_profile = profile
+            self.keypad_clock_enable = profile.clock
+            self.config = [(reg, profile_regs.get(reg, msg_data)) for reg, msg_data in self.config]
+            try:
+                # write_group skips the registers the profiles share
+                self.regs.write_group([(reg, msg_data) for reg, msg_data in self.config if reg in profile_regs])
+            except IOError as e:
+                # the health monitor writes the new profile once the bus is back
+                self.bus_error(e)
+        log.info('scan_profile', 'scan profile set', keypad=self.keypad_id, scan_profile=profile.name,
+                 worst_case_latency_ms=self.scan_latency() * 1000.0)
+
+    # worst case time from a key press until the keypad engine raises the interrupt, in seconds
+    def scan_latency(self):
+        return self.scan_profile.worst_case_latency(self.keypad_row)
+
+    # the configuration registers as the keypad wants them now, as a list of (reg, value) and a dict
+    def config_writes(self):
+        if self.keypad_scanning:
+            key_config_2 = self.keypad_matrix_size
+        else:
+            key_config_2 = 0x00
+        return [(reg, key_config_2 if reg == self.reg_key_config_2 else msg_data) for reg, msg_data in self.config]
+
+    def expected_config(self):
+        return dict(self.config_writes())
+
+    def bus_error(self, e):
+        if self.health is not None:
+            self.health.report_error(e)
+        else:
+            log.error('bus', 'bus error', keypad=self.keypad_id, error_class=classify_bus_error(e), error=e)
 
 
-    def enable_unlock_code_reading(self,LED_on):
+    def enable_unlock_code_reading(self,LED_on, keep_type_ahead=False):
 
         # for the new unlock code read cycle
                 # make sure user feedback LEDs are off
                 self.LED.green_off()
                 self.LED.red_off()
                 # clear the currently entered squence
-                self.unlock_code_reset(LED_on)
+                self.unlock_code_reset(LED_on, keep_type_ahead)
                 # start detection of user key presses
                 self.enable_keypad_scanning(True)
 
@@ -290,16 +1520,114 @@ class I2C_KeyPad:
 
 
 
+# ==========   define a class to describe LED patterns ===========
+# LED I/O pins on the SX1509
+LED_RED = 14
+LED_GREEN = 15
+
+# patterns are run by the SX1509 LED driver, the only step the driver can't do by itself
+# is to stop after a duration; that is done by the LED's deadline scheduler
+class LEDPattern:
+
+    # LED driver clock ClkX = 2Mhz / 2^(RegMisc bits(6:4) - 1) = 250Khz, as set up by I2C_LED
+    led_clock = 250000.0
+
+    # register values, as per the SX1509 datasheet:
+    # reg_ton   on time, 0 = static (steady on) mode
+    # reg_ion   on intensity
+    # reg_off   off time bits(7:3) and off intensity bits(2:0)
+    # reg_trise fade in time, 0 = off
+    # reg_tfall fade out time, 0 = off
+    # duration  seconds before the LED is turned off, None = until changed
+    def __init__(self, reg_ton=0x00, reg_ion=0xFF, reg_off=0x00, reg_trise=0x00, reg_tfall=0x00, duration=None):
+        self.reg_ton = reg_ton
+        self.reg_ion = reg_ion
+        self.reg_off = reg_off
+        self.reg_trise = reg_trise
+        self.reg_tfall = reg_tfall
+        self.duration = duration
+
+    # TOn/TOff: 1-15 = 64 * value * 255 / ClkX, 16-31 = 512 * value * 255 / ClkX
+    @classmethod
+    def time_reg(cls, seconds):
+        best = 1
+        for value in range(1, 32):
+            if abs(cls.reg_time(value) - seconds) < abs(cls.reg_time(best) - seconds):
+                best = value
+        return best
+
+    @classmethod
+    def reg_time(cls, value):
+        if value < 16:
+            return 64 * value * 255 / cls.led_clock
+        return 512 * value * 255 / cls.led_clock
+
+    # TRise/TFall: 1-15 = (RegIOn - 4 * off intensity) * value * 255 / ClkX, 16-31 = 16 times longer
+    @classmethod
+    def fade_reg(cls, seconds, reg_ion=0xFF):
+        best = 1
+        for value in range(1, 32):
+            if abs(cls.reg_fade(value, reg_ion) - seconds) < abs(cls.reg_fade(best, reg_ion) - seconds):
+                best = value
+        return best
+
+    @classmethod
+    def reg_fade(cls, value, reg_ion=0xFF):
+        fade = reg_ion * value * 255 / cls.led_clock
+        if value < 16:
+            return fade
+        return fade * 16
+
+    # the LED is on until changed, or for duration seconds
+    @classmethod
+    def steady(cls, duration=None, intensity=0xFF):
+        return cls(reg_ion=intensity, duration=duration)
+
+    # single flash of on_time seconds
+    @classmethod
+    def flash_once(cls, on_time, intensity=0xFF):
+        return cls(reg_ion=intensity, duration=on_time)
+
+    # count on/off blinks, count=None blinks until changed
+    @classmethod
+    def blink(cls, count=None, on_time=0.33, off_time=0.52, intensity=0xFF):
+        reg_ton = cls.time_reg(on_time)
+        reg_toff = cls.time_reg(off_time)
+        duration = None
+        if count is not None:
+            # stop in the off time after the last blink
+            duration = count * (cls.reg_time(reg_ton) + cls.reg_time(reg_toff)) - cls.reg_time(reg_toff) / 2
+        return cls(reg_ton=reg_ton, reg_ion=intensity, reg_off=reg_toff << 3, duration=duration)
+
+    # fade in, hold, fade out, hold off
+    @classmethod
+    def breathe(cls, on_time=0.5, off_time=0.5, rise_time=0.5, fall_time=0.5, duration=None, intensity=0xFF):
+        return cls(reg_ton=cls.time_reg(on_time), reg_ion=intensity, reg_off=cls.time_reg(off_time) << 3,
+                   reg_trise=cls.fade_reg(rise_time, intensity), reg_tfall=cls.fade_reg(fall_time, intensity),
+                   duration=duration)
+
+# ==========   END define a class to describe LED patterns ===========
+
+
 # ==========   define a class to interface with the LED ===========
 class I2C_LED:
 
-    def __init__(self, bus, address):
+    # led_pins: the LED pins that are driven, the others are left to the keypad and played patterns are ignored
+    def __init__(self, bus, address, regs=None, scheduler=None, led_pins=(LED_RED, LED_GREEN)):
 
         # I2C channel 1 is connected to the SX1509 I/O expander with keyboard engine
         # Initialize I2C (SMBus)
         self.bus = bus
         #  SX1509 address
         self.address = address #0x3E
+        # register cache shared with the keypad, bit updates of the LED registers are a single write
+        if regs is None:
+            regs = SX1509_RegisterCache(self.bus, self.address)
+        self.regs = regs
+        # turns LEDs off at the end of timed patterns
+        if scheduler is None:
+            scheduler = DeadlineScheduler()
+        self.scheduler = scheduler
 
         # ===== define addresses of keypad engine registers =====
 
@@ -347,199 +1675,622 @@ class I2C_LED:
         # I/O pin direction registers
         self.reg_dir_B = 0X0E
 
+        # per LED pin: (ton, ion, off, trise, tfall) registers and the RegDataB bit that turns it on (0) / off (1)
+        self.led_regs = {LED_RED: (self.reg_ton_14, self.reg_ion_14, self.reg_toff_14, self.reg_trise_14, self.reg_tfall_14, 0x40),
+                         LED_GREEN: (self.reg_ton_15, self.reg_ion_15, self.reg_toff_15, self.reg_trise_15, self.reg_tfall_15, 0x80),
+                        }
+        self.led_regs = dict((led, led_regs) for led, led_regs in self.led_regs.items() if led in led_pins)
+        # RegDataB/pin bank B bits of the driven LEDs, 0xC0 for both
+        led_mask = 0
+        for led_regs in self.led_regs.values():
+            led_mask = led_mask | led_regs[5]
+        self.led_mask = led_mask
+        # pending end of pattern deadline per LED and a count of the patterns played on it
+        self.pattern_end = {LED_RED: None, LED_GREEN: None}
+        self.pattern_count = {LED_RED: 0, LED_GREEN: 0}
+        self.pattern_lock = threading.RLock()
+
 
         # ===== end of LED address definitions ======
 
         # ===== initilize the LED registers =====
+        self.configure()
+
+    # set up the driven LED pins, only the registers that don't already hold the setting are written
+    # so this also puts back a configuration lost to a chip reset
+    def configure(self):
+        led_mask = self.led_mask
+        # no LED is driven, the pins belong to the keypad
+        if led_mask == 0:
+            return
 
         # disable LED pin 14 & 15 as input by setting it to 1 and preserve other B pins (8-14) values
-        msg_data = self.bus.read_byte_data(self.address, self.reg_inputdisable_B)
-        msg_data = msg_data | 0xC0 #0x80
-        self.bus.write_byte_data(self.address, self.reg_inputdisable_B, msg_data )
+        self.regs.update_bits(self.reg_inputdisable_B, or_mask=led_mask) #0xC0
 
 
         # disable pullup on pin 14 & 15 by setting to 0 and preserve the other B pins (8-14) values
-        msg_data = self.bus.read_byte_data(self.address, self.reg_pullup_B)
-        msg_data = msg_data & 0x3F #0x7F
-        self.bus.write_byte_data(self.address, self.reg_pullup_B,  msg_data)
+        self.regs.update_bits(self.reg_pullup_B, and_mask=led_mask ^ 0xFF) #0x3F
         #print hex(self.bus.read_byte_data(self.address, reg_pullup_B))+':  pullup B\n'
 
         # enable open drain on pin 14 & 15 by setting to 1 and preserve the other B pins (8-14) values
-        msg_data = self.bus.read_byte_data(self.address, self.reg_open_drain_B)
-        msg_data = msg_data |0xC0  #0x80
-        self.bus.write_byte_data(self.address, self.reg_open_drain_B,  msg_data)
+        self.regs.update_bits(self.reg_open_drain_B, or_mask=led_mask)  #0xC0
 
         # set direction of pin 14 & 15 to output by setting to 0 and preserve the othe B pins (8-14)
-        msg_data = self.bus.read_byte_data(self.address, self.reg_dir_B)
-        msg_data = msg_data & 0x3F #0x7F
-        self.bus.write_byte_data(self.address, self.reg_dir_B,  msg_data)
+        self.regs.update_bits(self.reg_dir_B, and_mask=led_mask ^ 0xFF) #0x3F
 
 
         # configure LED clock and mode
         # divie system clock by 4 = 2Mz/4 = 250Khz, keep all other pins the same
-        msg_data = self.bus.read_byte_data(self.address, self.reg_misc)
-        msg_data = msg_data | 0x40
-        self.bus.write_byte_data(self.address, self.reg_misc,  msg_data)
+        self.regs.update_bits(self.reg_misc, or_mask=0x40)
 
         # enable LED Driver on the pin 14 & 15 by setting it to 1, keep all other pins the same
-        msg_data = self.bus.read_byte_data(self.address, self.reg_leddriverenable_B)
-        msg_data = msg_data | 0xc0 #0x80
-        self.bus.write_byte_data(self.address, self.reg_leddriverenable_B,  msg_data)
+        self.regs.update_bits(self.reg_leddriverenable_B, or_mask=led_mask) #0xC0
 
         # ===== end of LED initalization =====
 
+    # program the LED driver with the pattern and turn the LED on; a pattern with a duration
+    # is turned off by the scheduler so no thread sleeps while the LED is on
+    def play(self, led, pattern):
+        if led not in self.led_regs:
+            return
+        reg_ton, reg_ion, reg_off, reg_trise, reg_tfall, data_bit = self.led_regs[led]
+        with self.pattern_lock:
+            self.scheduler.cancel(self.pattern_end[led])
+            self.pattern_end[led] = None
+            self.pattern_count[led] = self.pattern_count[led] + 1
+            # LED writes are queued on the bus as one group behind any key data reads
+            with self.regs.lock:
+                # turn pin on
+                msg_data = self.regs.read(self.reg_data_B) & (data_bit ^ 0xFF)
+                self.regs.write_group([(reg_ton, pattern.reg_ton),
+                                       (reg_ion, pattern.reg_ion),
+                                       (reg_off, pattern.reg_off),
+                                       (reg_trise, pattern.reg_trise),
+                                       (reg_tfall, pattern.reg_tfall),
+                                       (self.reg_data_B, msg_data),
+                                      ], posted=True)
+            if pattern.duration is not None:
+                self.pattern_end[led] = self.scheduler.schedule(pattern.duration, self.pattern_done,
+                                                                (led, self.pattern_count[led]), "LED " + str(led) + " pattern end")
+
+    def stop(self, led):
+        if led not in self.led_regs:
+            return
+        data_bit = self.led_regs[led][5]
+        with self.pattern_lock:
+            self.scheduler.cancel(self.pattern_end[led])
+            self.pattern_end[led] = None
+            self.pattern_count[led] = self.pattern_count[led] + 1
+            self.regs.update_bits(self.reg_data_B, or_mask=data_bit, posted=True)
+
+    # scheduler callback at the end of a timed pattern
+    def pattern_done(self, led, pattern_count):
+        with self.pattern_lock:
+            # a newer pattern replaced this one while the callback was pending
+            if pattern_count != self.pattern_count[led]:
+                return
+            self.stop(led)
+
     def green_blink_on(self):
         #LED Control regsters
-        # on time for and intensity of blink
-        msg_data = 0x05
-        self.bus.write_byte_data(self.address, self.reg_ton_15,  msg_data)
-
-        msg_data = 0xFF
-        self.bus.write_byte_data(self.address, self.reg_ion_15,  msg_data)
-
-        # off time and intensity of blink
-        msg_data = 0x40
-        self.bus.write_byte_data(self.address, self.reg_toff_15,  msg_data)
-
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data & 0x7F
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        # on time for and intensity of blink 0x05, off time and intensity of blink 0x40
+        self.play(LED_GREEN, LEDPattern(reg_ton=0x05, reg_ion=0xFF, reg_off=0x40))
 
     def green_steady_on(self):
          # pin mode steady on = 0x00
-        msg_data = 0x00
-        self.bus.write_byte_data(self.address, self.reg_ton_15,  msg_data)
-        # turn pin on
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data &  0x7F
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        self.play(LED_GREEN, LEDPattern.steady())
 
     def green_off(self):
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data |  0x80
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        self.stop(LED_GREEN)
 
     def red_blink_on(self):
         #LED Control regsters
-        # on time for and intensity of blink
-        msg_data = 0x05
-        self.bus.write_byte_data(self.address, self.reg_ton_14,  msg_data)
-
-        msg_data = 0xFF
-        self.bus.write_byte_data(self.address, self.reg_ion_14,  msg_data)
-
-        # off time and intensity of blink
-        msg_data = 0x40
-        self.bus.write_byte_data(self.address, self.reg_toff_14,  msg_data)
-
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data & 0xBF
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        # on time for and intensity of blink 0x05, off time and intensity of blink 0x40
+        self.play(LED_RED, LEDPattern(reg_ton=0x05, reg_ion=0xFF, reg_off=0x40))
 
     def red_steady_on(self):
          # pin mode steady on = 0x00
-        msg_data = 0x00
-        self.bus.write_byte_data(self.address, self.reg_ton_14,  msg_data)
-        # turn pin on
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data &  0xBF
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        self.play(LED_RED, LEDPattern.steady())
 
     def red_off(self):
-        msg_data = self.bus.read_byte_data(self.address, self.reg_data_B)
-        msg_data = msg_data |  0x40
-        self.bus.write_byte_data(self.address, self.reg_data_B,  msg_data)
+        self.stop(LED_RED)
 
 
 # ==========   END define a class to interface with the LED ===========
 
 
+# ========= define a class to cache valid unlock codes in front of PASSCODE_DB =========
+# valid codes are kept in a dict keyed by a keyed hash of the code so the plain codes are never held or
+# compared in memory; entries older than ttl seconds and codes not in the index are checked against the DB.
+# A code revoked in the DB keeps unlocking for up to ttl seconds unless the DB's owner calls notify_changed(),
+# so the default ttl of 0 checks every code against the DB
+class PasscodeCache:
+
+    def __init__(self, DB, ttl=0):
+        self.DB = DB
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # per process key for hashing the codes
+        self.hash_key = os.urandom(16)
+        # code hash -> (check_unlock_code result, time it was read from the DB)
+        self.index = {}
+        self.hits = 0
+        self.misses = 0
+        self.refreshes = 0
+        self.load()
+
+    def code_hash(self, unlock_code):
+        if not isinstance(unlock_code, bytes):
+            unlock_code = unlock_code.encode('utf-8')
+        return hmac.new(self.hash_key, unlock_code, hashlib.sha256).digest()
+
+    # bulk load of the index when the DB can list its codes as (unlock_code, id) pairs
+    def load(self):
+        get_unlock_codes = getattr(self.DB, 'get_unlock_codes', None)
+        if get_unlock_codes is None or self.ttl <= 0:
+            return
+        now = time.time()
+        index = {}
+        for unlock_code, ret in get_unlock_codes():
+            index[self.code_hash(unlock_code)] = (ret, now)
+        with self.lock:
+            self.index = index
+            self.refreshes = self.refreshes + 1
+
+    # same result as PASSCODE_DB.check_unlock_code: >= 0 for a valid code
+    def check_unlock_code(self, unlock_code):
+        key = self.code_hash(unlock_code)
+        now = time.time()
+        entry = self.index.get(key)
+        if entry is not None and now - entry[1] < self.ttl:
+            self.hits = self.hits + 1
+            return entry[0]
+
+        # not in the index or stale, ask the DB
+        ret = self.DB.check_unlock_code(unlock_code)
+        with self.lock:
+            if entry is None:
+                self.misses = self.misses + 1
+            else:
+                self.refreshes = self.refreshes + 1
+            if ret >= 0:
+                self.index[key] = (ret, now)
+            else:
+                self.index.pop(key, None)
+        return ret
+
+    # change signal from the owner of the DB: drop the listed codes, or everything and reload
+    def notify_changed(self, unlock_codes=None):
+        if unlock_codes is None:
+            with self.lock:
+                self.index = {}
+            self.load()
+            return
+        with self.lock:
+            for unlock_code in unlock_codes:
+                self.index.pop(self.code_hash(unlock_code), None)
+
+    def cache_stats(self):
+        with self.lock:
+            return {'hits': self.hits, 'misses': self.misses, 'refreshes': self.refreshes,
+                    'codes': len(self.index)}
+
+# ========= END define a class to cache valid unlock codes in front of PASSCODE_DB =========
+
+
+# ========= define a thread to write audit events and alerts to PASSCODE_DB in batches =========
+AUDIT_KEYPAD_ATTEMPT = 'keypad_attempt'
+AUDIT_REMOTE_UNLOCK = 'remote_unlock'
+AUDIT_ALERT = 'alert'
+
+# what record() does when the event queue is full
+AUDIT_DROP_NEWEST = 'drop_newest'
+AUDIT_DROP_OLDEST = 'drop_oldest'
+AUDIT_BLOCK = 'block'
+
+# running audit writers, flushed on shutdown by signal_handler
+audit_writers = []
+
+class AuditWriter(threading.Thread):
+
+    def __init__(self, db_factory=None, queue_size=256, flush_size=32, flush_interval=2.0,
+                 overflow_policy=AUDIT_DROP_OLDEST, history_size=512):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        # the writer opens its own DB connection on its own thread
+        if db_factory is None:
+            db_factory = default_db
+        self.db_factory = db_factory
+        self.DB = None
+        self.event_queue = Queue.Queue(queue_size)
+        self.flush_size = flush_size
+        self.flush_interval = flush_interval
+        self.overflow_policy = overflow_policy
+        # the events most recently written, for queries
+        self.history = collections.deque(maxlen=history_size)
+        self.history_lock = threading.Lock()
+        self.dropped = 0
+        self.written = 0
+        # events the DB has no way to store, ie. keypad attempts without write_audit_events()
+        self.discarded = 0
+        self.write_errors = 0
+        self.batches = 0
+        self.stopped = threading.Event()
+        audit_writers.append(self)
+
+    # queue an event for the DB, never blocks unless the overflow policy is AUDIT_BLOCK
+    def record(self, event_type, **fields):
+        fields['type'] = event_type
+        fields['time'] = time.time()
+        if self.overflow_policy == AUDIT_BLOCK:
+            self.event_queue.put(fields)
+            return True
+        try:
+            self.event_queue.put_nowait(fields)
+            return True
+        except Queue.Full:
+            pass
+        self.dropped = self.dropped + 1
+        if self.overflow_policy == AUDIT_DROP_OLDEST:
+            try:
+                self.event_queue.get_nowait()
+                self.event_queue.put_nowait(fields)
+                return True
+            except (Queue.Empty, Queue.Full):
+                pass
+        return False
+
+    def run(self):
+        self.DB = self.db_factory()
+        batch = []
+        flush_time = time.time() + self.flush_interval
+        while True:
+            try:
+                event = self.event_queue.get(True, max(flush_time - time.time(), 0.01))
+            except Queue.Empty:
+                event = False
+            # None is queued by close() after the last event
+            if event:
+                batch.append(event)
+            if event is None or len(batch) >= self.flush_size or time.time() >= flush_time:
+                if batch:
+                    self.write_batch(batch)
+                    batch = []
+                flush_time = time.time() + self.flush_interval
+            if event is None:
+                self.stopped.set()
+                return
+
+    # PASSCODE_DB.write_audit_events(events) writes a batch in one transaction; without it only
+    # the alerts can be stored, one ceate_alert() each, and the other events are discarded
+    def write_batch(self, batch):
+        try:
+            write_audit_events = getattr(self.DB, 'write_audit_events', None)
+            if write_audit_events is not None:
+                write_audit_events(batch)
+                self.written = self.written + len(batch)
+            else:
+                discarded = 0
+                for event in batch:
+                    if event['type'] == AUDIT_ALERT:
+                        self.DB.ceate_alert(alert_description=event['alert_description'], alert_type=event['alert_type'])
+                        self.written = self.written + 1
+                    else:
+                        discarded = discarded + 1
+                if discarded:
+                    self.discarded = self.discarded + discarded
+                    log.warning('audit', 'DB has no write_audit_events, events discarded', events=discarded)
+            self.batches = self.batches + 1
+        except Exception as e:
+            self.write_errors = self.write_errors + 1
+            log.error('audit', 'batch write failed', events=len(batch), error=e)
+        with self.history_lock:
+            self.history.extend(batch)
+
+    # recent events, newest last, optionally of one type and/or after a time
+    def events(self, event_type=None, since=None, limit=None):
+        with self.history_lock:
+            events = [event for event in self.history
+                      if (event_type is None or event['type'] == event_type) and (since is None or event['time'] >= since)]
+        if limit is not None:
+            events = events[-limit:]
+        return events
+
+    # write everything that is queued and stop the writer
+    def close(self, timeout=5.0):
+        if self.is_alive():
+            try:
+                self.event_queue.put(None, True, timeout)
+            except Queue.Full:
+                return False
+            self.stopped.wait(timeout)
+        if self in audit_writers:
+            audit_writers.remove(self)
+        return self.stopped.is_set()
+
+# ========= END define a thread to write audit events and alerts to PASSCODE_DB in batches =========
+
+
+# ========= define a class to multiplex the user interface inputs =========
+# keypad codes, remote unlocks and the consumer's ready signal all arrive on one queue so the
+# user interface thread wakes as soon as any of them happens and blocks without polling when idle
+INPUT_KEYPAD_CODE = 'keypad'
+INPUT_REMOTE_UNLOCK = 'remote'
+INPUT_CONSUMER_READY = 'ready'
+
+class InputMultiplexer:
+
+    def __init__(self):
+        self.input_queue = Queue.Queue()
+
+    def post(self, source, data=None):
+        self.input_queue.put((source, data))
+
+    # blocks until the next input, returns (source, data)
+    def get(self):
+        return self.input_queue.get()
+
+    # forward each set of a threading.Event that is owned by another module (ie. remote_unlock_event)
+    def watch_event(self, event, source):
+        watcher = threading.Thread(target=self.run_event_watch, args=(event, source))
+        watcher.daemon = True
+        watcher.start()
+
+    def run_event_watch(self, event, source):
+        while True:
+            event.wait()
+            event.clear()
+            self.post(source)
+
+# ========= END define a class to multiplex the user interface inputs =========
+
+
 # ========= Define thread to start the keypad and check for valid =========
 #           unlock codes entered by the user
+
+# events passed to the user interface's event listeners, as dicts with 'type', 'keypad' and 'time'
+KEYPAD_EVENT_KEY = 'key'            # key, key_time
+KEYPAD_EVENT_CODE = 'code'          # code: a complete unlock code was entered
+KEYPAD_EVENT_VERDICT = 'verdict'    # source, result, accepted: a keypad code or remote unlock was checked
+KEYPAD_EVENT_READY = 'ready'        # the consumer's ready signal was handled, code entry is enabled again
+KEYPAD_EVENT_ALERT = 'alert'        # alert_description, alert_type
+
 class UserInterfaceThread(threading.Thread):
-    def __init__(self):
+    # passcode_cache_ttl: seconds a valid code is taken from the cache, a revoked code keeps unlocking that long
+    # unless whoever changes the codes calls passcodes.notify_changed(); 0 checks every code against the DB
+    # watch_remote_unlocks: take unlocks from remote_interface.remote_unlock_event, by default when remote_commands
+    # starts the RemoteCommandServer; the event can be set by a server run elsewhere in the process
+    def __init__(self, Keypad=None, db_factory=None, remote_commands=True, audit=None, passcode_cache_ttl=0,
+                 watch_remote_unlocks=None):
         threading.Thread.__init__(self)
-        self.DB = PASSCODE_DB()
-        self.Keypad =  I2C_KeyPad(kpad_interrupt_input_pin=7)
+        if db_factory is None:
+            db_factory = default_db
+        self.DB = db_factory()
+        # unlock codes are checked through the cache, call passcodes.notify_changed() when the codes change
+        self.passcodes = PasscodeCache(self.DB, passcode_cache_ttl)
+        # unlock attempts, verdicts and alerts are written to the DB in the background
+        if audit is None:
+            audit = AuditWriter(db_factory)
+            audit.start()
+        self.audit = audit
+        if Keypad is None:
+            Keypad = I2C_KeyPad(kpad_interrupt_input_pin=7)
+        self.Keypad = Keypad
+        # start the RemoteCommandServer when the thread runs
+        self.remote_commands = remote_commands
+        if watch_remote_unlocks is None:
+            watch_remote_unlocks = remote_commands
+        self.watch_remote_unlocks = watch_remote_unlocks
         self.unlock_event = threading.Event()
         self.unlock_enable_timer = None
         self.unlock_reset_time= 90 # 1.5 minute
+        # keypad codes, remote unlocks and consumer ready signals
+        self.inputs = InputMultiplexer()
+        self.Keypad.unlock_code_listener = self.unlock_code_entered
+        # called with each event dict on the thread the event happened on, must not block
+        self.event_listeners = []
+        self.Keypad.key_listener = self.key_pressed
+
+    def add_event_listener(self, listener):
+        self.event_listeners.append(listener)
+
+    def remove_event_listener(self, listener):
+        if listener in self.event_listeners:
+            self.event_listeners.remove(listener)
+
+    def notify(self, event_type, **fields):
+        fields['type'] = event_type
+        fields['keypad'] = self.Keypad.keypad_id
+        fields['time'] = time.time()
+        for listener in list(self.event_listeners):
+            try:
+                listener(fields)
+            except Exception as e:
+                log.error('user_interface', 'event listener failed', keypad=self.Keypad.keypad_id, event=event_type, error=e)
+
+    def key_pressed(self, key, timestamp):
+        if self.event_listeners:
+            self.notify(KEYPAD_EVENT_KEY, key=key, key_time=timestamp)
+
+    def unlock_code_entered(self, unlock_code):
+        if self.event_listeners:
+            self.notify(KEYPAD_EVENT_CODE, code=unlock_code)
+        self.inputs.post(INPUT_KEYPAD_CODE, unlock_code)
 
     def run(self):
-        global RemoteCommandServer
-        RemoteCommandServer.start()
-
-        while True:
-            # wait for an unlock code to be entered by the user via the keypad, timeout after 15 seconds
-            self.Keypad.unlock_code_read_event.wait(.5)
-            remote_unlock_event.wait(.5)
+        if self.remote_commands == True:
+            start_remote_command_server()
+        if self.watch_remote_unlocks == True:
+            from remote_interface import remote_unlock_event
+            self.inputs.watch_event(remote_unlock_event, INPUT_REMOTE_UNLOCK)
 
-            if self.Keypad.unlock_code_read_event.is_set()==True or remote_unlock_event.is_set()==True:
-                # a code was entered so process it
+        # True while the consumer is handling an unlock, inputs that arrive meanwhile are deferred until it's ready
+        awaiting_ready = False
+        deferred_inputs = collections.deque()
+        LED_on = True
 
-                # disable further detection of key presses during unlock code processing
+        while True:
+            # wait for an unlock code to be entered by the user via the keypad or remotely, or for the consumer
+            if awaiting_ready == False and deferred_inputs:
+                source, data = deferred_inputs.popleft()
+            else:
+                source, data = self.inputs.get()
+
+            if source == INPUT_CONSUMER_READY:
+                if awaiting_ready == True:
+                    awaiting_ready = False
+                    # fnished processing the current unlock code that the user entered
+                    # now enable reading of the next unlock code from the user
+                    self.Keypad.enable_unlock_code_reading(LED_on)
+                if self.event_listeners:
+                    self.notify(KEYPAD_EVENT_READY)
+                continue
+
+            if awaiting_ready == True:
+                deferred_inputs.append((source, data))
+                continue
+
+            # a code was entered so process it
+
+            # disable further detection of key presses during unlock code processing, unless the keys are
+            # typed ahead for the next attempt
+            if self.Keypad.type_ahead == False:
                 self.Keypad.enable_keypad_scanning(False)
 
-                # if user entered  an unlock code via the keypad
-                if self.Keypad.unlock_code_read_event.is_set()==True:
-                    # see if the unlock code the user entered is valid
-                    ret=self.DB.check_unlock_code(self.Keypad.unlock_code)
-                # if the user entered an unlock remotely via the app just unlock
-                elif remote_unlock_event.is_set()==True:
-                    remote_unlock_event.clear()
-                    ret = 1
-
-                if ret >= 0:
-                        # a valid unlock code was entered via the keyboard
-                        print 'UserInterfaceThread:code found: '+ str(ret)
-                        # signal any threads that are waiting for the unlock
-                        self.unlock_event.set()
-                        # signal the user that the entered code was valid
-                        self.Keypad.LED.green_steady_on()
-                        time.sleep(2)
-                        # for unlock processing - disable signaling the user the current code is reset
-                        self.Keypad.display_unlock_code_reset=False
-                        LED_on = False
-
-                        # only allow so much time for a successful unlock to take place
-                        # before allowing the user to enter a new code
-                        self.unlock_enable_timer = threading.Timer(self.unlock_reset_time,self.read_next_unlock_code)
-                        self.unlock_enable_timer.start()
-                else:
-                        # an invalid unlock code was entered
-                        print 'UserInterfaceThread:code NOT found: '+ str(ret)
-                        # for invlaid code processing , enable signaling the user when the code is reset
-                        self.Keypad.display_unlock_code_reset=True
-                        LED_on = True
-
-                # wait until the unlock event is cleared to start the next unlock code read cycle
-                # this allows the user interface consumer to control when it's ready for the next unlock code cycle
-                while self.unlock_event.is_set()==True:
-                    time.sleep(.5)
-                # fnished processing the current unlock code that the user entered
-                # now enable reading of the next unlock code from the user
-                self.Keypad.enable_unlock_code_reading(LED_on)
+            # if user entered  an unlock code via the keypad
+            if source == INPUT_KEYPAD_CODE:
+                # see if the unlock code the user entered is valid
+                timed = metrics.enabled
+                if timed:
+                    start_time = time.time()
+                ret=self.passcodes.check_unlock_code(data)
+                if timed:
+                    metrics.observe(keypad_metrics.STAGE_CHECK_UNLOCK_CODE, time.time() - start_time)
+            # if the user entered an unlock remotely via the app just unlock
+            else:
+                ret = 1
+
+            # the audit trail records the code length, never the code
+            if source == INPUT_KEYPAD_CODE:
+                self.audit.record(AUDIT_KEYPAD_ATTEMPT, keypad=self.Keypad.keypad_id, code_length=len(data),
+                                  result=ret, accepted=(ret >= 0))
+            else:
+                self.audit.record(AUDIT_REMOTE_UNLOCK, keypad=self.Keypad.keypad_id, result=ret, accepted=(ret >= 0))
+            if self.event_listeners:
+                self.notify(KEYPAD_EVENT_VERDICT, source=source, result=ret, accepted=(ret >= 0))
+
+            if ret >= 0:
+                    metrics.count(keypad_metrics.COUNT_CODES_ACCEPTED)
+                    # a valid unlock code was entered via the keyboard
+                    log.info('check_unlock_code', 'code accepted', keypad=self.Keypad.keypad_id, source=source, result=ret)
+                    # signal any threads that are waiting for the unlock
+                    self.unlock_event.set()
+                    # signal the user that the entered code was valid, the green LED stays on
+                    # until the consumer is ready for the next unlock code
+                    self.Keypad.LED.green_steady_on()
+                    # for unlock processing - disable signaling the user the current code is reset
+                    self.Keypad.display_unlock_code_reset=False
+                    LED_on = False
+                    if self.Keypad.type_ahead == True:
+                        # nothing is typed ahead past an unlock, the keys are dropped when the consumer is ready
+                        self.Keypad.enable_keypad_scanning(False)
+
+                    # only allow so much time for a successful unlock to take place
+                    # before allowing the user to enter a new code
+                    self.unlock_enable_timer = self.Keypad.scheduler.schedule(self.unlock_reset_time, self.read_next_unlock_code,
+                                                                              name="unlock re-enable timeout")
+
+                    # wait until the consumer signals it's ready to start the next unlock code read cycle
+                    # this allows the user interface consumer to control when it's ready for the next unlock code cycle
+                    awaiting_ready = True
+            else:
+                    metrics.count(keypad_metrics.COUNT_CODES_REJECTED)
+                    # an invalid unlock code was entered
+                    log.info('check_unlock_code', 'code rejected', keypad=self.Keypad.keypad_id, source=source, result=ret)
+                    # for invlaid code processing , enable signaling the user when the code is reset
+                    self.Keypad.display_unlock_code_reset=True
+                    LED_on = True
+                    # now enable reading of the next unlock code from the user, starting with the keys typed ahead
+                    self.Keypad.enable_unlock_code_reading(LED_on, keep_type_ahead=True)
 
     # function to enable the reading of the next unlock code cycle
     # it is either called explicity by the user interface consumer to enable the next cycle
     # or by the unlock_enable_timer callback of the user interface to automtically enable the next cycle
     def read_next_unlock_code(self):
-        try:
-            if self.unlock_enable_timer != None:
-                self.unlock_enable_timer.cancel()
-        except:
-            pass
+        self.Keypad.scheduler.cancel(self.unlock_enable_timer)
+        self.unlock_enable_timer = None
         self.unlock_event.clear()
         self.Keypad.LED.green_off()
         self.Keypad.LED.red_off()
+        self.inputs.post(INPUT_CONSUMER_READY)
 
     def show_left_unlocked_warning(self):
         self.Keypad.LED.red_blink_on()
-        self.DB.ceate_alert(alert_description="Device",alert_type="unlocked")
+        self.audit.record(AUDIT_ALERT, keypad=self.Keypad.keypad_id, alert_description="Device", alert_type="unlocked")
+        if self.event_listeners:
+            self.notify(KEYPAD_EVENT_ALERT, alert_description="Device", alert_type="unlocked")
+
+
+# ========= define a class to run several keypads from one process =========
+# each door is a dict of I2C_KeyPad arguments, ie.
+#   {'keypad_id': 'front', 'channel': 1, 'address': 0x3E, 'kpad_interrupt_input_pin': 7}
+# keypads on the same channel share one bus handle; all keypads share one dispatcher with a pool of
+# workers, one deadline scheduler and one audit writer; only the first door takes remote unlocks
+class KeypadController:
+
+    def __init__(self, doors, workers=2, gpio=None, bus_factory=None, db_factory=None):
+        if bus_factory is None:
+            bus_factory = default_bus
+        self.bus_factory = bus_factory
+        self.buses = {}
+        self.scheduler = DeadlineScheduler()
+        self.dispatcher = KeypadDispatcher(queue_size=32 * len(doors), workers=min(workers, len(doors)))
+        self.audit = AuditWriter(db_factory)
+        self.audit.start()
+        self.keypads = collections.OrderedDict()
+        self.interfaces = collections.OrderedDict()
+
+        for door_num, door in enumerate(doors):
+            door = dict(door)
+            channel = door.pop('channel', 1)
+            keypad_id = door.pop('keypad_id', door_num)
+            if keypad_id in self.keypads:
+                raise ValueError("duplicate keypad id: " + str(keypad_id))
+            keypad = I2C_KeyPad(bus=self.bus(channel), gpio=gpio, channel=channel, keypad_id=keypad_id,
+                                dispatcher=self.dispatcher, scheduler=self.scheduler, **door)
+            self.keypads[keypad_id] = keypad
+            self.interfaces[keypad_id] = UserInterfaceThread(Keypad=keypad, db_factory=db_factory,
+                                                             remote_commands=(door_num == 0), audit=self.audit)
+
+    # one bus handle per I2C channel
+    def bus(self, channel):
+        if channel not in self.buses:
+            self.buses[channel] = SharedBus(self.bus_factory(channel))
+        return self.buses[channel]
+
+    def start(self):
+        for interface in self.interfaces.values():
+            interface.daemon = True
+            interface.start()
+
+    def interface(self, keypad_id):
+        return self.interfaces[keypad_id]
+
+    def stats(self):
+        return {'keypads': len(self.keypads),
+                'buses': dict((channel, bus.stats()) for channel, bus in self.buses.items()),
+                'workers': len(self.dispatcher.workers), 'pending_key_presses': self.dispatcher.pending(),
+                'dispatcher_overflows': self.dispatcher.overflow_count, 'threads': threading.active_count()}
+
+# ========= END define a class to run several keypads from one process =========
 
 
 def signal_handler(signal, frame):
-    print 'You pressed Ctrl+C!'
+    print('You pressed Ctrl+C!')
+    # don't lose the queued audit events
+    for writer in list(audit_writers):
+        writer.close()
+    log.flush()
     # for p in jobs:
     #     p.terminate()
     sys.exit(0)
@@ -550,19 +2301,53 @@ def main():
 
      # catch a CtrlC exit
     signal.signal(signal.SIGINT, signal_handler)
-    UserInterfaceThreadInstance = UserInterfaceThread()
+    keypad_args = {'kpad_interrupt_input_pin': 7}
+    # KEYPAD_TRACE_FILE=/path/keypad.trace records the key presses and I2C transactions, see keypad_trace
+    trace_path = os.environ.get('KEYPAD_TRACE_FILE')
+    if trace_path:
+        import keypad_trace
+        keypad_args['trace'] = keypad_trace.KeypadTraceRecorder(trace_path)
+    # KEYPAD_WARM_START=1 keeps the SX1509 configuration of the previous run and skips the LED self test
+    if os.environ.get('KEYPAD_WARM_START') == '1':
+        keypad_args['warm_start'] = True
+        keypad_args['self_test'] = False
+    # KEYPAD_TYPE_AHEAD=1 keeps the keys typed while a code is checked for the next attempt
+    if os.environ.get('KEYPAD_TYPE_AHEAD') == '1':
+        keypad_args['type_ahead'] = True
+    # KEYPAD_SCAN_PROFILE=low_latency|balanced|low_power trades key press latency against power
+    profile = os.environ.get('KEYPAD_SCAN_PROFILE')
+    if profile:
+        keypad_args['scan_profile'] = profile
+    UserInterfaceThreadInstance = UserInterfaceThread(Keypad=I2C_KeyPad(**keypad_args))
+    # KEYPAD_EVENT_SOCKET=/path/events.sock pushes the unlock events to other processes, see keypad_event_server
+    event_socket = os.environ.get('KEYPAD_EVENT_SOCKET')
+    if event_socket:
+        import keypad_event_server
+        event_server = keypad_event_server.UnlockEventServer(event_socket)
+        event_server.attach(UserInterfaceThreadInstance)
+        event_server.start()
     UserInterfaceThreadInstance.start()
 
+    # KEYPAD_METRICS_FILE=/path/keypad.prom turns on the latency metrics and dumps them every minute
+    metrics_path = os.environ.get('KEYPAD_METRICS_FILE')
+    if metrics_path:
+        metrics.enable()
+        metrics.start_dump(metrics_path, 60, UserInterfaceThreadInstance.Keypad.scheduler)
+    # KEYPAD_LOG_LEVEL=10 logs every key press event (never the key), log.set_level() changes it at runtime
+    log_level = os.environ.get('KEYPAD_LOG_LEVEL')
+    if log_level:
+        log.set_level(int(log_level))
+
     while True:
         UserInterfaceThreadInstance.unlock_event.wait(15)
         if UserInterfaceThreadInstance.unlock_event.is_set()==True:
-            print '>>>>>>>>> main:USER UNLOCKED DEVICE <<<<<<<<<<<'
-            print ' >>>>>>>> main: emulating consumer busy <<<<<<<<<<<<<'
+            print('>>>>>>>>> main:USER UNLOCKED DEVICE <<<<<<<<<<<')
+            print(' >>>>>>>> main: emulating consumer busy <<<<<<<<<<<<<')
             time.sleep(5)
-            print ' >>>>>>>> main: resuming next unlock cycle <<<<<<<<<<<<<'
+            print(' >>>>>>>> main: resuming next unlock cycle <<<<<<<<<<<<<')
             UserInterfaceThreadInstance.read_next_unlock_code() #unlock_event.clear()
         else:
-            print '>>>>>>>>> main:TIMEOUT WAITING FOR USER UNLOCK <<<<<<<<<<<'
+            print('>>>>>>>>> main:TIMEOUT WAITING FOR USER UNLOCK <<<<<<<<<<<')
 
 
 
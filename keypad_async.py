@@ -0,0 +1,231 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_async
+# Purpose:     asyncio interface to the keypad user interface events
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Streams the key, code, verdict and ready events of any number of UserInterfaceThreads into one
+# event loop. The events are handed over from the GPIO callback, dispatcher and user interface
+# threads with loop.call_soon_threadsafe, so the loop needs no thread of its own per keypad.
+#
+# asyncio is used where available, trollius on Python 2. Every call returns a future so it works
+# from trollius coroutines:
+#
+#   events = AsyncKeypadEvents(loop)
+#   events.attach(ui)
+#   stream = events.stream(KEYPAD_EVENT_VERDICT)
+#   while True:
+#       verdict = yield From(stream.get())
+#       if verdict['accepted']:
+#           ...unlock...
+#           yield From(events.ready(verdict['keypad']))
+#
+# and the streams are async iterators for asyncio coroutines: async for event in events.stream(): ...
+
+try:
+    import asyncio
+except ImportError:
+    import trollius as asyncio
+
+import collections
+
+from SX150_keypad_I2C_interface import KEYPAD_EVENT_KEY, KEYPAD_EVENT_CODE, KEYPAD_EVENT_VERDICT, KEYPAD_EVENT_READY
+from keypad_log import log
+
+try:
+    StopAsyncIteration = StopAsyncIteration
+except NameError:
+    class StopAsyncIteration(Exception):
+        pass
+
+
+# ========= define a class to queue the events of one consumer =========
+class KeypadEventStream:
+
+    # types: the event types to pass, None for all; keypad: the keypad id to pass, None for all
+    def __init__(self, events, types=None, keypad=None, queue_size=64):
+        self.events = events
+        self.loop = events.loop
+        self.types = types
+        self.keypad = keypad
+        # the oldest events are dropped when the consumer falls behind
+        self.queue = collections.deque(maxlen=queue_size)
+        self.dropped = 0
+        self.waiter = None
+        self.closed = False
+
+    def wants(self, event):
+        return (self.types is None or event['type'] in self.types) and \
+               (self.keypad is None or event['keypad'] == self.keypad)
+
+    # runs on the loop
+    def put(self, event):
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(event)
+            self.waiter = None
+            return
+        if len(self.queue) == self.queue.maxlen:
+            self.dropped = self.dropped + 1
+        self.queue.append(event)
+
+    # future of the next event, None once the stream is closed
+    def get(self):
+        future = asyncio.Future(loop=self.loop)
+        if self.queue:
+            future.set_result(self.queue.popleft())
+        elif self.closed:
+            future.set_result(None)
+        else:
+            if self.waiter is not None and not self.waiter.done():
+                raise RuntimeError("KeypadEventStream.get() is already waiting for an event")
+            self.waiter = future
+        return future
+
+    def close(self):
+        self.closed = True
+        self.events.streams.discard(self)
+        if self.waiter is not None and not self.waiter.done():
+            self.waiter.set_result(None)
+        self.waiter = None
+
+    def __aiter__(self):
+        return self
+
+    def __anext__(self):
+        future = asyncio.Future(loop=self.loop)
+        event_future = self.get()
+        def next_event(event_future):
+            if event_future.cancelled():
+                future.cancel()
+            elif future.done():
+                # the consumer gave up after the event arrived, keep it for the next call
+                if event_future.result() is not None:
+                    self.queue.appendleft(event_future.result())
+            elif event_future.result() is None:
+                future.set_exception(StopAsyncIteration())
+            else:
+                future.set_result(event_future.result())
+        def stop_waiting(future):
+            # cancelled by e.g. wait_for(), release the waiter so put() queues the next event
+            if future.cancelled():
+                if self.waiter is event_future:
+                    self.waiter = None
+                event_future.cancel()
+        event_future.add_done_callback(next_event)
+        future.add_done_callback(stop_waiting)
+        return future
+
+# ========= END define a class to queue the events of one consumer =========
+
+
+# ========= define a class to bridge the user interface events into an event loop =========
+class AsyncKeypadEvents:
+
+    def __init__(self, loop=None):
+        if loop is None:
+            loop = asyncio.get_event_loop()
+        self.loop = loop
+        # keypad id -> UserInterfaceThread
+        self.interfaces = collections.OrderedDict()
+        self.streams = set()
+        # futures of wait_unlock() and ready() calls as (future, keypad id or None)
+        self.unlock_waiters = []
+        self.ready_waiters = []
+        self.events = 0
+
+    def attach(self, ui):
+        self.interfaces[ui.Keypad.keypad_id] = ui
+        ui.add_event_listener(self.event_listener)
+
+    def detach(self, ui):
+        ui.remove_event_listener(self.event_listener)
+        self.interfaces.pop(ui.Keypad.keypad_id, None)
+
+    # called on the GPIO callback, dispatcher or user interface thread, only hands the event to the loop
+    def event_listener(self, event):
+        try:
+            self.loop.call_soon_threadsafe(self.dispatch, event)
+        except RuntimeError:
+            # the loop is closed
+            log.warning('async', 'event loop closed, event dropped', keypad=event['keypad'], event=event['type'])
+
+    # runs on the loop
+    def dispatch(self, event):
+        self.events = self.events + 1
+        for stream in list(self.streams):
+            if stream.wants(event):
+                stream.put(event)
+        if event['type'] == KEYPAD_EVENT_VERDICT and event['accepted']:
+            self.unlock_waiters = self.wake(self.unlock_waiters, event)
+        elif event['type'] == KEYPAD_EVENT_READY:
+            self.ready_waiters = self.wake(self.ready_waiters, event)
+
+    @staticmethod
+    def wake(waiters, event):
+        waiting = []
+        for future, keypad in waiters:
+            if future.done():
+                continue
+            if keypad is None or keypad == event['keypad']:
+                future.set_result(event)
+            else:
+                waiting.append((future, keypad))
+        return waiting
+
+    # a stream of the given event types, ie. stream(KEYPAD_EVENT_KEY) or stream(keypad='front')
+    def stream(self, *types, **filters):
+        stream = KeypadEventStream(self, types or None, filters.get('keypad'), filters.get('queue_size', 64))
+        self.streams.add(stream)
+        return stream
+
+    def keys(self, keypad=None):
+        return self.stream(KEYPAD_EVENT_KEY, keypad=keypad)
+
+    def codes(self, keypad=None):
+        return self.stream(KEYPAD_EVENT_CODE, keypad=keypad)
+
+    def verdicts(self, keypad=None):
+        return self.stream(KEYPAD_EVENT_VERDICT, keypad=keypad)
+
+    # future of the next accepted verdict, a keypad code or a remote unlock
+    def wait_unlock(self, keypad=None):
+        future = asyncio.Future(loop=self.loop)
+        self.unlock_waiters.append((future, keypad))
+        return future
+
+    # the consumer is done with the unlock: code entry is enabled again, the future is done once the
+    # user interface has handled it
+    def ready(self, keypad=None):
+        if keypad is None:
+            keypad = next(iter(self.interfaces))
+        future = asyncio.Future(loop=self.loop)
+        self.ready_waiters.append((future, keypad))
+        self.interfaces[keypad].read_next_unlock_code()
+        return future
+
+    def close(self):
+        for ui in list(self.interfaces.values()):
+            self.detach(ui)
+        for stream in list(self.streams):
+            stream.close()
+        for future, keypad in self.unlock_waiters + self.ready_waiters:
+            if not future.done():
+                future.cancel()
+        self.unlock_waiters = []
+        self.ready_waiters = []
+
+# ========= END define a class to bridge the user interface events into an event loop =========
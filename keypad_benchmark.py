@@ -0,0 +1,389 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_benchmark
+# Purpose:     Latency and I2C bus cost benchmark of the keypad pipeline
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Drives I2C_KeyPad and UserInterfaceThread against the simulated SX1509 bus and a
+# stand-in passcode DB and reports, per scenario:
+#   latency p50/p99 (ms) of each stage of a key press:
+#     interrupt -> read_key_press -> key_sequence_add -> code complete -> check_unlock_code -> unlock signal
+#   I2C transactions and bytes per key press, thread count and CPU time
+#   the scan_<profile> scenarios add the simulated scan and debounce delay of each scan profile to
+#   interrupt_to_read, to compare with the profile's scan_latency_worst_ms
+#
+#   python keypad_benchmark.py --output results.json [--baseline previous.json]
+#
+# results are JSON so runs can be compared over time; --baseline prints the change of every metric
+
+import os
+import time
+import json
+import argparse
+import platform
+import threading
+import collections
+
+import SX150_keypad_I2C_interface as keypad_interface
+import keypad_log
+from sx1509_sim import SimulatedGPIO, SimulatedSMBus, SimulatedSX1509
+
+VALID_CODE = '1234'
+INVALID_CODE = '9999'
+
+
+# ========= define a stand-in for PASSCODE_DB =========
+class BenchPasscodeDB:
+
+    def __init__(self, codes=(VALID_CODE,), check_time=0.0):
+        self.codes = dict((code, index) for index, code in enumerate(codes))
+        self.check_time = check_time
+        self.checks = 0
+        self.alerts = 0
+        self.audit_events = 0
+
+    def check_unlock_code(self, unlock_code):
+        self.checks = self.checks + 1
+        if self.check_time > 0:
+            time.sleep(self.check_time)
+        return self.codes.get(unlock_code, -1)
+
+    def ceate_alert(self, alert_description=None, alert_type=None):
+        self.alerts = self.alerts + 1
+
+    def write_audit_events(self, events):
+        self.audit_events = self.audit_events + len(events)
+
+# ========= END define a stand-in for PASSCODE_DB =========
+
+
+# nearest rank percentile of a list of seconds, in ms
+def percentile_ms(samples, percent):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    rank = int(round(percent / 100.0 * len(ordered) + 0.5)) - 1
+    return ordered[min(max(rank, 0), len(ordered) - 1)] * 1000.0
+
+
+# ========= define a class that builds and measures one keypad pipeline =========
+class KeypadBenchRig:
+
+    stages = ('interrupt_to_read', 'read_to_sequence', 'key_to_code', 'code_to_verdict', 'code_to_unlock',
+              'remote_to_unlock')
+
+    def __init__(self, check_time=0.0):
+        self.gpio = SimulatedGPIO()
+        self.bus = SimulatedSMBus()
+        self.chip = self.bus.add_device(SimulatedSX1509(0x3E))
+        self.chip.connect_interrupt(self.gpio, 7)
+        self.DB = BenchPasscodeDB(check_time=check_time)
+        self.Keypad = keypad_interface.I2C_KeyPad(bus=self.bus, gpio=self.gpio)
+        self.ui = keypad_interface.UserInterfaceThread(Keypad=self.Keypad, db_factory=lambda: self.DB,
+                                                       remote_commands=False)
+        self.ui.daemon = True
+        self.samples = dict((stage, []) for stage in self.stages)
+        self.press_times = []
+        # times of the presses that raised an interrupt and are not yet read, oldest first
+        self.pending_presses = collections.deque()
+        self.press_time = None
+        self.code_time = None
+        self.unlock_time = None
+        self.verdicts = []
+        self.scanning = threading.Event()
+        self.scanning.set()
+        self.instrument()
+        self.ui.start()
+
+    # wrap the pipeline stages of this instance to timestamp them
+    def instrument(self):
+        keypad = self.Keypad
+        samples = self.samples
+
+        process_key_data = keypad.process_key_data
+        def timed_process_key_data(timestamp, key_data):
+            if self.pending_presses:
+                self.press_time = self.pending_presses.popleft()
+                samples['interrupt_to_read'].append(timestamp - self.press_time)
+            self.read_time = timestamp
+            process_key_data(timestamp, key_data)
+        keypad.process_key_data = timed_process_key_data
+
+        key_sequence_add = keypad.key_sequence_add
+        def timed_key_sequence_add(new_key):
+            samples['read_to_sequence'].append(time.time() - self.read_time)
+            key_sequence_add(new_key)
+        keypad.key_sequence_add = timed_key_sequence_add
+
+        unlock_code_listener = keypad.unlock_code_listener
+        def timed_unlock_code_listener(unlock_code):
+            self.code_time = time.time()
+            if self.press_time is not None:
+                samples['key_to_code'].append(self.code_time - self.press_time)
+            unlock_code_listener(unlock_code)
+        keypad.unlock_code_listener = timed_unlock_code_listener
+
+        check_unlock_code = self.ui.passcodes.check_unlock_code
+        def timed_check_unlock_code(unlock_code):
+            ret = check_unlock_code(unlock_code)
+            samples['code_to_verdict'].append(time.time() - self.code_time)
+            self.verdicts.append(ret)
+            return ret
+        self.ui.passcodes.check_unlock_code = timed_check_unlock_code
+
+        # the unlock is timed when it is signalled, not when the scenario gets around to consuming it
+        unlock_event = self.ui.unlock_event
+        unlock_event_set = unlock_event.set
+        def timed_unlock_event_set():
+            self.unlock_time = time.time()
+            unlock_event_set()
+        unlock_event.set = timed_unlock_event_set
+
+        enable_keypad_scanning = keypad.enable_keypad_scanning
+        def tracked_enable_keypad_scanning(EnableFlag):
+            enable_keypad_scanning(EnableFlag)
+            if EnableFlag == True:
+                self.scanning.set()
+            else:
+                self.scanning.clear()
+        keypad.enable_keypad_scanning = tracked_enable_keypad_scanning
+
+    def press(self, key):
+        key_presses = self.chip.key_presses
+        press_time = time.time()
+        # the interrupt callback runs before type_keys returns so the press is queued first
+        self.pending_presses.append(press_time)
+        self.chip.type_keys(key, self.Keypad.key_map)
+        if self.chip.key_presses == key_presses:
+            # scanning was off, no interrupt
+            self.pending_presses.remove(press_time)
+            return
+        self.press_times.append(press_time)
+
+    def type_code(self, code, interval):
+        self.scanning.wait(5)
+        for key in code:
+            self.press(key)
+            if interval > 0:
+                time.sleep(interval)
+
+    # consumer side: wait for the unlock signal and ask for the next code
+    def consume_unlock(self, start_time, stage, timeout=5):
+        if not self.ui.unlock_event.wait(timeout):
+            return False
+        self.samples[stage].append(self.unlock_time - start_time)
+        self.ui.read_next_unlock_code()
+        return True
+
+    def wait_idle(self, timeout=5):
+        deadline = time.time() + timeout
+        while time.time() < deadline:
+            if self.Keypad.dispatcher.pending() == 0 and self.scanning.is_set():
+                return True
+            time.sleep(0.001)
+        return False
+
+    def reset_samples(self):
+        for stage in self.stages:
+            self.samples[stage] = []
+        self.press_times = []
+        self.pending_presses.clear()
+        self.verdicts = []
+        # keys left over from the last scenario, ie. a typist stopped mid code, would prefix the next code
+        self.Keypad.unlock_code_reset(False)
+        # the keypad and dispatcher counters run for the life of the rig, report them per scenario
+        self.Keypad.callback_time_max = 0.0
+        self.overflow_start = self.Keypad.dispatcher.overflow_count
+        self.deferred_reads_start = self.Keypad.deferred_reads
+
+    def measure(self, scenario, function):
+        self.wait_idle()
+        self.reset_samples()
+        self.bus.reset_stats()
+        cpu_start = sum(os.times()[:2])
+        wall_start = time.time()
+        function(self)
+        self.wait_idle()
+        wall_time = time.time() - wall_start
+        cpu_time = sum(os.times()[:2]) - cpu_start
+        bus_stats = self.bus.stats()
+        key_presses = len(self.press_times)
+        result = {'scenario': scenario,
+                  'wall_time_s': wall_time,
+                  'cpu_time_s': cpu_time,
+                  'cpu_percent': 100.0 * cpu_time / wall_time if wall_time > 0 else 0.0,
+                  'thread_count': threading.active_count(),
+                  'key_presses': key_presses,
+                  'i2c_transactions': bus_stats['transactions'],
+                  'i2c_bytes': bus_stats['bytes'],
+                  'transactions_per_keypress': float(bus_stats['transactions']) / key_presses if key_presses else None,
+                  'bytes_per_keypress': float(bus_stats['bytes']) / key_presses if key_presses else None,
+                  'dispatcher_overflows': self.Keypad.dispatcher.overflow_count - self.overflow_start,
+                  'deferred_reads': self.Keypad.deferred_reads - self.deferred_reads_start,
+                  'callback_time_max_ms': self.Keypad.callback_time_max * 1000.0,
+                  'scan_profile': self.Keypad.scan_profile.name,
+                  'scan_latency_worst_ms': self.Keypad.scan_latency() * 1000.0,
+                  'latency_ms': {},
+                 }
+        for stage in self.stages:
+            if self.samples[stage]:
+                result['latency_ms'][stage] = {'count': len(self.samples[stage]),
+                                               'p50': percentile_ms(self.samples[stage], 50),
+                                               'p99': percentile_ms(self.samples[stage], 99),
+                                               'max': max(self.samples[stage]) * 1000.0}
+        return result
+
+# ========= END define a class that builds and measures one keypad pipeline =========
+
+
+# ===== scenarios =====
+
+# valid codes typed at speed, each one unlocks and the consumer is immediately ready
+def typing_burst(rig, codes=50, interval=0.005):
+    for _ in range(codes):
+        rig.type_code(VALID_CODE, interval)
+        rig.consume_unlock(rig.press_times[-1], 'code_to_unlock')
+
+# invalid codes back to back, each is rejected and scanning re-enabled
+def invalid_code_storm(rig, codes=100, interval=0.0):
+    for _ in range(codes):
+        rig.type_code(INVALID_CODE, interval)
+        rig.wait_idle()
+
+# remote unlocks from several threads while a user types invalid codes; the unlocks are posted to the user
+# interface's inputs the way its remote_unlock_event watcher does, so remote_interface is not needed
+def concurrent_remote_unlocks(rig, unlocks=20, typists=1, interval=0.05):
+    stop = threading.Event()
+    def typist():
+        while not stop.is_set():
+            rig.type_code(INVALID_CODE, 0.002)
+    threads = [threading.Thread(target=typist) for _ in range(typists)]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for _ in range(unlocks):
+        start_time = time.time()
+        rig.ui.inputs.post(keypad_interface.INPUT_REMOTE_UNLOCK)
+        rig.consume_unlock(start_time, 'remote_to_unlock')
+        time.sleep(interval)
+    stop.set()
+    for thread in threads:
+        thread.join(5)
+
+# no input at all, measures the CPU used and threads held while waiting
+def idle(rig, duration=2.0):
+    time.sleep(duration)
+
+# a mistyped code immediately retyped, with type ahead the retyped keys are taken while the mistyped code is
+# checked instead of being lost, compare code_to_unlock with --db-check-time
+def type_ahead_retype(rig, codes=20, interval=0.005):
+    rig.Keypad.type_ahead = True
+    try:
+        for _ in range(codes):
+            rig.type_code(INVALID_CODE + VALID_CODE, interval)
+            if not rig.consume_unlock(rig.press_times[-1], 'code_to_unlock'):
+                raise RuntimeError("type_ahead_retype: the retyped code did not unlock")
+    finally:
+        rig.Keypad.type_ahead = False
+
+# invalid codes typed slowly enough for auto sleep, with the simulated scan and debounce delay of a
+# scan profile; interrupt_to_read then measures from the press and stays under scan_latency_worst_ms
+def scan_profile_scenario(profile, codes=5, interval=0.2):
+    def scan_profile_latency(rig):
+        rig.Keypad.set_scan_profile(profile)
+        rig.chip.scan_timing = True
+        try:
+            for _ in range(codes):
+                rig.type_code(INVALID_CODE, interval)
+                rig.wait_idle()
+        finally:
+            rig.chip.scan_timing = False
+    return scan_profile_latency
+
+SCENARIOS = [('typing_burst', typing_burst),
+             ('invalid_code_storm', invalid_code_storm),
+             ('concurrent_remote_unlocks', concurrent_remote_unlocks),
+             ('idle', idle),
+             ('type_ahead_retype', type_ahead_retype),
+            ] + [('scan_' + name, scan_profile_scenario(name)) for name in keypad_interface.SCAN_PROFILES]
+
+
+def run_benchmarks(names=None, check_time=0.0):
+    # the per key press log events would share stdout with the JSON results
+    keypad_log.log.set_level(keypad_log.LOG_WARNING)
+    rig = KeypadBenchRig(check_time=check_time)
+    # let the LED self test finish so it does not count against the first scenario
+    rig.wait_idle()
+    results = []
+    for name, function in SCENARIOS:
+        if names and name not in names:
+            continue
+        results.append(rig.measure(name, function))
+        rig.Keypad.set_scan_profile(keypad_interface.SCAN_PROFILE_BALANCED)
+    rig.ui.audit.close()
+    return {'time': time.time(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'db_check_time_s': check_time,
+            'results': results}
+
+
+# flatten a run into {scenario.metric: value} for comparisons
+def flatten(run):
+    values = {}
+    for result in run['results']:
+        for key, value in result.items():
+            if isinstance(value, (int, float)) and not isinstance(value, bool):
+                values[result['scenario'] + '.' + key] = value
+        for stage, latency in result['latency_ms'].items():
+            for key, value in latency.items():
+                values[result['scenario'] + '.' + stage + '.' + key] = value
+    return values
+
+
+def compare(baseline, run):
+    old = flatten(baseline)
+    new = flatten(run)
+    lines = []
+    for key in sorted(new):
+        if key in old and old[key]:
+            lines.append('%-60s %12.3f %12.3f %+8.1f%%' % (key, old[key], new[key], 100.0 * (new[key] - old[key]) / old[key]))
+    return '\n'.join(lines)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='keypad pipeline latency and bus cost benchmark')
+    parser.add_argument('--scenario', action='append', help='run only this scenario, can be repeated')
+    parser.add_argument('--db-check-time', type=float, default=0.0, help='seconds each stand-in DB check takes')
+    parser.add_argument('--output', help='write the results as JSON to this file')
+    parser.add_argument('--baseline', help='JSON results of an earlier run to compare against')
+    args = parser.parse_args()
+
+    run = run_benchmarks(args.scenario, args.db_check_time)
+    text = json.dumps(run, indent=2, sort_keys=True)
+    if args.output:
+        with open(args.output, 'w') as output:
+            output.write(text)
+    else:
+        print text
+    if args.baseline:
+        with open(args.baseline) as baseline:
+            print compare(json.load(baseline), run)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,401 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_event_server
+# Purpose:     Unlock event publishing to other processes over a Unix domain socket
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Pushes unlock, reject, alert and ready events of the user interfaces to any number of subscriber
+# processes (lock actuators, loggers, UIs) connected to a Unix domain socket. Key presses and codes are
+# never published.
+#
+# Line protocol, one ASCII line per message, fields separated by spaces, values url quoted:
+#   server: HELLO <protocol version> <last sequence number>
+#           EVT <seq> <type> <keypad> <time> [name=value ...]
+#           ERR <reason>
+#   client: SUB <type>[,<type>...]      only send these event types, all by default
+#           SINCE <seq>                 resend the buffered events after seq, ie. after a reconnect
+#           ACK <seq>                   the events up to seq were handled
+#           READY [<keypad>]            the consumer is ready for the next unlock code
+#
+#   server = UnlockEventServer('/var/run/keypad/events.sock')
+#   server.attach(ui)
+#   server.start()
+#
+#   python keypad_event_server.py subscribe /var/run/keypad/events.sock
+#
+# one thread serves every subscriber with select(); publishing only queues the line and wakes it
+
+import os
+import sys
+import time
+import errno
+import socket
+import select
+import fcntl
+import urllib
+import threading
+import collections
+
+from SX150_keypad_I2C_interface import KEYPAD_EVENT_VERDICT, KEYPAD_EVENT_READY, KEYPAD_EVENT_ALERT
+from keypad_log import log
+
+PROTOCOL_VERSION = 1
+
+# published event types
+EVENT_UNLOCK = 'unlock'
+EVENT_REJECT = 'reject'
+EVENT_ALERT = 'alert'
+EVENT_READY = 'ready'
+EVENT_TYPES = (EVENT_UNLOCK, EVENT_REJECT, EVENT_ALERT, EVENT_READY)
+
+# fields of the user interface events that are published
+EVENT_FIELDS = ('source', 'result', 'alert_description', 'alert_type')
+
+
+# ========= define a class to hold one subscriber connection =========
+class EventSubscriber:
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.input = ''
+        self.output = collections.deque()
+        self.output_size = 0
+        self.types = None
+        # highest sequence number acknowledged by the subscriber
+        self.acked = 0
+        self.connect_time = time.time()
+
+    def send(self, line):
+        self.output.append(line)
+        self.output_size = self.output_size + len(line)
+
+# ========= END define a class to hold one subscriber connection =========
+
+
+# ========= define a thread to publish the unlock events on a Unix domain socket =========
+class UnlockEventServer(threading.Thread):
+
+    # history_size: events kept for SINCE; output_max: bytes queued for a subscriber before it is dropped
+    def __init__(self, path, history_size=256, output_max=65536, mode=0660):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.mode = mode
+        self.history = collections.deque(maxlen=history_size)
+        self.output_max = output_max
+        self.lock = threading.Lock()
+        self.seq = 0
+        # lines published by the user interface threads, waiting for the server thread; the oldest are
+        # dropped when the server thread falls history_size events behind, they could not be resent anyway
+        self.pending = collections.deque(maxlen=history_size)
+        self.dropped_events = 0
+        self.subscribers = {}
+        # keypad id -> UserInterfaceThread
+        self.interfaces = collections.OrderedDict()
+        self.published = 0
+        self.dropped_subscribers = 0
+        self.stopped = False
+        # the server thread sleeps in select(), a byte on this pipe wakes it
+        self.wake_read, self.wake_write = os.pipe()
+        # publishing never blocks: a full pipe means the server thread has a wake up pending already
+        fcntl.fcntl(self.wake_write, fcntl.F_SETFL, fcntl.fcntl(self.wake_write, fcntl.F_GETFL) | os.O_NONBLOCK)
+        self.listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            os.unlink(path)
+        except OSError as e:
+            if e.errno != errno.ENOENT:
+                raise
+        self.listener.bind(path)
+        os.chmod(path, mode)
+        self.listener.listen(8)
+        self.listener.setblocking(False)
+
+    def attach(self, ui):
+        self.interfaces[ui.Keypad.keypad_id] = ui
+        ui.add_event_listener(self.event_listener)
+
+    def detach(self, ui):
+        ui.remove_event_listener(self.event_listener)
+        self.interfaces.pop(ui.Keypad.keypad_id, None)
+
+    # user interface event listener, runs on the user interface thread and never blocks
+    def event_listener(self, event):
+        if event['type'] == KEYPAD_EVENT_VERDICT:
+            if event['accepted']:
+                event_type = EVENT_UNLOCK
+            else:
+                event_type = EVENT_REJECT
+        elif event['type'] == KEYPAD_EVENT_READY:
+            event_type = EVENT_READY
+        elif event['type'] == KEYPAD_EVENT_ALERT:
+            event_type = EVENT_ALERT
+        else:
+            return
+        fields = [(name, event[name]) for name in EVENT_FIELDS if name in event]
+        self.publish(event_type, event['keypad'], event['time'], fields)
+
+    def publish(self, event_type, keypad, event_time, fields=()):
+        with self.lock:
+            if self.stopped:
+                return
+            if len(self.pending) == self.pending.maxlen:
+                self.dropped_events = self.dropped_events + 1
+            self.seq = self.seq + 1
+            line = 'EVT %d %s %s %.6f' % (self.seq, event_type, quote(keypad), event_time)
+            for name, value in fields:
+                line = line + ' ' + name + '=' + quote(value)
+            self.pending.append((self.seq, event_type, line + '\n'))
+        self.wake()
+
+    def wake(self):
+        try:
+            os.write(self.wake_write, 'x')
+        except OSError as e:
+            if e.errno != errno.EAGAIN:
+                log.warning('event_server', 'wake up failed', error=e)
+
+    def run(self):
+        while not self.stopped:
+            readers = [self.listener, self.wake_read] + list(self.subscribers)
+            writers = [connection for connection, subscriber in self.subscribers.items() if subscriber.output]
+            try:
+                readable, writable, failed = select.select(readers, writers, [])
+            except select.error as e:
+                if e.args[0] == errno.EINTR:
+                    continue
+                raise
+            if self.wake_read in readable:
+                os.read(self.wake_read, 4096)
+                self.distribute()
+            if self.listener in readable:
+                self.accept()
+            for connection in readable:
+                if connection in self.subscribers:
+                    self.receive(connection)
+            for connection in writable:
+                if connection in self.subscribers:
+                    self.flush(connection)
+        self.listener.close()
+
+    def accept(self):
+        try:
+            connection, address = self.listener.accept()
+        except socket.error:
+            return
+        connection.setblocking(False)
+        subscriber = EventSubscriber(connection)
+        self.subscribers[connection] = subscriber
+        subscriber.send('HELLO %d %d\n' % (PROTOCOL_VERSION, self.seq))
+
+    # hand the published lines to the subscribers, a subscriber that can't keep up is dropped
+    def distribute(self):
+        while self.pending:
+            seq, event_type, line = self.pending.popleft()
+            self.history.append((seq, event_type, line))
+            self.published = self.published + 1
+            for connection, subscriber in self.subscribers.items():
+                if subscriber.types is None or event_type in subscriber.types:
+                    subscriber.send(line)
+                    if subscriber.output_size > self.output_max:
+                        self.dropped_subscribers = self.dropped_subscribers + 1
+                        log.warning('event_server', 'subscriber dropped, too far behind', seq=seq)
+                        self.disconnect(connection)
+
+    def receive(self, connection):
+        subscriber = self.subscribers[connection]
+        try:
+            data = connection.recv(4096)
+        except socket.error as e:
+            if e.errno in (errno.EAGAIN, errno.EINTR):
+                return
+            data = ''
+        if not data:
+            self.disconnect(connection)
+            return
+        subscriber.input = subscriber.input + data
+        while '\n' in subscriber.input:
+            line, subscriber.input = subscriber.input.split('\n', 1)
+            self.command(subscriber, line.strip().split())
+        # a line that long is not part of the protocol
+        if len(subscriber.input) > 256:
+            self.disconnect(connection)
+
+    def command(self, subscriber, words):
+        if not words:
+            return
+        try:
+            if words[0] == 'ACK' and len(words) == 2:
+                subscriber.acked = max(subscriber.acked, int(words[1]))
+            elif words[0] == 'SUB' and len(words) == 2:
+                subscriber.types = set(words[1].split(','))
+            elif words[0] == 'SINCE' and len(words) == 2:
+                since = int(words[1])
+                for seq, event_type, line in self.history:
+                    if seq > since and (subscriber.types is None or event_type in subscriber.types):
+                        subscriber.send(line)
+            elif words[0] == 'READY' and len(words) <= 2:
+                if len(words) == 2:
+                    ui = self.interface(unquote(words[1]))
+                else:
+                    ui = next(iter(self.interfaces.values()), None)
+                if ui is None:
+                    subscriber.send('ERR unknown_keypad\n')
+                else:
+                    ui.read_next_unlock_code()
+            else:
+                subscriber.send('ERR unknown_command\n')
+        except ValueError:
+            subscriber.send('ERR bad_argument\n')
+
+    # keypad ids arrive as text, ie. '0' for the KeypadController's default id 0, None for '-'
+    def interface(self, keypad):
+        for keypad_id, ui in self.interfaces.items():
+            if keypad_id is None or keypad is None:
+                if keypad_id is keypad:
+                    return ui
+            elif str(keypad_id) == keypad:
+                return ui
+        return None
+
+    def flush(self, connection):
+        subscriber = self.subscribers[connection]
+        while subscriber.output:
+            line = subscriber.output[0]
+            try:
+                sent = connection.send(line)
+            except socket.error as e:
+                if e.errno in (errno.EAGAIN, errno.EINTR):
+                    return
+                self.disconnect(connection)
+                return
+            subscriber.output_size = subscriber.output_size - sent
+            if sent < len(line):
+                subscriber.output[0] = line[sent:]
+                return
+            subscriber.output.popleft()
+
+    def disconnect(self, connection):
+        self.subscribers.pop(connection, None)
+        try:
+            connection.close()
+        except socket.error:
+            pass
+
+    def stop(self):
+        for ui in list(self.interfaces.values()):
+            self.detach(ui)
+        with self.lock:
+            self.stopped = True
+        self.wake()
+        for connection in list(self.subscribers):
+            self.disconnect(connection)
+        try:
+            os.unlink(self.path)
+        except OSError:
+            pass
+
+    def stats(self):
+        return {'published': self.published, 'seq': self.seq, 'subscribers': len(self.subscribers),
+                'dropped_subscribers': self.dropped_subscribers, 'dropped_events': self.dropped_events,
+                'unacked_max': max([self.seq - subscriber.acked for subscriber in self.subscribers.values()] or [0])}
+
+# ========= END define a thread to publish the unlock events on a Unix domain socket =========
+
+
+# None goes on the wire as '-', a '-' value is escaped so the two stay apart
+def quote(value):
+    if value is None:
+        return '-'
+    return urllib.quote(str(value), safe='').replace('-', '%2D')
+
+def unquote(value):
+    if value == '-':
+        return None
+    return urllib.unquote(value)
+
+
+# ========= define a class for subscriber processes =========
+class UnlockEventClient:
+
+    def __init__(self, path, types=None, since=None, timeout=None):
+        self.connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.connection.settimeout(timeout)
+        self.connection.connect(path)
+        self.reader = self.connection.makefile('r')
+        hello = self.reader.readline().split()
+        if len(hello) != 3 or hello[0] != 'HELLO':
+            raise IOError(errno.EPROTO, 'not a keypad event server: ' + path)
+        self.server_seq = int(hello[2])
+        if types is not None:
+            self.send('SUB ' + ','.join(types))
+        if since is not None:
+            self.send('SINCE %d' % since)
+
+    def send(self, line):
+        self.connection.sendall(line + '\n')
+
+    # next event as a dict with 'seq', 'type', 'keypad', 'time' and the event fields, None when the server closed
+    def next_event(self):
+        while True:
+            line = self.reader.readline()
+            if not line:
+                return None
+            words = line.split()
+            if not words or words[0] != 'EVT' or len(words) < 5:
+                continue
+            event = {'seq': int(words[1]), 'type': words[2], 'keypad': unquote(words[3]), 'time': float(words[4])}
+            for word in words[5:]:
+                name, value = word.split('=', 1)
+                event[name] = unquote(value)
+            return event
+
+    def __iter__(self):
+        while True:
+            event = self.next_event()
+            if event is None:
+                return
+            yield event
+
+    def ack(self, seq):
+        self.send('ACK %d' % seq)
+
+    def ready(self, keypad=None):
+        if keypad is None:
+            self.send('READY')
+        else:
+            self.send('READY ' + quote(keypad))
+
+    def close(self):
+        self.connection.close()
+
+# ========= END define a class for subscriber processes =========
+
+
+# prints the events, ie. python keypad_event_server.py subscribe /var/run/keypad/events.sock
+def main():
+    if len(sys.argv) != 3 or sys.argv[1] != 'subscribe':
+        print 'usage: keypad_event_server.py subscribe <socket path>'
+        sys.exit(2)
+    client = UnlockEventClient(sys.argv[2])
+    for event in client:
+        print event['seq'], event['type'], event['keypad'], ' '.join(
+            name + '=' + str(event[name]) for name in sorted(event) if name in EVENT_FIELDS)
+        client.ack(event['seq'])
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,163 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_log
+# Purpose:     Non-blocking structured logging for the keypad interface
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Log events are appended to a bounded deque and written by a background thread, so a slow
+# serial console or a blocked pipe stalls only the writer and never key handling:
+#
+#   log.info('key_sequence_add', 'added key', keypad=self.keypad_id, code_length=3)
+#
+# events over the queue size or the rate limit are dropped and counted. Unlock codes must
+# never be logged; log the code length instead.
+
+import sys
+import time
+import threading
+import collections
+
+LOG_DEBUG = 10
+LOG_INFO = 20
+LOG_WARNING = 30
+LOG_ERROR = 40
+LEVEL_NAMES = {LOG_DEBUG: 'DEBUG', LOG_INFO: 'INFO', LOG_WARNING: 'WARNING', LOG_ERROR: 'ERROR'}
+
+
+# ========= define a class to write log events from a background thread =========
+class KeypadLog:
+
+    # rate: events per second on average, burst: events allowed at once
+    def __init__(self, level=LOG_INFO, queue_size=1024, rate=100.0, burst=200, stream=None):
+        self.level = level
+        # per stage level overrides
+        self.stage_levels = {}
+        # deque append/popleft are atomic so producers never take a lock for the queue
+        self.events = collections.deque()
+        self.queue_size = queue_size
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.token_time = time.time()
+        self.stream = stream
+        self.dropped = 0
+        self.rate_limited = 0
+        self.write_errors = 0
+        self.written = 0
+        self.wakeup = threading.Event()
+        self.idle = threading.Event()
+        self.idle.set()
+        self.writer = None
+        self.writer_lock = threading.Lock()
+
+    # level for all stages, or for one stage
+    def set_level(self, level, stage=None):
+        if stage is None:
+            self.level = level
+        else:
+            self.stage_levels[stage] = level
+
+    def is_enabled(self, level, stage=None):
+        return level >= self.stage_levels.get(stage, self.level)
+
+    def log(self, level, stage, message, keypad=None, **fields):
+        if level < self.stage_levels.get(stage, self.level):
+            return False
+        if len(self.events) >= self.queue_size:
+            self.dropped = self.dropped + 1
+            return False
+        # token bucket, approximate under concurrency which is good enough for a rate limit
+        now = time.time()
+        self.tokens = min(self.burst, self.tokens + (now - self.token_time) * self.rate)
+        self.token_time = now
+        if self.tokens < 1.0:
+            self.rate_limited = self.rate_limited + 1
+            return False
+        self.tokens = self.tokens - 1.0
+        self.events.append((now, level, keypad, stage, message, fields))
+        if self.writer is None:
+            self.start()
+        self.idle.clear()
+        self.wakeup.set()
+        return True
+
+    def debug(self, stage, message, keypad=None, **fields):
+        return self.log(LOG_DEBUG, stage, message, keypad, **fields)
+
+    def info(self, stage, message, keypad=None, **fields):
+        return self.log(LOG_INFO, stage, message, keypad, **fields)
+
+    def warning(self, stage, message, keypad=None, **fields):
+        return self.log(LOG_WARNING, stage, message, keypad, **fields)
+
+    def error(self, stage, message, keypad=None, **fields):
+        return self.log(LOG_ERROR, stage, message, keypad, **fields)
+
+    def start(self):
+        with self.writer_lock:
+            if self.writer is None:
+                self.writer = threading.Thread(target=self.run)
+                self.writer.daemon = True
+                self.writer.start()
+
+    @staticmethod
+    def format(event):
+        timestamp, level, keypad, stage, message, fields = event
+        line = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(timestamp)) + ('.%03d ' % (int(timestamp * 1000) % 1000))
+        line = line + LEVEL_NAMES.get(level, str(level)) + ' '
+        if keypad is not None:
+            line = line + 'keypad=' + str(keypad) + ' '
+        line = line + str(stage) + ': ' + message
+        for name in sorted(fields):
+            value = fields[name]
+            if isinstance(value, float):
+                value = '%.6f' % value
+            line = line + ' ' + name + '=' + str(value)
+        return line + '\n'
+
+    def run(self):
+        while True:
+            self.wakeup.wait()
+            self.wakeup.clear()
+            stream = self.stream
+            if stream is None:
+                stream = sys.stdout
+            try:
+                while self.events:
+                    stream.write(self.format(self.events.popleft()))
+                    self.written = self.written + 1
+                stream.flush()
+            except (IOError, ValueError):
+                self.write_errors = self.write_errors + 1
+            if not self.events:
+                self.idle.set()
+
+    # wait for the queued events to be written, ie. before exiting
+    def flush(self, timeout=2.0):
+        if self.writer is None:
+            return True
+        self.wakeup.set()
+        return self.idle.wait(timeout)
+
+    def stats(self):
+        return {'queued': len(self.events), 'written': self.written, 'dropped': self.dropped,
+                'rate_limited': self.rate_limited, 'write_errors': self.write_errors}
+
+# ========= END define a class to write log events from a background thread =========
+
+# shared by every keypad in the process
+log = KeypadLog()
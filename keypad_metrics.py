@@ -0,0 +1,181 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_metrics
+# Purpose:     Per stage latency histograms and event counters for the keypad
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Fixed bucket latency histograms and counters held in preallocated arrays. Recording is off
+# by default; the hot paths only time a stage when metrics.enabled is set:
+#
+#   if metrics.enabled:
+#       start_time = time.time()
+#   ...
+#   if metrics.enabled:
+#       metrics.observe(STAGE_READ_KEY_PRESS, time.time() - start_time)
+#
+# snapshot() returns the current values, prometheus_text()/dump() write them in the
+# Prometheus text format, ie. for the node exporter's textfile collector
+
+import os
+import time
+import array
+import bisect
+import threading
+
+# ===== stages with a latency histogram =====
+STAGE_READ_KEY_PRESS = 0
+STAGE_KEY_SEQUENCE_ADD = 1
+STAGE_UNLOCK_CODE_RESET = 2
+STAGE_ENABLE_KEYPAD_SCANNING = 3
+STAGE_CHECK_UNLOCK_CODE = 4
+STAGE_I2C_TRANSACTION = 5
+STAGE_BUS_RECOVERY = 6
+STAGE_NAMES = ('read_key_press', 'key_sequence_add', 'unlock_code_reset', 'enable_keypad_scanning',
+               'check_unlock_code', 'i2c_transaction', 'bus_recovery')
+
+# ===== counters =====
+COUNT_KEYPRESSES = 0
+COUNT_INVALID_DECODES = 1
+COUNT_TIMEOUTS = 2
+COUNT_CODES_ACCEPTED = 3
+COUNT_CODES_REJECTED = 4
+COUNT_BUS_ERRORS = 5
+COUNT_MULTI_KEY_PRESSES = 6
+COUNT_BUS_RETRIES = 7
+COUNT_CHIP_RESETS = 8
+COUNT_RECOVERIES = 9
+COUNTER_NAMES = ('keypresses', 'invalid_decodes', 'timeouts', 'codes_accepted', 'codes_rejected', 'bus_errors',
+                 'multi_key_presses', 'bus_retries', 'chip_resets', 'recoveries')
+
+# histogram bucket upper bounds in seconds, the last bucket is +Inf
+BUCKET_BOUNDS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5)
+
+
+# ========= define a class to hold the keypad metrics =========
+class KeypadMetrics:
+
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        self.bucket_count = len(BUCKET_BOUNDS) + 1
+        self.buckets = array.array('L', [0] * (len(STAGE_NAMES) * self.bucket_count))
+        self.sums = array.array('d', [0.0] * len(STAGE_NAMES))
+        self.counters = array.array('L', [0] * len(COUNTER_NAMES))
+        self.dump_call = None
+
+    def enable(self, enabled=True):
+        self.enabled = enabled
+
+    def observe(self, stage, seconds):
+        bucket = stage * self.bucket_count + bisect.bisect_left(BUCKET_BOUNDS, seconds)
+        with self.lock:
+            self.buckets[bucket] = self.buckets[bucket] + 1
+            self.sums[stage] = self.sums[stage] + seconds
+
+    def count(self, counter, increment=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[counter] = self.counters[counter] + increment
+
+    def reset(self):
+        with self.lock:
+            for index in range(len(self.buckets)):
+                self.buckets[index] = 0
+            for index in range(len(self.sums)):
+                self.sums[index] = 0.0
+            for index in range(len(self.counters)):
+                self.counters[index] = 0
+
+    # upper bound of the bucket holding the given fraction of the samples
+    def quantile(self, stage, fraction):
+        with self.lock:
+            counts = self.buckets[stage * self.bucket_count:(stage + 1) * self.bucket_count]
+        total = sum(counts)
+        if total == 0:
+            return None
+        running = 0
+        for index, bucket_count in enumerate(counts):
+            running = running + bucket_count
+            if running >= fraction * total:
+                if index < len(BUCKET_BOUNDS):
+                    return BUCKET_BOUNDS[index]
+                return float('inf')
+
+    def snapshot(self):
+        with self.lock:
+            buckets = self.buckets.tolist()
+            sums = self.sums.tolist()
+            counters = self.counters.tolist()
+        stages = {}
+        for stage, name in enumerate(STAGE_NAMES):
+            counts = buckets[stage * self.bucket_count:(stage + 1) * self.bucket_count]
+            stages[name] = {'count': sum(counts), 'sum': sums[stage], 'buckets': counts,
+                            'p50': self.quantile(stage, 0.5), 'p99': self.quantile(stage, 0.99)}
+        return {'time': time.time(), 'enabled': self.enabled, 'bucket_bounds': list(BUCKET_BOUNDS),
+                'stages': stages, 'counters': dict(zip(COUNTER_NAMES, counters))}
+
+    def prometheus_text(self):
+        snapshot = self.snapshot()
+        lines = ['# HELP keypad_stage_latency_seconds Time spent in each keypad processing stage.',
+                 '# TYPE keypad_stage_latency_seconds histogram']
+        for name in STAGE_NAMES:
+            stage = snapshot['stages'][name]
+            cumulative = 0
+            for index, bucket_count in enumerate(stage['buckets']):
+                cumulative = cumulative + bucket_count
+                if index < len(BUCKET_BOUNDS):
+                    bound = repr(BUCKET_BOUNDS[index])
+                else:
+                    bound = '+Inf'
+                lines.append('keypad_stage_latency_seconds_bucket{stage="%s",le="%s"} %d' % (name, bound, cumulative))
+            lines.append('keypad_stage_latency_seconds_sum{stage="%s"} %r' % (name, stage['sum']))
+            lines.append('keypad_stage_latency_seconds_count{stage="%s"} %d' % (name, stage['count']))
+        lines.append('# HELP keypad_events_total Keypad events by type.')
+        lines.append('# TYPE keypad_events_total counter')
+        for name in COUNTER_NAMES:
+            lines.append('keypad_events_total{event="%s"} %d' % (name, snapshot['counters'][name]))
+        return '\n'.join(lines) + '\n'
+
+    # write to a temporary file and rename so a reader never sees a partial file
+    def dump(self, path):
+        temp_path = path + '.tmp'
+        with open(temp_path, 'w') as dump_file:
+            dump_file.write(self.prometheus_text())
+        os.rename(temp_path, path)
+
+    # dump every interval seconds on a scheduler with schedule(delay, callback, args, name)/cancel(call)
+    def start_dump(self, path, interval, scheduler):
+        self.stop_dump()
+        self.dump_scheduler = scheduler
+        self.dump_call = scheduler.schedule(interval, self.periodic_dump, (path, interval), "metrics dump")
+
+    def periodic_dump(self, path, interval):
+        try:
+            self.dump(path)
+        finally:
+            self.dump_call = self.dump_scheduler.schedule(interval, self.periodic_dump, (path, interval), "metrics dump")
+
+    def stop_dump(self):
+        if self.dump_call is not None:
+            self.dump_scheduler.cancel(self.dump_call)
+            self.dump_call = None
+
+# ========= END define a class to hold the keypad metrics =========
+
+# shared by every keypad in the process
+metrics = KeypadMetrics()
@@ -0,0 +1,315 @@
+#-------------------------------------------------------------------------------
+# Name:        keypad_trace
+# Purpose:     Key press trace recording and replay for the keypad interface
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Records every keypad interrupt with its raw KeyData1/KeyData2 bytes and every I2C transaction
+# into a ring file of fixed size records, written in place through mmap:
+#
+#   trace = KeypadTraceRecorder('/var/log/keypad.trace')
+#   keypad = I2C_KeyPad(trace=trace)
+#
+# and replays the interrupts of a trace through I2C_KeyPad and UserInterfaceThread on the
+# simulated SX1509, at the recorded speed or faster:
+#
+#   python keypad_trace.py dump /var/log/keypad.trace
+#   python keypad_trace.py replay /var/log/keypad.trace --speed 10 --code 1234
+#
+# the trace holds raw key data, which reveals the codes typed; keep trace files as private as the DB
+
+import os
+import sys
+import time
+import mmap
+import struct
+import argparse
+import threading
+
+TRACE_MAGIC = 'KPTR'
+TRACE_VERSION = 1
+# magic, version, record size, capacity in records, records written since the file was created
+TRACE_HEADER = struct.Struct('<4sHHIQ')
+TRACE_HEADER_SIZE = 32
+# time, type, address, register, data0, data1, length; 16 bytes
+TRACE_RECORD = struct.Struct('<dBBBBBBxx')
+
+# ===== record types =====
+TRACE_INTERRUPT = 1     # read_key_press: data0 = KeyData1 (col), data1 = KeyData2 (row)
+TRACE_READ = 2          # read_byte_data: data0 = value
+TRACE_WRITE = 3         # write_byte_data: data0 = value
+TRACE_BLOCK_READ = 4    # read_i2c_block_data: data0/data1 = first two bytes
+TRACE_BLOCK_WRITE = 5   # write_i2c_block_data: data0/data1 = first two bytes
+TRACE_BUS_ERROR = 6     # IOError from the bus: data0 = errno
+TRACE_TYPE_NAMES = {TRACE_INTERRUPT: 'interrupt', TRACE_READ: 'read', TRACE_WRITE: 'write',
+                    TRACE_BLOCK_READ: 'block_read', TRACE_BLOCK_WRITE: 'block_write', TRACE_BUS_ERROR: 'bus_error'}
+
+
+# ========= define a class to record the keypad trace into a ring file =========
+class KeypadTraceRecorder:
+
+    # an existing trace file of the same capacity is appended to, otherwise the file is created
+    def __init__(self, path, capacity=65536):
+        self.path = path
+        self.lock = threading.Lock()
+        size = TRACE_HEADER_SIZE + capacity * TRACE_RECORD.size
+        # the trace reveals the codes typed, only the owner may read it whatever the umask
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0600)
+        os.fchmod(fd, 0600)
+        self.trace_file = os.fdopen(fd, 'r+b')
+        self.trace_file.seek(0, os.SEEK_END)
+        written = 0
+        if self.trace_file.tell() == size:
+            self.trace_file.seek(0)
+            magic, version, record_size, file_capacity, file_written = TRACE_HEADER.unpack(
+                self.trace_file.read(TRACE_HEADER.size))
+            if magic == TRACE_MAGIC and version == TRACE_VERSION and record_size == TRACE_RECORD.size and \
+               file_capacity == capacity:
+                written = file_written
+        if written == 0:
+            self.trace_file.truncate(0)
+            self.trace_file.truncate(size)
+        self.trace_file.flush()
+        self.map = mmap.mmap(self.trace_file.fileno(), size)
+        self.capacity = capacity
+        self.written = written
+        TRACE_HEADER.pack_into(self.map, 0, TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, capacity, written)
+
+    def record(self, record_type, address, reg, data0=0, data1=0, length=0, timestamp=None):
+        if timestamp is None:
+            timestamp = time.time()
+        with self.lock:
+            if self.map is None:
+                return
+            offset = TRACE_HEADER_SIZE + (self.written % self.capacity) * TRACE_RECORD.size
+            TRACE_RECORD.pack_into(self.map, offset, timestamp, record_type, address, reg & 0xFF, data0 & 0xFF,
+                                   data1 & 0xFF, min(length, 0xFF))
+            self.written = self.written + 1
+            TRACE_HEADER.pack_into(self.map, 0, TRACE_MAGIC, TRACE_VERSION, TRACE_RECORD.size, self.capacity,
+                                   self.written)
+
+    # called by I2C_KeyPad.read_key_press with the raw key data, before it is decoded
+    def key_data(self, timestamp, address, key_data):
+        self.record(TRACE_INTERRUPT, address, 0x27, key_data[0], key_data[1], 2, timestamp)
+
+    # called by I2C_KeyPad to record the transactions on its bus
+    def bus(self, bus):
+        return TracingBus(bus, self)
+
+    def flush(self):
+        with self.lock:
+            if self.map is not None:
+                self.map.flush()
+
+    def close(self):
+        with self.lock:
+            if self.map is None:
+                return
+            self.map.flush()
+            self.map.close()
+            self.map = None
+            self.trace_file.close()
+
+# ========= END define a class to record the keypad trace into a ring file =========
+
+
+# ========= define a class to record the transactions of an smbus.SMBus =========
+class TracingBus:
+
+    def __init__(self, bus, recorder):
+        self.bus = bus
+        self.recorder = recorder
+
+    def call(self, function, address, reg, *args):
+        try:
+            return function(address, reg, *args)
+        except IOError as e:
+            self.recorder.record(TRACE_BUS_ERROR, address, reg, e.errno or 0)
+            raise
+
+    def read_byte_data(self, address, reg):
+        msg_data = self.call(self.bus.read_byte_data, address, reg)
+        self.recorder.record(TRACE_READ, address, reg, msg_data, 0, 1)
+        return msg_data
+
+    def write_byte_data(self, address, reg, msg_data):
+        self.call(self.bus.write_byte_data, address, reg, msg_data)
+        self.recorder.record(TRACE_WRITE, address, reg, msg_data, 0, 1)
+
+    def read_i2c_block_data(self, address, reg, length=32):
+        data = self.call(self.bus.read_i2c_block_data, address, reg, length)
+        self.recorder.record(TRACE_BLOCK_READ, address, reg, data[0] if data else 0,
+                             data[1] if len(data) > 1 else 0, len(data))
+        return data
+
+    def write_i2c_block_data(self, address, reg, data):
+        self.call(self.bus.write_i2c_block_data, address, reg, data)
+        self.recorder.record(TRACE_BLOCK_WRITE, address, reg, data[0] if data else 0,
+                             data[1] if len(data) > 1 else 0, len(data))
+
+    def close(self):
+        self.bus.close()
+
+# ========= END define a class to record the transactions of an smbus.SMBus =========
+
+
+# records of a trace file, oldest first, as (time, type, address, reg, data0, data1, length)
+def read_trace(path):
+    with open(path, 'rb') as trace_file:
+        data = trace_file.read()
+    magic, version, record_size, capacity, written = TRACE_HEADER.unpack_from(data, 0)
+    if magic != TRACE_MAGIC or version != TRACE_VERSION or record_size != TRACE_RECORD.size:
+        raise ValueError("not a keypad trace file: " + path)
+    records = []
+    for seq in range(max(written - capacity, 0), written):
+        records.append(TRACE_RECORD.unpack_from(data, TRACE_HEADER_SIZE + (seq % capacity) * TRACE_RECORD.size))
+    return records
+
+
+def format_record(record):
+    timestamp, record_type, address, reg, data0, data1, length = record
+    return '%.6f %-11s addr=0x%02X reg=0x%02X data=0x%02X 0x%02X len=%d' % (
+        timestamp, TRACE_TYPE_NAMES.get(record_type, str(record_type)), address, reg, data0, data1, length)
+
+
+# ========= define a class to replay a trace through the keypad interface =========
+# the interrupts of one SX1509 address are replayed as raw key data on a simulated SX1509 so
+# spurious and multi key reads reach read_key_press exactly as they were recorded; unlocks are
+# consumed straight away
+class KeypadTraceReplay:
+
+    def __init__(self, records, db_factory, address=None, speed=1.0, **keypad_args):
+        # imported here, the interface module records traces through this module
+        import SX150_keypad_I2C_interface as keypad_interface
+        from sx1509_sim import SimulatedGPIO, SimulatedSMBus, SimulatedSX1509
+
+        interrupts = [record for record in records if record[1] == TRACE_INTERRUPT]
+        if address is None:
+            if interrupts:
+                address = interrupts[0][2]
+            else:
+                address = 0x3E
+        self.interrupts = [record for record in interrupts if record[2] == address]
+        self.recorded_transactions = len([record for record in records
+                                          if record[1] not in (TRACE_INTERRUPT, TRACE_BUS_ERROR) and record[2] == address])
+        self.speed = speed
+        self.gpio = SimulatedGPIO()
+        self.bus = SimulatedSMBus()
+        self.chip = self.bus.add_device(SimulatedSX1509(address))
+        interrupt_pin = keypad_args.get('kpad_interrupt_input_pin', 7)
+        self.chip.connect_interrupt(self.gpio, interrupt_pin)
+        self.Keypad = keypad_interface.I2C_KeyPad(bus=self.bus, gpio=self.gpio, address=address, **keypad_args)
+        # keep the inter key press timeout in step with the replay speed
+        if speed > 0:
+            self.Keypad.inter_keypress_time = self.Keypad.inter_keypress_time / float(speed)
+        self.ui = keypad_interface.UserInterfaceThread(Keypad=self.Keypad, db_factory=db_factory, remote_commands=False)
+        self.ui.daemon = True
+        self.unlocks = 0
+        self.stopped = threading.Event()
+
+    def consume_unlocks(self):
+        while not self.stopped.is_set():
+            if self.ui.unlock_event.wait(0.1):
+                self.unlocks = self.unlocks + 1
+                self.ui.read_next_unlock_code()
+
+    def wait_idle(self, timeout=5):
+        deadline = time.time() + timeout
+        while self.Keypad.dispatcher.pending() and time.time() < deadline:
+            time.sleep(0.001)
+
+    def run(self):
+        self.ui.start()
+        consumer = threading.Thread(target=self.consume_unlocks)
+        consumer.daemon = True
+        consumer.start()
+        # let the LED self test writes go out so they don't count as replayed traffic
+        self.wait_idle()
+        self.bus.reset_stats()
+        start_time = time.time()
+        if self.interrupts:
+            trace_start = self.interrupts[0][0]
+        for record in self.interrupts:
+            if self.speed > 0:
+                delay = start_time + (record[0] - trace_start) / self.speed - time.time()
+                if delay > 0:
+                    time.sleep(delay)
+            else:
+                # as fast as possible, one interrupt at a time so the result doesn't depend on timing
+                self.wait_idle()
+            self.chip.set_key_data(record[4], record[5])
+        self.wait_idle()
+        # the last code check
+        time.sleep(0.1)
+        self.stopped.set()
+        consumer.join(1)
+        replay_time = time.time() - start_time
+        self.ui.audit.close()
+        return {'interrupts': len(self.interrupts),
+                'replay_time_s': replay_time,
+                'key_decode_errors': dict(self.Keypad.key_decode_errors),
+                'multi_key_presses': self.Keypad.multi_key_presses,
+                'unlocks': self.unlocks,
+                'recorded_transactions': self.recorded_transactions,
+                'replayed_transactions': self.bus.stats()['transactions'],
+                'callback_time_max_ms': self.Keypad.callback_time_max * 1000.0}
+
+# ========= END define a class to replay a trace through the keypad interface =========
+
+
+# ========= define a stand-in for PASSCODE_DB that accepts the given codes =========
+class ReplayPasscodeDB:
+
+    def __init__(self, codes=()):
+        self.codes = dict((code, index) for index, code in enumerate(codes))
+
+    def check_unlock_code(self, unlock_code):
+        return self.codes.get(unlock_code, -1)
+
+    def ceate_alert(self, alert_description=None, alert_type=None):
+        pass
+
+# ========= END define a stand-in for PASSCODE_DB that accepts the given codes =========
+
+
+def main():
+    parser = argparse.ArgumentParser(description='keypad trace dump and replay')
+    parser.add_argument('command', choices=('dump', 'replay'))
+    parser.add_argument('path', help='trace file')
+    parser.add_argument('--speed', type=float, default=1.0, help='replay speed, 0 = as fast as possible')
+    parser.add_argument('--address', type=lambda value: int(value, 0), help='SX1509 address to replay')
+    parser.add_argument('--code', action='append', default=[], help='unlock code the stand-in DB accepts')
+    args = parser.parse_args()
+
+    try:
+        records = read_trace(args.path)
+    except (IOError, ValueError, struct.error) as e:
+        print 'keypad_trace: ' + str(e)
+        sys.exit(1)
+    if args.command == 'dump':
+        for record in records:
+            print format_record(record)
+        return
+    codes = args.code
+    replay = KeypadTraceReplay(records, lambda: ReplayPasscodeDB(codes), args.address, args.speed)
+    results = replay.run()
+    for key in sorted(results):
+        print key + ': ' + str(results[key])
+
+
+if __name__ == '__main__':
+    main()
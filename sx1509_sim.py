@@ -0,0 +1,371 @@
+#-------------------------------------------------------------------------------
+# Name:        sx1509_sim
+# Purpose:     Simulated SX1509 keypad engine, SMBus and GPIO backends
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#
+#       [2019] DeviceFusion LLC
+#       All Rights Reserved.
+#
+#       NOTICE:  All information contained herein is, and remains
+#       the property of DeviceFusion LLC Incorporated and its suppliers,
+#       if any.  The intellectual and technical concepts contained
+#       herein are proprietary to DeviceFusion LLC
+#       and its suppliers and may be covered by U.S. and Foreign Patents,
+#       patents in process, and are protected by trade secret or copyright law.
+#       Dissemination of this information or reproduction of this material
+#       is strictly forbidden unless prior written permission is obtained
+#       from DeviceFusion LLC.
+#-------------------------------------------------------------------------------
+# Stand-ins for smbus.SMBus, RPi.GPIO and the SX1509 so I2C_KeyPad and I2C_LED
+# can run without the device, ie:
+#
+#   gpio = SimulatedGPIO()
+#   bus = SimulatedSMBus()
+#   chip = bus.add_device(SimulatedSX1509(0x3E))
+#   chip.connect_interrupt(gpio, 7)
+#   keypad = I2C_KeyPad(bus=bus, gpio=gpio)
+#   chip.type_keys('1234', keypad.key_map)
+#
+# every transaction is counted per register so the bus cost of a change can be measured
+
+import os
+import time
+import random
+import threading
+import errno
+
+from SX150_keypad_I2C_interface import SX1509_REG_DEFAULTS
+
+
+# ========= define a class to simulate the RPi.GPIO module =========
+class SimulatedGPIO:
+
+    BOARD = 10
+    BCM = 11
+    OUT = 0
+    IN = 1
+    LOW = 0
+    HIGH = 1
+    PUD_OFF = 20
+    PUD_DOWN = 21
+    PUD_UP = 22
+    RISING = 31
+    FALLING = 32
+    BOTH = 33
+
+    def __init__(self):
+        self.lock = threading.RLock()
+        self.mode = None
+        # pin -> level, pin -> (edge, callback)
+        self.levels = {}
+        self.event_detect = {}
+
+    def setmode(self, mode):
+        self.mode = mode
+
+    def setwarnings(self, flag):
+        pass
+
+    def setup(self, pin, direction, pull_up_down=None, initial=None):
+        with self.lock:
+            if pull_up_down == self.PUD_DOWN:
+                self.levels[pin] = self.LOW
+            else:
+                self.levels[pin] = self.HIGH
+
+    def input(self, pin):
+        return self.levels.get(pin, self.HIGH)
+
+    def add_event_detect(self, pin, edge, callback=None, bouncetime=None):
+        with self.lock:
+            self.event_detect[pin] = (edge, callback)
+
+    def remove_event_detect(self, pin):
+        with self.lock:
+            self.event_detect.pop(pin, None)
+
+    def cleanup(self, pin=None):
+        with self.lock:
+            if pin is None:
+                self.event_detect = {}
+            else:
+                self.event_detect.pop(pin, None)
+
+    # drive a pin, the event callback runs on the caller's thread like RPi.GPIO's callback thread
+    def set_level(self, pin, level):
+        with self.lock:
+            previous = self.levels.get(pin, self.HIGH)
+            self.levels[pin] = level
+            edge, callback = self.event_detect.get(pin, (None, None))
+        if callback is None or previous == level:
+            return
+        if (edge == self.FALLING and level == self.LOW) or (edge == self.RISING and level == self.HIGH) or edge == self.BOTH:
+            callback(pin)
+
+# ========= END define a class to simulate the RPi.GPIO module =========
+
+
+# ========= define a class to simulate the SX1509 register file and keypad engine =========
+class SimulatedSX1509:
+
+    reg_reset = 0x7D
+    reg_clock = 0x1E
+    reg_data_B = 0x10
+    reg_leddriverenable_B = 0x20
+    reg_debounce_config = 0x22
+    reg_key_config_1 = 0x25
+    reg_key_config_2 = 0x26
+    reg_key_data_1 = 0x27
+    reg_key_data_2 = 0x28
+
+    # register values after power up / reset that are not 0x00, as per the SX1509 datasheet
+    reg_defaults = SX1509_REG_DEFAULTS
+
+    def __init__(self, address=0x3E):
+        self.address = address
+        self.lock = threading.RLock()
+        self.regs = [0] * 0x80
+        self.reset_state = 0
+        # NINT output, active low, and the GPIO pin it is wired to
+        self.gpio = None
+        self.interrupt_pin = None
+        self.interrupt_level = 1
+        self.key_presses = 0
+        self.ignored_key_presses = 0
+        self.resets = 0
+        # when set, a key press raises the interrupt after the scan and debounce delay of the keypad engine
+        self.scan_timing = False
+        self.last_key_time = 0.0
+        self.power_on()
+        self.reset_stats()
+
+    def power_on(self):
+        with self.lock:
+            self.regs = [0] * 0x80
+            for reg, msg_data in self.reg_defaults.items():
+                self.regs[reg] = msg_data
+            self.reset_state = 0
+
+    def reset_stats(self):
+        with self.lock:
+            self.reg_reads = [0] * 0x80
+            self.reg_writes = [0] * 0x80
+
+    def connect_interrupt(self, gpio, pin):
+        self.gpio = gpio
+        self.interrupt_pin = pin
+
+    def set_interrupt(self, level):
+        self.interrupt_level = level
+        if self.gpio is not None:
+            self.gpio.set_level(self.interrupt_pin, level)
+
+    # ===== register access, called by SimulatedSMBus =====
+
+    def read_register(self, reg):
+        with self.lock:
+            self.reg_reads[reg] = self.reg_reads[reg] + 1
+            msg_data = self.regs[reg]
+            # reading the key data clears the keypad interrupt
+            clear_interrupt = reg in (self.reg_key_data_1, self.reg_key_data_2) and self.interrupt_level == 0
+        if clear_interrupt:
+            self.set_interrupt(1)
+        return msg_data
+
+    def write_register(self, reg, msg_data):
+        with self.lock:
+            self.reg_writes[reg] = self.reg_writes[reg] + 1
+            if reg == self.reg_reset:
+                # software reset: 0x12 followed by 0x34
+                if msg_data == 0x12:
+                    self.reset_state = 1
+                    return
+                if msg_data == 0x34 and self.reset_state == 1:
+                    self.power_on()
+                    self.resets = self.resets + 1
+                    return
+                self.reset_state = 0
+                return
+            # key data is read only
+            if reg in (self.reg_key_data_1, self.reg_key_data_2):
+                return
+            self.regs[reg] = msg_data & 0xFF
+
+    # ===== keypad engine =====
+
+    # rows bits(5:3): 0 = scanning off, n = n + 1 rows; columns bits(2:0): n = n + 1 columns
+    def keypad_size(self):
+        config = self.regs[self.reg_key_config_2]
+        row_bits = (config >> 3) & 0x07
+        if row_bits == 0:
+            return 0, 0
+        return row_bits + 1, (config & 0x07) + 1
+
+    # time from a key press until the engine has it debounced: the row is scanned at a random point of
+    # the scan cycle; a sleeping engine is woken by the press and starts over from the first row
+    def scan_delay(self, row):
+        with self.lock:
+            rows, cols = self.keypad_size()
+            if rows == 0:
+                return 0.0
+            debounce = 0.0005 * (1 << (self.regs[self.reg_debounce_config] & 0x07))
+            scan_time = 0.001 * (1 << (self.regs[self.reg_key_config_1] & 0x07))
+            auto_sleep = (self.regs[self.reg_key_config_1] >> 4) & 0x07
+            now = time.time()
+            asleep = auto_sleep and now - self.last_key_time > 0.128 * (1 << (auto_sleep - 1))
+            self.last_key_time = now
+        if asleep:
+            return debounce + row * scan_time + debounce
+        return random.uniform(0, rows * scan_time) + debounce
+
+    # press one or more keys in the same scan; keys is a list of (row, col)
+    def press_keys(self, keys):
+        if self.scan_timing and keys:
+            time.sleep(self.scan_delay(min(row for row, col in keys)))
+        with self.lock:
+            rows, cols = self.keypad_size()
+            row_byte = 0xFF
+            col_byte = 0xFF
+            for row, col in keys:
+                if row >= rows or col >= cols:
+                    continue
+                row_byte = row_byte & ~(1 << row)
+                col_byte = col_byte & ~(1 << col)
+            if row_byte == 0xFF:
+                # scanning is off or the keys are outside the matrix
+                self.ignored_key_presses = self.ignored_key_presses + 1
+                return False
+            self.regs[self.reg_key_data_1] = col_byte & 0xFF
+            self.regs[self.reg_key_data_2] = row_byte & 0xFF
+            self.key_presses = self.key_presses + 1
+        self.set_interrupt(0)
+        return True
+
+    def press_key(self, row, col):
+        return self.press_keys([(row, col)])
+
+    # supply dip that resets the chip: every register returns to its reset value and NINT is released
+    def brown_out(self):
+        with self.lock:
+            self.power_on()
+            self.resets = self.resets + 1
+        self.set_interrupt(1)
+
+    # raw key data as read by the host, ie. a spurious 0xFF read
+    def set_key_data(self, col_byte, row_byte, interrupt=True):
+        with self.lock:
+            self.regs[self.reg_key_data_1] = col_byte
+            self.regs[self.reg_key_data_2] = row_byte
+        if interrupt:
+            self.set_interrupt(0)
+
+    # scripted key presses: each character is looked up in the keypad's key_map
+    def type_keys(self, keys, key_map, interval=0.0):
+        positions = {}
+        for row, row_keys in enumerate(key_map):
+            for col, key in enumerate(row_keys):
+                positions[key] = (row, col)
+        for key in keys:
+            row, col = positions[key]
+            self.press_key(row, col)
+            if interval > 0:
+                time.sleep(interval)
+
+    # LED on pin 14 / 15 is on when its driver is enabled and its RegDataB bit is 0
+    def led_on(self, pin):
+        bit = 1 << (pin - 8)
+        return bool(self.regs[self.reg_leddriverenable_B] & bit) and not (self.regs[self.reg_data_B] & bit)
+
+    def stats(self):
+        with self.lock:
+            reads = dict((reg, count) for reg, count in enumerate(self.reg_reads) if count)
+            writes = dict((reg, count) for reg, count in enumerate(self.reg_writes) if count)
+            return {'reads': reads, 'writes': writes, 'key_presses': self.key_presses,
+                    'ignored_key_presses': self.ignored_key_presses, 'resets': self.resets}
+
+# ========= END define a class to simulate the SX1509 register file and keypad engine =========
+
+
+# ========= define a class to simulate smbus.SMBus =========
+class SimulatedSMBus:
+
+    def __init__(self, channel=1):
+        self.channel = channel
+        self.lock = threading.Lock()
+        self.devices = {}
+        # injected faults: the next fault_count transactions fail with IOError(fault_errno)
+        self.fault_count = 0
+        self.fault_errno = errno.EIO
+        self.faults = 0
+        self.reset_stats()
+
+    def add_device(self, device):
+        self.devices[device.address] = device
+        return device
+
+    def reset_stats(self):
+        self.transactions = 0
+        self.bytes = 0
+        # address -> transaction count
+        self.device_transactions = {}
+        for device in self.devices.values():
+            device.reset_stats()
+
+    # bytes on the wire: address + register + data (+ repeated start address for reads)
+    def count(self, address, wire_bytes):
+        with self.lock:
+            self.transactions = self.transactions + 1
+            self.bytes = self.bytes + wire_bytes
+            self.device_transactions[address] = self.device_transactions.get(address, 0) + 1
+
+    # make the next count transactions fail, ie. errno.EREMOTEIO for a chip that doesn't ack
+    def fail(self, count=1, fault_errno=errno.EIO):
+        with self.lock:
+            self.fault_count = count
+            self.fault_errno = fault_errno
+
+    def device(self, address):
+        with self.lock:
+            if self.fault_count > 0:
+                self.fault_count = self.fault_count - 1
+                self.faults = self.faults + 1
+                raise IOError(self.fault_errno, os.strerror(self.fault_errno))
+        device = self.devices.get(address)
+        if device is None:
+            # same error as the smbus module when no device acks the address
+            raise IOError(errno.EREMOTEIO, 'Remote I/O error')
+        return device
+
+    def read_byte_data(self, address, reg):
+        device = self.device(address)
+        self.count(address, 4)
+        return device.read_register(reg)
+
+    def write_byte_data(self, address, reg, msg_data):
+        device = self.device(address)
+        self.count(address, 3)
+        device.write_register(reg, msg_data)
+
+    # register address auto increments, as on the SX1509
+    def read_i2c_block_data(self, address, reg, length=32):
+        device = self.device(address)
+        self.count(address, 3 + length)
+        return [device.read_register(reg + offset) for offset in range(length)]
+
+    def write_i2c_block_data(self, address, reg, data):
+        device = self.device(address)
+        self.count(address, 2 + len(data))
+        for offset, msg_data in enumerate(data):
+            device.write_register(reg + offset, msg_data)
+
+    def close(self):
+        pass
+
+    def stats(self):
+        with self.lock:
+            return {'transactions': self.transactions, 'bytes': self.bytes,
+                    'device_transactions': dict(self.device_transactions), 'faults': self.faults}
+
+# ========= END define a class to simulate smbus.SMBus =========
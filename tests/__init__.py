@@ -0,0 +1,3 @@
+# the tests provoke bus errors and invalid key data on purpose, keep their log warnings out of the results
+import keypad_log
+keypad_log.log.set_level(keypad_log.LOG_ERROR)
@@ -0,0 +1,121 @@
+#-------------------------------------------------------------------------------
+# Name:        test_health_monitor
+# Purpose:     Unit tests for KeypadHealthMonitor fault detection and recovery on the simulated SX1509
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#-------------------------------------------------------------------------------
+# run from the repository root: python -m unittest discover -s tests -t .
+
+import time
+import errno
+import unittest
+
+import SX150_keypad_I2C_interface as keypad_interface
+from sx1509_sim import SimulatedGPIO, SimulatedSMBus, SimulatedSX1509
+
+# registers the keypad configures, see I2C_KeyPad.config_writes
+REG_CLOCK = 0x1E
+REG_KEY_CONFIG_1 = 0x25
+REG_KEY_CONFIG_2 = 0x26
+
+
+def wait_for(condition, timeout=2.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class HealthMonitorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gpio = SimulatedGPIO()
+        self.bus = SimulatedSMBus()
+        self.chip = self.bus.add_device(SimulatedSX1509(0x3E))
+        self.chip.connect_interrupt(self.gpio, 7)
+        self.keypad = keypad_interface.I2C_KeyPad(bus=self.bus, gpio=self.gpio, self_test=False,
+                                                  health_check_interval=0.05)
+        self.health = self.keypad.health
+        self.configured = [self.chip.regs[reg] for reg in (REG_CLOCK, REG_KEY_CONFIG_1, REG_KEY_CONFIG_2)]
+
+    def tearDown(self):
+        self.health.stop()
+
+    def config(self):
+        return [self.chip.regs[reg] for reg in (REG_CLOCK, REG_KEY_CONFIG_1, REG_KEY_CONFIG_2)]
+
+    def type_key(self, key):
+        count = self.keypad.key_sequence.count
+        self.chip.type_keys(key, self.keypad.key_map)
+        return wait_for(lambda: self.keypad.key_sequence.count == count + 1)
+
+    def test_clean_checks(self):
+        self.assertTrue(wait_for(lambda: self.health.checks >= 3))
+        stats = self.health.stats()
+        self.assertEqual((stats['failed_checks'], stats['chip_resets'], stats['repairs'], stats['recoveries']),
+                         (0, 0, 0, 0))
+        self.assertTrue(stats['healthy'])
+
+    def test_brown_out_recovery(self):
+        self.chip.brown_out()
+        self.assertEqual(self.chip.regs[REG_KEY_CONFIG_2], 0x00)
+        self.assertTrue(wait_for(lambda: self.health.recoveries == 1))
+        self.assertEqual(self.health.chip_resets, 1)
+        self.assertEqual(self.config(), self.configured)
+        self.assertTrue(self.health.stats()['healthy'])
+        # the keypad engine scans again
+        self.assertTrue(self.type_key('1'))
+
+    def test_brown_out_keeps_scanning_disabled(self):
+        self.keypad.enable_keypad_scanning(False)
+        self.chip.brown_out()
+        self.assertTrue(wait_for(lambda: self.health.recoveries == 1))
+        self.assertEqual(self.chip.regs[REG_KEY_CONFIG_2], 0x00)
+        self.assertEqual(self.chip.regs[REG_CLOCK], self.configured[0])
+
+    def test_changed_register_is_repaired(self):
+        self.chip.regs[REG_KEY_CONFIG_1] = 0x07
+        self.assertTrue(wait_for(lambda: self.health.repairs == 1))
+        self.assertEqual(self.health.chip_resets, 0)
+        self.assertEqual(self.config(), self.configured)
+
+    def test_bus_outage(self):
+        self.bus.fail(20, errno.EREMOTEIO)
+        self.assertTrue(wait_for(lambda: self.health.failed_checks > 0))
+        self.assertFalse(self.health.stats()['healthy'])
+        self.assertTrue(wait_for(lambda: self.health.recoveries == 1))
+        stats = self.health.stats()
+        self.assertTrue(stats['healthy'])
+        self.assertTrue(stats['recovery_time_last'] > 0)
+        self.assertTrue(self.type_key('1'))
+
+    def test_key_press_during_an_outage_is_read_after_recovery(self):
+        self.bus.fail(8, errno.EREMOTEIO)
+        self.chip.type_keys('5', self.keypad.key_map)
+        self.assertTrue(wait_for(lambda: self.health.recoveries == 1))
+        self.assertTrue(wait_for(lambda: self.keypad.key_sequence.count == 1))
+        self.assertEqual(self.chip.interrupt_level, 1)
+
+    def test_stuck_interrupt_is_read_on_a_clean_check(self):
+        # the callback could not read the key data and its deferred read was lost to a dispatcher overflow
+        read_block_nowait = self.keypad.regs.read_block_nowait
+        submit = self.keypad.dispatcher.submit
+        self.keypad.regs.read_block_nowait = lambda reg, count: None
+        self.keypad.dispatcher.submit = lambda keypad, timestamp, key_data: False
+        try:
+            self.chip.type_keys('5', self.keypad.key_map)
+        finally:
+            self.keypad.regs.read_block_nowait = read_block_nowait
+            self.keypad.dispatcher.submit = submit
+        self.assertEqual(self.chip.interrupt_level, 0)
+        self.assertTrue(wait_for(lambda: self.keypad.key_sequence.count == 1))
+        self.assertEqual(self.chip.interrupt_level, 1)
+        self.assertEqual(self.health.stuck_interrupts, 1)
+        self.assertEqual(self.health.recoveries, 0)
+
+
+if __name__ == '__main__':
+    unittest.main()
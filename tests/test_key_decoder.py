@@ -0,0 +1,102 @@
+#-------------------------------------------------------------------------------
+# Name:        test_key_decoder
+# Purpose:     Unit tests for SX1509_KeyDecoder and the key data path of I2C_KeyPad
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#-------------------------------------------------------------------------------
+# run from the repository root: python -m unittest discover -s tests -t .
+
+import time
+import unittest
+
+import SX150_keypad_I2C_interface as keypad_interface
+from SX150_keypad_I2C_interface import (SX1509_KeyDecoder, KEYPAD_3X4, KEY_DECODE_OK, KEY_DECODE_NONE,
+                                        KEY_DECODE_MULTI, KEY_DECODE_RANGE, KEY_DECODE_AMBIGUOUS)
+from sx1509_sim import SimulatedGPIO, SimulatedSMBus, SimulatedSX1509
+
+
+# raw key data: the pressed row or column is the 0 bit
+def key_byte(*bits):
+    raw_byte = 0xFF
+    for bit_num in bits:
+        raw_byte = raw_byte & ~(1 << bit_num)
+    return raw_byte
+
+
+def wait_for(condition, timeout=1.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class KeyDecoderTest(unittest.TestCase):
+
+    def setUp(self):
+        self.decoder = SX1509_KeyDecoder(KEYPAD_3X4, 4, 3)
+
+    def test_every_single_key(self):
+        for row in range(4):
+            for col in range(3):
+                self.assertEqual(self.decoder.decode(key_byte(col), key_byte(row)),
+                                 (KEY_DECODE_OK, row, col, KEYPAD_3X4[row][col]))
+                self.assertEqual(self.decoder.decode_keys(key_byte(col), key_byte(row)),
+                                 (KEY_DECODE_OK, ((row, col, KEYPAD_3X4[row][col]),)))
+
+    def test_no_key(self):
+        self.assertEqual(self.decoder.decode_keys(0xFF, key_byte(0)), (KEY_DECODE_NONE, ()))
+        self.assertEqual(self.decoder.decode_keys(key_byte(0), 0xFF), (KEY_DECODE_NONE, ()))
+
+    def test_single_bit_outside_the_matrix(self):
+        self.assertEqual(self.decoder.decode_keys(key_byte(3), key_byte(0)), (KEY_DECODE_RANGE, ()))
+        self.assertEqual(self.decoder.decode_keys(key_byte(0), key_byte(4)), (KEY_DECODE_RANGE, ()))
+
+    def test_several_bits_with_one_outside_the_matrix(self):
+        # 0xF6: columns 0 and 3 of a 3 column keypad
+        self.assertEqual(self.decoder.decode_keys(0xF6, 0xFE), (KEY_DECODE_RANGE, ()))
+        self.assertEqual(self.decoder.decode_keys(key_byte(0), key_byte(1, 6)), (KEY_DECODE_RANGE, ()))
+        self.assertEqual(self.decoder.decode_keys(0xF6, key_byte(0, 1)), (KEY_DECODE_RANGE, ()))
+
+    def test_keys_pressed_in_one_row(self):
+        self.assertEqual(self.decoder.decode_keys(key_byte(0, 2), key_byte(1)),
+                         (KEY_DECODE_MULTI, ((1, 0, '4'), (1, 2, '6'))))
+
+    def test_keys_pressed_in_one_column(self):
+        self.assertEqual(self.decoder.decode_keys(key_byte(1), key_byte(0, 3)),
+                         (KEY_DECODE_MULTI, ((0, 1, '2'), (3, 1, '0'))))
+
+    def test_keys_pressed_in_two_rows_and_columns(self):
+        self.assertEqual(self.decoder.decode_keys(key_byte(0, 1), key_byte(0, 1)), (KEY_DECODE_AMBIGUOUS, ()))
+
+
+class KeypadKeyDataTest(unittest.TestCase):
+
+    def setUp(self):
+        self.gpio = SimulatedGPIO()
+        self.bus = SimulatedSMBus()
+        self.chip = self.bus.add_device(SimulatedSX1509(0x3E))
+        self.chip.connect_interrupt(self.gpio, 7)
+        self.keypad = keypad_interface.I2C_KeyPad(bus=self.bus, gpio=self.gpio, self_test=False,
+                                                  health_check_interval=60.0)
+
+    def tearDown(self):
+        self.keypad.health.stop()
+
+    def test_spurious_key_data_is_counted(self):
+        self.chip.set_key_data(0xF6, 0xFE)
+        self.assertTrue(wait_for(lambda: self.keypad.key_decode_errors[KEY_DECODE_RANGE] == 1))
+        self.assertEqual(self.keypad.key_sequence.count, 0)
+
+    def test_key_after_spurious_key_data(self):
+        self.chip.set_key_data(0xF6, 0xFE)
+        self.assertTrue(wait_for(lambda: self.keypad.key_decode_errors[KEY_DECODE_RANGE] == 1))
+        self.chip.type_keys('5', self.keypad.key_map)
+        self.assertTrue(wait_for(lambda: self.keypad.key_sequence.count == 1))
+        self.assertEqual(self.keypad.key_decode_errors[KEY_DECODE_RANGE], 1)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,182 @@
+#-------------------------------------------------------------------------------
+# Name:        test_key_sequence
+# Purpose:     Unit tests for KeySequenceBuffer and the unlock code modes of the simulated keypad
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#-------------------------------------------------------------------------------
+# run from the repository root: python -m unittest discover -s tests -t .
+
+import time
+import unittest
+
+import SX150_keypad_I2C_interface as keypad_interface
+from SX150_keypad_I2C_interface import KeySequenceBuffer, KEY_SEQUENCE_FIXED, KEY_SEQUENCE_ROLLING
+from sx1509_sim import SimulatedGPIO, SimulatedSMBus, SimulatedSX1509
+
+
+# stand-in for PASSCODE_DB that accepts 1234
+class PasscodeDB:
+
+    def __init__(self):
+        self.check_time = 0.0
+        self.checks = 0
+
+    def check_unlock_code(self, unlock_code):
+        self.checks = self.checks + 1
+        if self.check_time > 0:
+            time.sleep(self.check_time)
+        if unlock_code == '1234':
+            return 1
+        return -1
+
+    def ceate_alert(self, alert_description=None, alert_type=None):
+        pass
+
+    def write_audit_events(self, events):
+        pass
+
+
+def add_keys(sequence, keys):
+    return [code for code in [sequence.add(key) for key in keys] if code is not None]
+
+
+def wait_for(condition, timeout=1.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.005)
+    return True
+
+
+class KeySequenceBufferTest(unittest.TestCase):
+
+    def test_fixed_length(self):
+        sequence = KeySequenceBuffer(4)
+        self.assertEqual(add_keys(sequence, '123'), [])
+        self.assertEqual(add_keys(sequence, '4'), ['1234'])
+        self.assertTrue(sequence.pending)
+
+    def test_keys_while_pending_are_typed_ahead(self):
+        sequence = KeySequenceBuffer(4)
+        add_keys(sequence, '9999')
+        self.assertEqual(add_keys(sequence, '1234'), [])
+        self.assertEqual(sequence.ahead, 4)
+        # the typed ahead keys complete the next code as soon as the pending one is released
+        self.assertEqual(sequence.release(True), '1234')
+        self.assertTrue(sequence.pending)
+        self.assertEqual(sequence.release(True), None)
+        self.assertEqual(add_keys(sequence, '5678'), ['5678'])
+
+    def test_release_without_type_ahead_drops_the_keys(self):
+        sequence = KeySequenceBuffer(4)
+        add_keys(sequence, '99991')
+        self.assertEqual(sequence.release(False), None)
+        self.assertEqual((sequence.count, sequence.ahead, sequence.pending), (0, 0, False))
+        self.assertEqual(add_keys(sequence, '1234'), ['1234'])
+
+    def test_type_ahead_is_bounded(self):
+        sequence = KeySequenceBuffer(4)
+        add_keys(sequence, '9999')
+        add_keys(sequence, '123456')
+        self.assertEqual(sequence.ahead, sequence.capacity - 4)
+        self.assertEqual(sequence.dropped, 1)
+
+    def test_rolling_window(self):
+        sequence = KeySequenceBuffer(4, KEY_SEQUENCE_ROLLING)
+        codes = []
+        for key in '9991234':
+            code = sequence.add(key)
+            if code is not None:
+                codes.append(code)
+                sequence.release(True)
+        self.assertEqual(codes, ['9991', '9912', '9123', '1234'])
+
+    def test_rolling_window_with_type_ahead(self):
+        sequence = KeySequenceBuffer(4, KEY_SEQUENCE_ROLLING)
+        self.assertEqual(add_keys(sequence, '9991'), ['9991'])
+        add_keys(sequence, '234')
+        # the window moves over the typed ahead keys to the last 4 keys
+        self.assertEqual(sequence.release(True), '1234')
+
+    def test_terminated_code(self):
+        sequence = KeySequenceBuffer(6, terminators=('#',), clear_keys=('*',))
+        self.assertEqual(add_keys(sequence, '#'), [])
+        self.assertEqual(add_keys(sequence, '12#'), ['12'])
+        sequence.release(False)
+        self.assertEqual(add_keys(sequence, '99*1234#'), ['1234'])
+        sequence.release(False)
+        # past the length the oldest keys are dropped
+        self.assertEqual(add_keys(sequence, '99123456#'), ['123456'])
+
+    def test_invalid_configuration(self):
+        self.assertRaises(ValueError, KeySequenceBuffer, 0)
+        self.assertRaises(ValueError, KeySequenceBuffer, 4, 'sliding')
+        self.assertRaises(ValueError, KeySequenceBuffer, 4, KEY_SEQUENCE_ROLLING, ('#',))
+
+
+class KeypadUnlockCodeTest(unittest.TestCase):
+
+    def start(self, **keypad_args):
+        gpio = SimulatedGPIO()
+        bus = SimulatedSMBus()
+        self.chip = bus.add_device(SimulatedSX1509(0x3E))
+        self.chip.connect_interrupt(gpio, 7)
+        self.keypad = keypad_interface.I2C_KeyPad(bus=bus, gpio=gpio, self_test=False, health_check_interval=60.0,
+                                                  **keypad_args)
+        self.DB = PasscodeDB()
+        self.ui = keypad_interface.UserInterfaceThread(Keypad=self.keypad, db_factory=lambda: self.DB,
+                                                       remote_commands=False)
+        self.ui.daemon = True
+        self.ui.start()
+
+    def tearDown(self):
+        self.keypad.health.stop()
+        self.ui.audit.close()
+
+    # one key at a time, waiting for each to be taken or refused, the way a person types
+    def type_keys(self, keys):
+        for key in keys:
+            self.chip.type_keys(key, self.keypad.key_map)
+            self.assertTrue(wait_for(lambda: self.keypad.dispatcher.pending() == 0))
+            time.sleep(0.02)
+
+    def test_fixed_code(self):
+        self.start()
+        self.type_keys('1234')
+        self.assertTrue(self.ui.unlock_event.wait(1))
+
+    def test_fixed_mode_needs_the_code_from_the_first_key(self):
+        self.start(key_sequence_mode=KEY_SEQUENCE_FIXED)
+        self.type_keys('991234')
+        self.assertFalse(self.ui.unlock_event.wait(0.2))
+
+    def test_rolling_code_without_type_ahead(self):
+        self.start(key_sequence_mode=KEY_SEQUENCE_ROLLING, type_ahead=False)
+        self.type_keys('9991234')
+        self.assertTrue(self.ui.unlock_event.wait(1))
+
+    def test_rolling_code_with_type_ahead(self):
+        self.start(key_sequence_mode=KEY_SEQUENCE_ROLLING, type_ahead=True)
+        self.type_keys('9991234')
+        self.assertTrue(self.ui.unlock_event.wait(1))
+
+    def test_type_ahead_retyped_code(self):
+        self.start(type_ahead=True)
+        self.DB.check_time = 0.1
+        # the retyped code is typed while the mistyped one is still being checked
+        for key in '99991234':
+            self.chip.type_keys(key, self.keypad.key_map)
+            time.sleep(0.01)
+        self.assertTrue(self.ui.unlock_event.wait(1))
+        self.assertEqual(self.DB.checks, 2)
+
+    def test_terminated_code(self):
+        self.start(unlock_code_max=6, terminators=('#',), clear_keys=('*',))
+        self.type_keys('5*1234#')
+        self.assertTrue(self.ui.unlock_event.wait(1))
+
+
+if __name__ == '__main__':
+    unittest.main()
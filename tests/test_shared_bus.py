@@ -0,0 +1,154 @@
+#-------------------------------------------------------------------------------
+# Name:        test_shared_bus
+# Purpose:     Unit tests for SharedBus priorities, posted write coalescing and retries
+#
+# Copyright:   (c) DeviceFusion LLC 2019
+# Licence:     DeviceFusion LLC CONFIDENTIAL
+#-------------------------------------------------------------------------------
+# run from the repository root: python -m unittest discover -s tests -t .
+
+import time
+import errno
+import threading
+import unittest
+
+from SX150_keypad_I2C_interface import SharedBus, PRIORITY_KEY_DATA, PRIORITY_NORMAL, PRIORITY_LED
+from sx1509_sim import SimulatedSMBus, SimulatedSX1509
+
+ADDRESS = 0x3E
+REG_DATA_B = 0x10       # PRIORITY_LED
+REG_KEY_DATA_1 = 0x27   # PRIORITY_KEY_DATA
+REG_KEY_CONFIG_2 = 0x26 # PRIORITY_NORMAL
+
+
+def wait_for(condition, timeout=1.0):
+    deadline = time.time() + timeout
+    while not condition():
+        if time.time() > deadline:
+            return False
+        time.sleep(0.001)
+    return True
+
+
+class SharedBusTest(unittest.TestCase):
+
+    def setUp(self):
+        self.smbus = SimulatedSMBus()
+        self.chip = self.smbus.add_device(SimulatedSX1509(ADDRESS))
+        self.bus = SharedBus(self.smbus, retry_delay=0.0001, retry_delay_max=0.0001)
+
+    def test_register_priorities(self):
+        self.assertEqual(self.bus.priority(REG_KEY_DATA_1), PRIORITY_KEY_DATA)
+        self.assertEqual(self.bus.priority(REG_KEY_CONFIG_2), PRIORITY_NORMAL)
+        self.assertEqual(self.bus.priority(REG_DATA_B), PRIORITY_LED)
+        self.assertEqual(self.bus.priority(0x5F), PRIORITY_LED)
+
+    def test_waiting_transactions_run_in_priority_order(self):
+        order = []
+        def transaction(priority):
+            with self.bus.transaction(priority):
+                order.append(priority)
+        self.bus.acquire()
+        threads = []
+        # queued lowest priority first
+        for priority in (PRIORITY_LED, PRIORITY_NORMAL, PRIORITY_KEY_DATA):
+            thread = threading.Thread(target=transaction, args=(priority,))
+            thread.start()
+            threads.append(thread)
+            self.assertTrue(wait_for(lambda: self.bus.waiting[priority] == 1))
+        self.bus.release()
+        for thread in threads:
+            thread.join(1)
+        self.assertEqual(order, [PRIORITY_KEY_DATA, PRIORITY_NORMAL, PRIORITY_LED])
+        self.assertEqual(self.bus.stats()['wait_count'], [1, 1, 1])
+
+    def test_nested_transactions_do_not_wait(self):
+        with self.bus.transaction():
+            with self.bus.transaction(PRIORITY_KEY_DATA):
+                self.bus.write_byte_data(ADDRESS, REG_KEY_CONFIG_2, 0x1A)
+        self.assertEqual(self.bus.owner, None)
+        self.assertEqual(self.chip.regs[REG_KEY_CONFIG_2], 0x1A)
+
+    def test_try_acquire(self):
+        self.assertTrue(self.bus.try_acquire(PRIORITY_KEY_DATA))
+        holder = []
+        thread = threading.Thread(target=lambda: holder.append(self.bus.try_acquire(PRIORITY_KEY_DATA)))
+        thread.start()
+        thread.join(1)
+        self.assertEqual(holder, [False])
+        self.bus.release()
+        # a waiting key data read goes first
+        self.bus.waiting[PRIORITY_KEY_DATA] = 1
+        self.assertFalse(self.bus.try_acquire(PRIORITY_NORMAL))
+        self.assertFalse(self.bus.try_acquire(PRIORITY_KEY_DATA))
+        self.bus.waiting[PRIORITY_KEY_DATA] = 0
+        self.bus.waiting[PRIORITY_LED] = 1
+        self.assertTrue(self.bus.try_acquire(PRIORITY_KEY_DATA))
+        self.bus.release()
+
+    def test_nowait_read_while_the_bus_is_held(self):
+        self.chip.regs[REG_KEY_DATA_1] = 0xFE
+        result = []
+        def read():
+            result.append(self.bus.read_i2c_block_data_nowait(ADDRESS, REG_KEY_DATA_1, 2))
+        with self.bus.transaction():
+            thread = threading.Thread(target=read)
+            thread.start()
+            thread.join(1)
+        self.assertEqual(result, [None])
+        self.assertEqual(self.chip.reg_reads[REG_KEY_DATA_1], 0)
+        read()
+        self.assertEqual(result[1], [0xFE, 0xFF])
+
+    def test_nowait_read_does_not_retry(self):
+        self.smbus.fail(1)
+        self.assertEqual(self.bus.read_i2c_block_data_nowait(ADDRESS, REG_KEY_DATA_1, 2), None)
+        self.assertEqual(self.bus.retried, 0)
+        self.assertEqual(self.bus.errors['transient'], 1)
+
+    def test_posted_writes_are_coalesced(self):
+        with self.bus.transaction():
+            self.bus.post_writes(ADDRESS, [(REG_DATA_B, 0x3F)])
+            self.bus.post_writes(ADDRESS, [(REG_DATA_B, 0xBF), (0x5F, 0x10)])
+            self.assertEqual(self.chip.reg_writes[REG_DATA_B], 0)
+        self.assertTrue(wait_for(lambda: self.chip.reg_writes[0x5F] == 1))
+        self.assertEqual(self.chip.reg_writes[REG_DATA_B], 1)
+        self.assertEqual(self.chip.regs[REG_DATA_B], 0xBF)
+        stats = self.bus.stats()
+        self.assertEqual((stats['posted_writes'], stats['coalesced_writes']), (3, 1))
+
+    def test_synchronous_write_replaces_a_posted_write(self):
+        with self.bus.transaction():
+            self.bus.post_writes(ADDRESS, [(REG_DATA_B, 0x3F)])
+            self.bus.write_byte_data(ADDRESS, REG_DATA_B, 0xFF)
+        time.sleep(0.01)
+        self.assertEqual(self.chip.reg_writes[REG_DATA_B], 1)
+        self.assertEqual(self.chip.regs[REG_DATA_B], 0xFF)
+
+    def test_read_flushes_a_posted_write(self):
+        with self.bus.transaction():
+            self.bus.post_writes(ADDRESS, [(REG_DATA_B, 0x3F)])
+            self.assertEqual(self.bus.read_byte_data(ADDRESS, REG_DATA_B), 0x3F)
+        time.sleep(0.01)
+        self.assertEqual(self.chip.reg_writes[REG_DATA_B], 1)
+
+    def test_transient_errors_are_retried(self):
+        self.smbus.fail(2)
+        self.bus.write_byte_data(ADDRESS, REG_KEY_CONFIG_2, 0x1A)
+        self.assertEqual(self.chip.regs[REG_KEY_CONFIG_2], 0x1A)
+        self.assertEqual((self.bus.retried, self.bus.errors['transient']), (2, 2))
+
+    def test_retries_are_bounded(self):
+        self.smbus.fail(10, errno.EREMOTEIO)
+        self.assertRaises(IOError, self.bus.read_byte_data, ADDRESS, REG_KEY_CONFIG_2)
+        self.assertEqual(self.bus.errors['no_ack'], self.bus.retries + 1)
+        self.assertEqual(self.bus.owner, None)
+
+    def test_fatal_errors_are_not_retried(self):
+        self.smbus.fail(1, errno.EBADF)
+        self.assertRaises(IOError, self.bus.read_byte_data, ADDRESS, REG_KEY_CONFIG_2)
+        self.assertEqual((self.bus.retried, self.bus.errors['fatal']), (0, 1))
+
+
+if __name__ == '__main__':
+    unittest.main()